@@ -0,0 +1,177 @@
+"""
+Reader for NDJSON return event archives.
+
+Archives hold one JSON return event per line and can be several GB in size.
+The file is memory-mapped and split on newlines in place, so only the line
+being parsed is ever copied out of the page cache. A byte range can be given
+to read a single shard of the archive; a line belongs to the range in which
+its first byte falls, so disjoint ranges never process the same line twice.
+"""
+import json
+import mmap
+import os
+import weakref
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple
+
+
+@dataclass
+class ArchiveRecord:
+    """Represents a single line read from an event archive."""
+    offset: int  # Byte offset of the first byte of the line
+    next_offset: int  # Byte offset to resume from after this line
+    event: Optional[dict] = None
+    error: Optional[str] = None  # Set when the line is not a valid event
+    raw: Optional[str] = None  # Original line, kept only for invalid lines
+
+
+def shard_ranges(size: int, num_shards: int) -> List[Tuple[int, int]]:
+    """Splits an archive of `size` bytes into contiguous byte ranges.
+
+    Args:
+        size (int): Archive size in bytes
+        num_shards (int): Number of shards
+
+    Raises:
+        ValueError: If `num_shards` is less than 1
+
+    Returns:
+        List[Tuple[int, int]]: (start, end) byte range for each shard
+    """
+    if num_shards < 1:
+        raise ValueError(f"Invalid number of shards: {num_shards}")
+
+    bounds = [size * n // num_shards for n in range(num_shards + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class ArchiveReader:
+    """Memory-mapped reader for an NDJSON event archive.
+
+    Use as a context manager so the mapping is released when done:
+
+        with ArchiveReader("events.ndjson") as reader:
+            for record in reader.iter_records():
+                ...
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.position = 0  # Resume offset after the last line handed out
+        self._file = open(path, "rb")
+        self.size = os.fstat(self._file.fileno()).st_size
+        # mmap cannot map an empty file
+        self._map = None
+        self._view = memoryview(b"")
+        self._iterators = weakref.WeakSet()  # Line iterators that may hold a slice
+        if self.size:
+            self._map = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        """Releases the memory map and closes the archive file.
+
+        Iterations still in progress are closed first, releasing the line
+        they hold, since the map cannot be closed while a slice of it is in
+        use. They end if advanced afterwards.
+        """
+        for iterator in list(self._iterators):
+            iterator.close()
+        self._view.release()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def shards(self, num_shards: int) -> List[Tuple[int, int]]:
+        """Returns `num_shards` disjoint byte ranges covering the archive."""
+        return shard_ranges(self.size, num_shards)
+
+    def _line_start(self, offset: int) -> int:
+        """Returns the start of the first line beginning at or after `offset`."""
+        if offset <= 0:
+            return 0
+        if offset >= self.size:
+            return self.size
+        if self._map[offset - 1] == ord("\n"):
+            return offset
+        newline = self._map.find(b"\n", offset)
+        return self.size if newline == -1 else newline + 1
+
+    def iter_lines(self, start: int = 0,
+                   end: Optional[int] = None) -> Iterator[Tuple[int, int, memoryview]]:
+        """Yields the lines that begin within the byte range [start, end).
+
+        Lines are yielded as memoryview slices of the mapped file, without
+        the trailing newline. A slice is released once the iterator advances,
+        so copy it (e.g. with `bytes()`) if it is needed afterwards.
+
+        Args:
+            start (int): Byte offset to start from, e.g. a saved resume offset
+            end (Optional[int]): Byte offset to stop at, defaults to end of file
+
+        Yields:
+            Tuple[int, int, memoryview]: (offset, next_offset, line)
+        """
+        lines = self._iter_lines(start, end)
+        self._iterators.add(lines)
+        return lines
+
+    def _iter_lines(self, start: int,
+                    end: Optional[int]) -> Iterator[Tuple[int, int, memoryview]]:
+        end = self.size if end is None else min(end, self.size)
+        offset = self._line_start(start)
+
+        while offset < end:
+            newline = self._map.find(b"\n", offset)
+            stop = self.size if newline == -1 else newline
+            next_offset = stop + 1 if newline != -1 else self.size
+
+            self.position = next_offset
+            with self._view[offset:stop] as line:
+                yield offset, next_offset, line
+
+            offset = next_offset
+
+    def iter_records(self, start: int = 0,
+                     end: Optional[int] = None) -> Iterator[ArchiveRecord]:
+        """Yields parsed return events that begin within [start, end).
+
+        Blank lines are skipped. Lines that are not a JSON object are yielded
+        with `error` set instead of raising, so one bad line does not stop a
+        replay.
+
+        Args:
+            start (int): Byte offset to start from, e.g. a saved resume offset
+            end (Optional[int]): Byte offset to stop at, defaults to end of file
+
+        Yields:
+            ArchiveRecord: Parsed event or parse error for each line
+        """
+        for offset, next_offset, line in self.iter_lines(start, end):
+            data = line.tobytes()
+            if not data.strip():
+                continue
+
+            try:
+                event = json.loads(data)
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                yield ArchiveRecord(offset, next_offset,
+                                    error=f"Invalid JSON: {str(e)}",
+                                    raw=data.decode("utf-8", errors="replace"))
+                continue
+
+            if not isinstance(event, dict):
+                yield ArchiveRecord(offset, next_offset,
+                                    error="Invalid event: expected a JSON object",
+                                    raw=data.decode("utf-8", errors="replace"))
+                continue
+
+            yield ArchiveRecord(offset, next_offset, event=event)
@@ -0,0 +1,201 @@
+"""
+Coalescing window in front of `process_rental_returns`.
+
+Kiosks often send a burst of returns from one user within seconds, e.g. a
+family returning six containers. `EventCoalescer` groups events by
+(location, user) for up to `window` seconds after the first one arrives and
+resolves each group in one transaction: the user's rentals are read once and
+the updates and responses are committed together. Rentals are assigned in
+the order the events were submitted, as processing them one at a time
+would, and each event still gets its own response.
+
+A group is processed early once it holds `max_events`, or when the same user
+returns at another location, so a user's groups are always processed in
+the order their events arrived. Events that cannot be parsed are not
+grouped and are answered by `process_rental_return` straight away.
+
+`submit` can be called from any thread and returns a future for the
+response. `run` processes groups on the calling thread, which must be the
+thread that uses the shared database connection. After `shutdown`, new
+events are refused and `run` returns once the open groups are processed.
+
+Metrics:
+    coalescer.pending_groups gauge, groups waiting to be processed
+    coalescer.groups         counter, groups processed
+    coalescer.events         counter, events processed in groups
+    coalescer.wait           timer, time from submit to processing
+"""
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+from rental_return_events.handler import ReturnEvent, parse_return_event
+from rental_return_events.metrics import metrics
+from rental_return_events.processor import process_rental_return, process_rental_returns
+from rental_return_events.retry import RetryPolicy
+
+DEFAULT_WINDOW = 0.5
+DEFAULT_MAX_EVENTS = 20
+
+
+@dataclass
+class CoalescedGroup:
+    """Events of one user at one location, processed together"""
+    key: Optional[Tuple[str, str]]  # (location_id, user_id), None for an unparsed event
+    deadline: float
+    events: List[dict] = field(default_factory=list)
+    return_events: List[ReturnEvent] = field(default_factory=list)
+    futures: List[Future] = field(default_factory=list)
+    submitted_at: List[float] = field(default_factory=list)
+    closed: bool = False  # Takes no more events and is processed next
+
+
+class EventCoalescer:
+    """Resolves bursts of returns from the same user and location in one transaction."""
+
+    def __init__(self, window: float = DEFAULT_WINDOW, max_events: int = DEFAULT_MAX_EVENTS,
+                 retry_policy: RetryPolicy = None):
+        """
+        Args:
+            window (float): Seconds a group stays open after its first event
+            max_events (int): Events after which a group is processed without waiting
+            retry_policy (RetryPolicy): Passed to the processor
+
+        Raises:
+            ValueError: If `window` is negative or `max_events` is below 1
+        """
+        if window < 0:
+            raise ValueError(f"Invalid coalescing window: {window}")
+        if max_events < 1:
+            raise ValueError(f"Invalid max events: {max_events}")
+
+        self.window = window
+        self.max_events = max_events
+        self.retry_policy = retry_policy
+        self._groups: List[CoalescedGroup] = []  # In the order they were opened
+        self._open = {}  # key -> group still taking events
+        self._open_by_user = {}  # user_id -> location of their open group
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def _close(self, group: CoalescedGroup) -> None:
+        group.closed = True
+        if self._open.get(group.key) is group:
+            del self._open[group.key]
+            del self._open_by_user[group.key[1]]
+
+    def submit(self, event: dict) -> Future:
+        """Adds an event to the open group for its location and user.
+
+        Args:
+            event (dict): Return event, as passed to `process_rental_return`
+
+        Raises:
+            RuntimeError: If the coalescer is shut down
+
+        Returns:
+            Future: Resolves to the response, or the exception processing raised
+        """
+        try:
+            return_event = parse_return_event(event)
+            key = (return_event.location_id, return_event.user_id)
+        except Exception:  # pylint: disable=broad-except
+            return_event, key = None, None  # Answered with its failure response by `run`
+
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Coalescer is shut down")
+
+            now = time.monotonic()
+            group = self._open.get(key)
+            if group is None:
+                if key is not None and key[1] in self._open_by_user:
+                    # Processed before this event, to keep the user's order
+                    self._close(self._open[(self._open_by_user[key[1]], key[1])])
+                group = CoalescedGroup(key, now + self.window)
+                self._groups.append(group)
+                if key is None:
+                    group.closed = True
+                else:
+                    self._open[key] = group
+                    self._open_by_user[key[1]] = key[0]
+
+            group.events.append(event)
+            group.return_events.append(return_event)
+            group.futures.append(future)
+            group.submitted_at.append(now)
+            if len(group.events) >= self.max_events:
+                self._close(group)
+
+            metrics.gauge("coalescer.pending_groups", len(self._groups))
+            self._condition.notify_all()
+        return future
+
+    def _next_group(self) -> Optional[CoalescedGroup]:
+        """Waits for the next group to process, None once shut down and drained.
+
+        Groups are taken in the order they were opened, skipping ones still
+        in their window. Opening a group for a user closes their other one,
+        so a user's groups become ready in the order they were opened.
+        """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                for group in self._groups:
+                    if group.closed or self._closed or group.deadline <= now:
+                        self._close(group)
+                        self._groups.remove(group)
+                        metrics.gauge("coalescer.pending_groups", len(self._groups))
+                        return group
+
+                if self._closed:
+                    return None
+                self._condition.wait(
+                    min(group.deadline for group in self._groups) - now if self._groups else None)
+
+    def _process(self, group: CoalescedGroup) -> None:
+        started = time.monotonic()
+        for submitted_at in group.submitted_at:
+            metrics.observe("coalescer.wait", started - submitted_at)
+
+        # Cancelled events are left out
+        running = [n for n, future in enumerate(group.futures)
+                   if future.set_running_or_notify_cancel()]
+        if not running:
+            return
+        futures = [group.futures[n] for n in running]
+
+        try:
+            if group.key is None:
+                responses = [process_rental_return(group.events[n], self.retry_policy)
+                             for n in running]
+            else:
+                responses = process_rental_returns(
+                    [group.return_events[n] for n in running], self.retry_policy)
+        except Exception as e:  # pylint: disable=broad-except
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        for future, response in zip(futures, responses):
+            future.set_result(response)
+        if group.key is not None:
+            metrics.increment("coalescer.groups")
+            metrics.increment("coalescer.events", len(futures))
+
+    def run(self) -> None:
+        """Processes groups on this thread until shut down and drained."""
+        while True:
+            group = self._next_group()
+            if group is None:
+                return
+            self._process(group)
+
+    def shutdown(self) -> None:
+        """Refuses new events and lets `run` return once the open groups are processed."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
@@ -12,6 +12,10 @@ from datetime import datetime
 from rental_return_events.logger import log_function_calls
 
 
+class InvalidQRCodeError(ValueError):
+    """Raised when QR code data cannot be decoded."""
+
+
 @dataclass
 class ReturnEvent:
     """Represents a return event."""
@@ -28,7 +32,7 @@ def decode_qr(encoded_str: str) -> str:
         encoded_str (str): Base64 encoded string
 
     Raises:
-        ValueError: If the string cannot be decoded
+        InvalidQRCodeError: If the string cannot be decoded
 
     Returns:
         str: Decoded string
@@ -36,7 +40,7 @@ def decode_qr(encoded_str: str) -> str:
     try:
         return base64.b64decode(encoded_str).decode("utf-8")
     except (UnicodeDecodeError, binascii.Error) as e:
-        raise ValueError(f"Could not decode QR: {str(e)}") from e
+        raise InvalidQRCodeError(f"Could not decode QR: {str(e)}") from e
 
 
 def convert_timestamp(timestamp: str) -> datetime:
@@ -65,7 +69,9 @@ def parse_return_event(event: dict) -> ReturnEvent:
         event (dict): JSON event data
 
     Raises:
-        ValueError: If any required key is missing
+        KeyError: If any required key is missing
+        InvalidQRCodeError: If a QR code cannot be decoded
+        ValueError: If the timestamp is invalid
 
     Returns:
         ReturnEvent: Parsed return event
@@ -91,5 +97,8 @@ def parse_return_event(event: dict) -> ReturnEvent:
     except KeyError as e:
         raise KeyError(f"Missing event key(s): {str(e)}") from e
 
+    except InvalidQRCodeError as e:
+        raise InvalidQRCodeError(f"Failed to parse return event: {str(e)}") from e
+
     except ValueError as e:
         raise ValueError(f"Failed to parse return event: {str(e)}") from e
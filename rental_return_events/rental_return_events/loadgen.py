@@ -0,0 +1,686 @@
+"""
+Load generator and soak test harness for the rental return service.
+
+Simulates kiosks emitting return events at a target rate and reports the
+throughput/latency curve, the error rate and the growth of the database and
+WAL files. Run several rates to find the saturation point, or one rate for a
+long time as a soak test.
+
+Each kiosk is a thread emitting events with exponential inter-arrival times,
+so a slow service builds up a queue instead of slowing the kiosks down.
+Latency is measured from when an event was due, including that queueing;
+service time excludes it.
+
+The event mix is that of `bootstrap/events.py`, at scale:
+    return     - a seeded user returns one of their rentals
+    repeat     - a user who just returned something returns another rental
+    invalid_qr - an undecodable QR code, or an asset that does not exist
+    expired    - a user whose only rentals have expired
+    duplicate  - a kiosk re-sends an event that was already processed
+
+Users and rentals for the run are seeded first, with ids unique to the run,
+so repeated runs against one database do not interfere, and deleted when the
+run ends.
+
+Database growth counts the pages in use rather than the file size, which
+never shrinks. Without `--publish` nothing drains the outbox, so it is
+drained before each measurement to leave the responses out of the growth.
+
+Drivers:
+    inprocess - events go through `process_rental_return` in this process,
+                on the thread that owns the shared connection
+    cli       - each event is written to a file and processed by
+                `python -m rental_return_events.main`, `--workers` at a time
+
+Usage:
+    python -m rental_return_events.loadgen --kiosks 20 --rates 50,100,200,400
+        [--step-duration 30] [--report-every 10] [--driver inprocess|cli]
+        [--workers N] [--mix return=0.7,invalid_qr=0.3] [--publish]
+"""
+import argparse
+import json
+import math
+import os
+import queue
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from collections import Counter, defaultdict, deque
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from topanga_queries import get_connection, get_db_path
+from topanga_queries.bootstrap.db import generate_rental_record
+from topanga_queries.bootstrap.events import encode_qr
+from topanga_queries.membership import invalidate_id_filters
+from topanga_queries.outbox import get_outbox_mode
+from topanga_queries.rentals import RENTAL_COLUMNS
+
+from rental_return_events.logger import configure_logging, logger
+from rental_return_events.processor import process_rental_return
+from rental_return_events.publisher import NullSink, OutboxPublisher
+
+DEFAULT_MIX = {
+    "return": 0.70,
+    "repeat": 0.10,
+    "invalid_qr": 0.08,
+    "expired": 0.06,
+    "duplicate": 0.06,
+}
+# Status each kind of event should get, any other outcome is an error
+EXPECTED_STATUS = {
+    "return": "SUCCESS",
+    "repeat": "SUCCESS",
+    "invalid_qr": "FAILED",
+    "expired": "FAILED",
+    "duplicate": "FAILED",
+}
+DEFAULT_RENTALS_PER_USER = 3
+DEFAULT_REPORT_EVERY = 10.0
+# A step that processes less than this share of the events emitted is saturated
+SATURATION_RATIO = 0.95
+LOCATIONS = [f"topanga-location-{n:02}" for n in range(1, 6)]
+RECENT_USERS = 1000
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """Parses an event mix such as `return=0.8,invalid_qr=0.2`.
+
+    Raises:
+        ValueError: If a kind is unknown or the weights do not add up to more than 0
+    """
+    mix = {}
+    for part in text.split(","):
+        kind, weight = part.split("=")
+        if kind not in EXPECTED_STATUS:
+            raise ValueError(f"Unknown event kind: {kind}")
+        mix[kind] = float(weight)
+
+    if sum(mix.values()) <= 0:
+        raise ValueError(f"Invalid event mix: {text}")
+    return mix
+
+
+def percentile(values, fraction: float) -> float:
+    """Nearest-rank percentile of `values`, 0.0 if there are none."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def latency_summary(seconds) -> dict:
+    """p50/p95/p99/max of durations in seconds, in milliseconds."""
+    return {
+        "p50": round(percentile(seconds, 0.50) * 1000, 3),
+        "p95": round(percentile(seconds, 0.95) * 1000, 3),
+        "p99": round(percentile(seconds, 0.99) * 1000, 3),
+        "max": round(max(seconds, default=0.0) * 1000, 3),
+    }
+
+
+def database_sizes() -> Tuple[int, int]:
+    """Sizes in bytes of the database file and its WAL."""
+    path = get_db_path()
+    return tuple(os.path.getsize(p) if os.path.exists(p) else 0
+                 for p in (path, f"{path}-wal"))
+
+
+def used_database_bytes() -> int:
+    """Bytes of the database pages in use, excluding free pages."""
+    connection = get_connection()
+    page_size, = connection.execute("PRAGMA page_size;").fetchone()
+    page_count, = connection.execute("PRAGMA page_count;").fetchone()
+    free_pages, = connection.execute("PRAGMA freelist_count;").fetchone()
+    return (page_count - free_pages) * page_size
+
+
+def drain_outbox() -> int:
+    """Deletes the responses queued in the outbox, as a publisher would."""
+    return OutboxPublisher(NullSink()).drain(get_connection())
+
+# ====================================================
+# Seeded Data and Events
+# ====================================================
+
+
+@dataclass
+class LoadPool:
+    """Users and rentals seeded for a load run"""
+    run_id: str
+    # user_id -> [asset_id, rentals left to return]
+    returnable: Dict[str, list]
+    # (user_id, asset_id) of users whose rentals have all expired
+    expired: List[Tuple[str, str]]
+
+
+def seed_load_rentals(users: int, rentals_per_user: int = DEFAULT_RENTALS_PER_USER,
+                      expired_users: int = 100, run_id: str = None) -> LoadPool:
+    """Seeds users with rentals in progress for a load run.
+
+    Each user rents one asset `rentals_per_user` times, so every return the
+    generator sends for them completes exactly one of their rentals.
+
+    Args:
+        users (int): Number of users with returnable rentals
+        rentals_per_user (int): Rentals in progress per user
+        expired_users (int): Number of users whose only rental has expired
+        run_id (str): Suffix for the seeded ids, random by default
+
+    Raises:
+        ValueError: If the database has no assets
+
+    Returns:
+        LoadPool: The seeded users
+    """
+    connection = get_connection()
+    assets = [row[0] for row in connection.execute("SELECT id FROM assets ORDER BY id;")]
+    if not assets:
+        raise ValueError("No assets in the database, initialize it first")
+
+    run_id = run_id or uuid4().hex[:8]
+    now = datetime.now(timezone.utc)
+    pool = LoadPool(run_id, {}, [])
+    user_rows, rental_rows = [], []
+
+    for n in range(users):
+        user_id, asset_id = f"load_{run_id}_u{n:06}", assets[n % len(assets)]
+        pool.returnable[user_id] = [asset_id, rentals_per_user]
+        user_rows.append((user_id, f"Load user {n}"))
+        rental_rows.extend(
+            generate_rental_record(f"load-{run_id}-u{n}-{k}", user_id, asset_id,
+                                   LOCATIONS[n % len(LOCATIONS)], now - timedelta(hours=k + 1),
+                                   10, "IN_PROGRESS")
+            for k in range(rentals_per_user))
+
+    for n in range(expired_users):
+        user_id, asset_id = f"load_{run_id}_x{n:06}", assets[n % len(assets)]
+        pool.expired.append((user_id, asset_id))
+        user_rows.append((user_id, f"Expired load user {n}"))
+        rental_rows.append(
+            generate_rental_record(f"load-{run_id}-x{n}", user_id, asset_id,
+                                   LOCATIONS[n % len(LOCATIONS)], now - timedelta(days=12),
+                                   1, "IN_PROGRESS"))
+
+    connection.executemany("INSERT INTO users(id, name) VALUES (?, ?);", user_rows)
+    connection.executemany(
+        f"INSERT INTO rentals({RENTAL_COLUMNS}) VALUES ({', '.join('?' * 10)});", rental_rows)
+    connection.commit()
+    invalidate_id_filters()
+    return pool
+
+
+def delete_load_rentals(pool: LoadPool) -> None:
+    """Deletes the users and rentals seeded for a load run.
+
+    Args:
+        pool (LoadPool): The seeded users
+    """
+    connection = get_connection()
+    connection.execute("DELETE FROM rentals WHERE id GLOB ?;", (f"load-{pool.run_id}-*",))
+    connection.execute("DELETE FROM users WHERE id GLOB ?;", (f"load_{pool.run_id}_*",))
+    connection.commit()
+    invalidate_id_filters()
+
+
+class EventGenerator:
+    """Builds the event stream of a run from a `LoadPool`, shared by the kiosks."""
+
+    def __init__(self, pool: LoadPool, mix: Dict[str, float] = None, seed=None):
+        self.pool = pool
+        self.kinds, self.weights = zip(*(mix or DEFAULT_MIX).items())
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._active = list(pool.returnable)  # Emptied users are removed lazily
+        self._recent = deque(maxlen=RECENT_USERS)
+        self._finished = deque(maxlen=RECENT_USERS)  # Events that used a user's last rental
+        self._unprocessed = {}  # id -> such an event, until `processed` is called for it
+
+    def _event(self, user_id: str, asset_qr_data: str) -> dict:
+        return {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "location_id": self._random.choice(LOCATIONS),
+            "user_qr_data": encode_qr(user_id),
+            "asset_qr_data": asset_qr_data,
+        }
+
+    def _pick_active(self) -> Optional[str]:
+        while self._active:
+            index = self._random.randrange(len(self._active))
+            user_id = self._active[index]
+            if self.pool.returnable[user_id][1]:
+                return user_id
+            self._active[index] = self._active[-1]
+            self._active.pop()
+        return None
+
+    def _return(self, user_id: str) -> dict:
+        entry = self.pool.returnable[user_id]
+        entry[1] -= 1
+        event = self._event(user_id, encode_qr(entry[0]))
+        if entry[1]:
+            self._recent.append(user_id)
+        else:
+            # Sent again once processed, this event finds no rental left to complete
+            self._unprocessed[id(event)] = event
+        return event
+
+    def processed(self, event: dict) -> None:
+        """Marks an event as processed, so it can be sent again as a duplicate.
+
+        A duplicate sent while its original is still being processed, as
+        with several `CliDriver` workers, could complete the rental itself
+        and leave the original to fail.
+        """
+        with self._lock:
+            event = self._unprocessed.pop(id(event), None)
+            if event is not None:
+                self._finished.append(event)
+
+    def next_event(self) -> Tuple[str, dict]:
+        """Returns the kind and payload of the next event.
+
+        A kind that cannot be built, e.g. a return once every seeded rental
+        has been returned, falls back to one that can.
+        """
+        with self._lock:
+            kind = self._random.choices(self.kinds, self.weights)[0]
+
+            if kind == "repeat":
+                user_id = self._random.choice(self._recent) if self._recent else None
+                if user_id and self.pool.returnable[user_id][1]:
+                    return kind, self._return(user_id)
+                kind = "return"
+
+            if kind == "return":
+                user_id = self._pick_active()
+                if user_id:
+                    return kind, self._return(user_id)
+                kind = "duplicate"
+
+            if kind == "duplicate" and self._finished:
+                return kind, dict(self._random.choice(self._finished))
+
+            if kind == "expired" and self.pool.expired:
+                user_id, asset_id = self._random.choice(self.pool.expired)
+                return kind, self._event(user_id, encode_qr(asset_id))
+
+            user_id = f"load_{self.pool.run_id}_u{self._random.randrange(1_000_000):06}"
+            if self._random.random() < 0.5:
+                return "invalid_qr", self._event(user_id, "%%not-base64%%")
+            return "invalid_qr", self._event(user_id, encode_qr("tpg_a99999"))
+
+# ====================================================
+# Drivers
+# ====================================================
+
+
+class InProcessDriver:
+    """Processes events with `process_rental_return` in this process."""
+
+    name = "inprocess"
+    # The shared connection can only be used by the thread that opened it
+    workers = 1
+
+    def handle(self, event: dict) -> dict:
+        """Processes one event and returns the response."""
+        return process_rental_return(event)
+
+    def __enter__(self) -> "InProcessDriver":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+class CliDriver:
+    """Processes each event in a `rental_return_events.main` subprocess."""
+
+    name = "cli"
+
+    def __init__(self, workers: int = 4):
+        self.workers = workers
+        self._directory = tempfile.TemporaryDirectory(prefix="loadgen-")
+        self.directory = self._directory.name
+
+    def __enter__(self) -> "CliDriver":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Removes the directory the event files are written to."""
+        self._directory.cleanup()
+
+    def handle(self, event: dict) -> dict:
+        """Runs one event through the command line and returns the response.
+
+        Raises:
+            RuntimeError: If the process fails
+        """
+        fd, path = tempfile.mkstemp(suffix=".json", dir=self.directory)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(event, f)
+
+        try:
+            # Writes to the outbox like the in-process driver, which `main`
+            # would otherwise skip
+            result = subprocess.run(
+                [sys.executable, "-m", "rental_return_events.main", path],
+                capture_output=True, text=True, check=False,
+                env={**os.environ, "TOPANGA_OUTBOX": get_outbox_mode()})
+        finally:
+            os.remove(path)
+
+        if result.returncode != 0 or "{" not in result.stdout:
+            raise RuntimeError(f"Exit status {result.returncode}: "
+                               f"{(result.stdout + result.stderr).strip()[-200:]}")
+        return json.loads(result.stdout[result.stdout.index("{"):])
+
+# ====================================================
+# Load Steps
+# ====================================================
+
+
+@dataclass
+class StepReport:
+    """Results of running one target rate"""
+    target_rate: float
+    duration_seconds: float
+    emitted: int = 0
+    processed: int = 0
+    backlog: int = 0
+    errors: int = 0
+    latency_ms: dict = field(default_factory=dict)
+    service_ms: dict = field(default_factory=dict)
+    by_kind: dict = field(default_factory=dict)
+    db_bytes: int = 0
+    wal_bytes: int = 0
+    db_growth_bytes: int = 0
+    windows: list = field(default_factory=list)
+
+    @property
+    def achieved_rate(self) -> float:
+        """Events processed per second"""
+        return self.processed / self.duration_seconds if self.duration_seconds else 0.0
+
+    @property
+    def error_rate(self) -> float:
+        """Share of processed events that raised or got an unexpected status"""
+        return self.errors / self.processed if self.processed else 0.0
+
+    @property
+    def saturated(self) -> bool:
+        """Whether the service fell behind the events the kiosks sent"""
+        return self.processed < SATURATION_RATIO * self.emitted
+
+    def to_dict(self):
+        """Converts the report to a dictionary for JSON serialization"""
+        report = asdict(self)
+        report["achieved_rate"] = round(self.achieved_rate, 2)
+        report["error_rate"] = round(self.error_rate, 4)
+        report["saturated"] = self.saturated
+        return report
+
+
+class StepRecorder:
+    """Collects the outcomes of a step and rolls them into report windows."""
+
+    def __init__(self, report: StepReport, report_every: float, started: float,
+                 run_started: float, on_window=None):
+        self.report = report
+        self.report_every = report_every
+        self.run_started = run_started
+        self.on_window = on_window
+        self.latencies = array("d")
+        self.service_times = array("d")
+        self.by_kind = defaultdict(Counter)
+        self._lock = threading.Lock()
+        self._window_started = started
+        self._window_latencies = array("d")
+        self._window_errors = 0
+
+    def record(self, kind: str, status: Optional[str], latency: float, service: float) -> None:
+        """Records one processed event, `status` None if processing raised."""
+        error = status != EXPECTED_STATUS[kind]
+        with self._lock:
+            self.report.processed += 1
+            self.report.errors += error
+            self.by_kind[kind][status or "ERROR"] += 1
+            self.latencies.append(latency)
+            self.service_times.append(service)
+            self._window_latencies.append(latency)
+            self._window_errors += error
+
+    def tick(self, now: float, queue_depth: int, force: bool = False) -> None:
+        """Closes the current window if it is `report_every` seconds old."""
+        with self._lock:
+            elapsed = now - self._window_started
+            if elapsed <= 0 or (elapsed < self.report_every and not force):
+                return
+
+            events = len(self._window_latencies)
+            db_bytes, wal_bytes = database_sizes()
+            window = {
+                "elapsed_seconds": round(now - self.run_started, 3),
+                "target_rate": self.report.target_rate,
+                "events": events,
+                "rate": round(events / elapsed, 2),
+                "error_rate": round(self._window_errors / events, 4) if events else 0.0,
+                "latency_ms": latency_summary(self._window_latencies),
+                "queue_depth": queue_depth,
+                "db_bytes": db_bytes,
+                "wal_bytes": wal_bytes,
+            }
+            self.report.windows.append(window)
+            self._window_started = now
+            self._window_latencies = array("d")
+            self._window_errors = 0
+
+        if self.on_window:
+            self.on_window(window)
+
+
+def run_step(driver, generator: EventGenerator, kiosks: int, rate: float, duration: float,
+             report_every: float = DEFAULT_REPORT_EVERY, run_started: float = None,
+             on_window=None, drain: bool = False) -> StepReport:
+    """Runs kiosks emitting `rate` events per second in total for `duration` seconds.
+
+    Events still queued at the end of the step are dropped and reported as
+    `backlog`; a growing backlog means the service is saturated.
+
+    Args:
+        driver: `InProcessDriver` or `CliDriver`
+        generator (EventGenerator): Source of the events
+        kiosks (int): Number of kiosk threads sharing the rate
+        rate (float): Target events per second, over all kiosks
+        duration (float): Step length in seconds
+        report_every (float): Seconds per report window
+        run_started (float): `time.perf_counter()` at the start of the run
+        on_window: Called with each report window as it closes
+        drain (bool): Drain the outbox before measuring the database growth,
+            when no publisher runs during the step
+
+    Returns:
+        StepReport: Throughput, latency, errors and database growth of the step
+    """
+    report = StepReport(rate, duration)
+    if drain:
+        drain_outbox()
+    used_bytes_before = used_database_bytes()
+    events = queue.Queue()
+    stop = threading.Event()
+    emitted = [0] * kiosks
+    started = time.perf_counter()
+    deadline = started + duration
+    recorder = StepRecorder(report, report_every, started,
+                            started if run_started is None else run_started, on_window)
+
+    def kiosk(index: int) -> None:
+        arrivals = random.Random(f"{generator.pool.run_id}-{rate}-{index}")
+        due = started
+        while True:
+            due += arrivals.expovariate(rate / kiosks)
+            if due >= deadline:
+                return
+            delay = due - time.perf_counter()
+            if delay > 0 and stop.wait(delay):
+                return
+            events.put((due,) + generator.next_event())
+            emitted[index] += 1
+
+    def consume() -> None:
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                return
+            try:
+                due, kind, event = events.get(timeout=min(0.1, deadline - now))
+            except queue.Empty:
+                recorder.tick(now, events.qsize())
+                continue
+
+            sent = time.perf_counter()
+            try:
+                status = driver.handle(event)["status"]
+            except Exception as e:  # pylint: disable=broad-except
+                logger.warning("Load event failed: %s", e)
+                status = None
+            done = time.perf_counter()
+            generator.processed(event)
+            recorder.record(kind, status, done - due, done - sent)
+            recorder.tick(done, events.qsize())
+
+    kiosk_threads = [threading.Thread(target=kiosk, args=(index,), name=f"kiosk-{index}",
+                                      daemon=True) for index in range(kiosks)]
+    for thread in kiosk_threads:
+        thread.start()
+
+    if driver.workers == 1:
+        consume()
+    else:
+        workers = [threading.Thread(target=consume, name=f"load-worker-{index}", daemon=True)
+                   for index in range(driver.workers)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+    stop.set()
+    for thread in kiosk_threads:
+        thread.join()
+    recorder.tick(time.perf_counter(), events.qsize(), force=True)
+
+    report.emitted = sum(emitted)
+    report.backlog = events.qsize()
+    report.latency_ms = latency_summary(recorder.latencies)
+    report.service_ms = latency_summary(recorder.service_times)
+    report.by_kind = {kind: dict(statuses) for kind, statuses in recorder.by_kind.items()}
+    if drain:
+        drain_outbox()
+    report.db_bytes, report.wal_bytes = database_sizes()
+    report.db_growth_bytes = used_database_bytes() - used_bytes_before
+    return report
+
+
+def run_load(driver, generator: EventGenerator, kiosks: int, rates: List[float],
+             step_duration: float, report_every: float = DEFAULT_REPORT_EVERY,
+             on_window=None, drain: bool = False) -> dict:
+    """Runs each target rate in turn and summarizes the throughput/latency curve.
+
+    `drain` is passed to each `run_step`.
+
+    Returns:
+        dict: Per-step reports, the first saturated rate and the highest
+            throughput sustained below it
+    """
+    run_started = time.perf_counter()
+    db_bytes, wal_bytes = database_sizes()
+    steps = []
+    for rate in rates:
+        steps.append(run_step(driver, generator, kiosks, rate, step_duration,
+                              report_every, run_started, on_window, drain))
+
+    saturated = [step for step in steps if step.saturated]
+    sustained = [step.achieved_rate for step in steps if not step.saturated]
+    end_db_bytes, end_wal_bytes = database_sizes()
+    return {
+        "run_id": generator.pool.run_id,
+        "driver": driver.name,
+        "kiosks": kiosks,
+        "elapsed_seconds": round(time.perf_counter() - run_started, 3),
+        "saturated_at_rate": saturated[0].target_rate if saturated else None,
+        "max_sustained_rate": round(max(sustained), 2) if sustained else None,
+        "db_bytes": {"start": db_bytes, "end": end_db_bytes},
+        "wal_bytes": {"start": wal_bytes, "end": end_wal_bytes},
+        "steps": [step.to_dict() for step in steps],
+    }
+
+
+def main():
+    """Runs a load test and prints the report as JSON."""
+    parser = argparse.ArgumentParser(
+        description="Simulate kiosks sending return events and report throughput and latency.")
+    parser.add_argument("--kiosks", type=int, default=10)
+    parser.add_argument("--rates", type=lambda text: [float(r) for r in text.split(",")],
+                        default=[50.0], help="target events per second, e.g. 50,100,200")
+    parser.add_argument("--step-duration", type=float, default=30.0,
+                        help="seconds to run each rate")
+    parser.add_argument("--report-every", type=float, default=DEFAULT_REPORT_EVERY,
+                        help="seconds per progress window, printed to stderr")
+    parser.add_argument("--driver", choices=("inprocess", "cli"), default="inprocess")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="concurrent processes for the cli driver")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help="event kind weights, e.g. return=0.8,invalid_qr=0.2")
+    parser.add_argument("--rentals-per-user", type=int, default=DEFAULT_RENTALS_PER_USER)
+    parser.add_argument("--users", type=int,
+                        help="users to seed (default: enough for every return)")
+    parser.add_argument("--seed", type=int, help="random seed for the event stream")
+    parser.add_argument("--publish", action="store_true",
+                        help="drain the outbox in the background, as in production")
+    parser.add_argument("--output", help="also write the report to this file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    configure_logging(verbose=args.verbose)
+
+    returns = sum(args.rates) * args.step_duration * sum(
+        weight for kind, weight in args.mix.items() if EXPECTED_STATUS[kind] == "SUCCESS"
+    ) / sum(args.mix.values())
+    users = args.users or max(1, math.ceil(1.25 * returns / args.rentals_per_user))
+    pool = seed_load_rentals(users, args.rentals_per_user)
+    print(f"Seeded {users} users with {args.rentals_per_user} rentals each "
+          f"(run {pool.run_id})", file=sys.stderr)
+
+    driver = CliDriver(args.workers) if args.driver == "cli" else InProcessDriver()
+    publisher = OutboxPublisher(NullSink()) if args.publish else None
+    if publisher:
+        publisher.start()
+
+    try:
+        with driver:
+            report = run_load(driver, EventGenerator(pool, args.mix, args.seed), args.kiosks,
+                              args.rates, args.step_duration, args.report_every,
+                              on_window=lambda window: print(json.dumps(window), file=sys.stderr),
+                              drain=not args.publish)
+    finally:
+        if publisher:
+            publisher.stop()
+        delete_load_rentals(pool)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
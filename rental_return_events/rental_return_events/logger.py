@@ -3,7 +3,6 @@ import logging
 import sys
 import functools
 import json
-from tabulate import tabulate
 
 logger = logging.getLogger("rental_return_events")
 
@@ -50,6 +49,9 @@ def infer_object_type(obj):
 
 def format_output(value):
     """Formats logging output based on data type."""
+    # Only needed in verbose mode, so kept off the import path
+    from tabulate import tabulate
+
     if isinstance(value, dict):
         return json.dumps(value, indent=4)
 
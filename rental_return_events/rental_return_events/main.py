@@ -1,39 +1,37 @@
 """Main module to process a rental return event from a JSON file."""
 import json
-from pathlib import Path
 import sys
 import os
-import sqlite3
+
+from topanga_queries import get_db_path
+from topanga_queries.migrations import SchemaOutdatedError, check_schema_version
 
 from rental_return_events.logger import configure_logging
 from rental_return_events.processor import process_rental_return
-
-PACKAGE_ROOT = Path(__file__).resolve().parents[1]
-DB_PATH = PACKAGE_ROOT / "challenge.db"
+from rental_return_events.profiler import get_profile_mode, profile_run
 
 
 def check_database():
-    """Ensure the database exists and contains the required tables."""
-    if not DB_PATH.exists():
-        print(f"Error! challege.db not found at: {DB_PATH}")
+    """Ensure the database exists and has the current schema."""
+    db_path = get_db_path()
+    if not os.path.exists(db_path):
+        print(f"Error! challenge.db not found at: {os.path.abspath(db_path)}")
         print("Initialize with: python -m topanga_queries.bootstrap.db")
         sys.exit(1)
 
-    # Check for the required tables: users, assets, rentals
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = {row[0] for row in cursor.fetchall()}
-
-        required_tables = {"users", "assets", "rentals"}
-
-        if not required_tables.issubset(tables):
-            print(
-                f"Error: Database at {DB_PATH} is missing required tables: {
-                    required_tables - tables}")
-            print("Initialize with: python -m topanga_queries.bootstrap.db")
-            sys.exit(1)
+    # Checks the schema version through the shared connection, cached for
+    # the life of the process
+    try:
+        check_schema_version()
+    except SchemaOutdatedError as e:
+        # Bootstrapping would delete the records, migrating keeps them
+        print(f"Error: Database at {os.path.abspath(db_path)} - {str(e)}")
+        print("Migrate with: migrate-db (or python -m topanga_queries.scripts.migrate_db)")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"Error: Database at {os.path.abspath(db_path)} - {str(e)}")
+        print("Initialize with: python -m topanga_queries.bootstrap.db")
+        sys.exit(1)
 
 
 def load_json_file(file_path):
@@ -66,20 +64,40 @@ def main():
     check_database()  # Ensure the database exists and is valid
 
     if len(sys.argv) < 2:
-        print("Usage: python main.py <event_file.json> [--verbose]")
+        print("Usage: python main.py <event_file.json> [--verbose] "
+              "[--profile[=sample|cprofile]]")
         sys.exit(1)
 
     # Check for optional --verbose flag
     verbose_mode = "--verbose" in sys.argv
 
+    # Check for optional --profile flag, which defaults to sampling
+    profile_mode = None
+    for arg in sys.argv[2:]:
+        if arg == "--profile":
+            profile_mode = "sample"
+        elif arg.startswith("--profile="):
+            profile_mode = arg.split("=", 1)[1]
+
+    try:
+        profile_mode = get_profile_mode(profile_mode)
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+
     # Configure logging based on verbose mode
     configure_logging(verbose=verbose_mode)
 
+    # A single run has no publisher to drain the outbox, so responses are only
+    # written there when TOPANGA_OUTBOX=on is set, see `topanga_queries.outbox`
+    os.environ.setdefault("TOPANGA_OUTBOX", "off")
+
     json_file = sys.argv[1]  # read the json return event file
 
     try:
         payload = load_json_file(json_file)
-        response = process_rental_return(payload)
+        with profile_run("main", profile_mode):
+            response = process_rental_return(payload)
         print(json.dumps(response, indent=4))  # Print structured JSON response
 
     except FileNotFoundError:
@@ -0,0 +1,62 @@
+"""In-process metrics for the rental return events package.
+
+Counters, gauges and timers are kept in a process-wide registry that callers
+can snapshot, e.g. at the end of a batch or from a monitoring hook, and ship
+to whatever backend the deployment uses.
+"""
+import threading
+from collections import defaultdict
+
+
+class Metrics:
+    """Thread-safe registry of counters, gauges and timers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._gauges = {}
+        self._timers = {}
+
+    def increment(self, name: str, value: int = 1) -> None:
+        """Adds `value` to the counter `name`."""
+        with self._lock:
+            self._counters[name] += value
+
+    def gauge(self, name: str, value: float) -> None:
+        """Sets the gauge `name` to its current `value`."""
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, seconds: float) -> None:
+        """Records a duration, in seconds, for the timer `name`."""
+        with self._lock:
+            count, total, maximum = self._timers.get(name, (0, 0.0, 0.0))
+            self._timers[name] = (count + 1, total + seconds, max(maximum, seconds))
+
+    def snapshot(self) -> dict:
+        """Returns the current counters and timers.
+
+        Returns:
+            dict: {"counters": {name: value},
+                   "gauges": {name: value},
+                   "timers": {name: {"count", "total_seconds", "max_seconds"}}}
+        """
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "timers": {
+                    name: {"count": count, "total_seconds": total, "max_seconds": maximum}
+                    for name, (count, total, maximum) in self._timers.items()
+                },
+            }
+
+    def reset(self) -> None:
+        """Clears all counters, gauges and timers."""
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._timers.clear()
+
+
+metrics = Metrics()
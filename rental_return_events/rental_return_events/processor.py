@@ -1,14 +1,29 @@
 """Rental Return Processor"""
 import json
-from typing import List, Optional
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterable, List, Optional
 from datetime import datetime
 
-from topanga_queries.rentals import Rental, complete_rental, get_rental, list_rentals_for_user
+from topanga_queries import get_connection
+from topanga_queries.rentals import (Rental, complete_rental,
+    find_oldest_eligible_rental, list_active_rentals_for_user,
+    list_in_progress_rentals_for_user, to_epoch_ms)
 from topanga_queries.assets import Asset, get_asset
+from topanga_queries.membership import may_exist
+from topanga_queries.migrations import migration_complete
+from topanga_queries.outbox import enqueue_message, get_failure_outbox_mode, get_outbox_mode
 
-from rental_return_events.handler import parse_return_event, ReturnEvent
-from rental_return_events.response import create_failure_response, create_success_response
-from rental_return_events.logger import log_function_calls
+from rental_return_events.handler import InvalidQRCodeError, parse_return_event, ReturnEvent
+from rental_return_events.response import (ErrorCode, create_failure_response,
+    create_success_response, serialize_response)
+from rental_return_events.logger import log_function_calls, logger
+from rental_return_events.metrics import metrics
+from rental_return_events.retry import RetryPolicy, call_with_retry, is_transient_db_error
+
+
+class AssetNotFoundError(LookupError):
+    """Raised when a returned asset does not exist."""
 
 # ====================================================
 # Rental Eligibility Helpers
@@ -38,33 +53,130 @@ def rental_is_non_expired(rental: Rental, timestamp: datetime) -> bool:
     Returns:
         bool: True if the rental is not expired
     """
+    if rental.expires_at_ms is not None:
+        return rental.expires_at_ms > to_epoch_ms(timestamp)
     return not rental.expires_at or datetime.fromisoformat(
         rental.expires_at) > timestamp
 
 
+def rental_created_at_ms(rental: Rental) -> int:
+    """Returns the rental creation time in epoch milliseconds
+
+    Args:
+        rental (Rental): Rental object
+
+    Returns:
+        int: Creation time, parsed from the ISO column if not loaded from the DB
+    """
+    if rental.created_at_ms is not None:
+        return rental.created_at_ms
+    return to_epoch_ms(datetime.fromisoformat(rental.created_at))
+
+
+def rejected_by_membership(table: str, id: str) -> bool:
+    """Returns True if the id is known not to exist, without a database query
+
+    Args:
+        table (str): 'users' or 'assets'
+        id (str): User or asset ID
+
+    Returns:
+        bool: True if no row in `table` has this id, see `topanga_queries.membership`
+    """
+    if may_exist(table, id):
+        return False
+    metrics.increment(f"membership.{table}.rejected")
+    return True
+
+
 def fetch_valid_asset(asset_id: str) -> Optional[Asset]:
     """Fetches a valid asset from the database
 
+    Unknown assets are rejected by the in-memory membership filter first.
+
     Args:
         asset_id (str): Asset ID
 
+    Raises:
+        AssetNotFoundError: If the asset does not exist
+
     Returns:
-        Optional[Asset]: Asset object if found, None otherwise
+        Optional[Asset]: Asset object
     """
+    if rejected_by_membership("assets", asset_id):
+        raise AssetNotFoundError(f"Asset not found: {asset_id}")
     try:
         return get_asset(asset_id)
 
     except (ValueError, TypeError) as e:
-        raise LookupError(f"Asset not found: {asset_id}") from e
+        raise AssetNotFoundError(f"Asset not found: {asset_id}") from e
 
 # ====================================================
 # Find Eligible Rental
 # ====================================================
 
 
+def rentals_backfilled() -> bool:
+    """Returns True once eligible rentals can be filtered and ordered in SQL
+
+    Migration backfills run online. Until the `eligibility_groups`
+    migration, which follows `epoch_timestamps`, is recorded, some rentals
+    may still have NULL epoch columns or `eligible_group_id`, and the SQL
+    filters would skip them.
+
+    Returns:
+        bool: True if the epoch and group columns are filled for every rental
+    """
+    return migration_complete("eligibility_groups")
+
+
+def scan_eligible_rentals(
+        user_id: str, as_of: datetime, asset_type: Optional[str] = None) -> List[Rental]:
+    """Returns eligible rentals, filtered here from the ISO and JSON columns
+
+    Used instead of the SQL filters while a backfill is running, see
+    `rentals_backfilled`.
+
+    Args:
+        user_id (str): User ID
+        as_of (datetime): Rentals expiring at or before this time are excluded
+        asset_type (Optional[str]): Only return rentals accepting this asset type
+
+    Returns:
+        List[Rental]: Eligible rentals, oldest first
+    """
+    rentals = [
+        rental for rental in list_in_progress_rentals_for_user(user_id)
+        if rental_is_non_expired(rental, as_of)
+        and (asset_type is None or rental_is_of_asset_type(asset_type, rental))
+    ]
+    return sorted(rentals, key=rental_created_at_ms)
+
+
+def eligible_rentals_for_user(
+        user_id: str, as_of: datetime, asset_type: Optional[str] = None) -> List[Rental]:
+    """Returns a user's unexpired IN_PROGRESS rentals, oldest first
+
+    Args:
+        user_id (str): User ID
+        as_of (datetime): Rentals expiring at or before this time are excluded
+        asset_type (Optional[str]): Only return rentals accepting this asset type
+
+    Returns:
+        List[Rental]: Eligible rentals, oldest first
+    """
+    if rentals_backfilled():
+        return list_active_rentals_for_user(user_id, as_of, asset_type)
+    return scan_eligible_rentals(user_id, as_of, asset_type)
+
+
 def active_eligible_rentals(return_event: ReturnEvent) -> List[Rental]:
     """Returns rentals that are in progress, eligible, and not expired.
 
+    Not used on the return path, which only reads the oldest eligible
+    rental, see `oldest_eligible_rental`. Kept for tests and tools that
+    want the full list.
+
     Args:
         return_event (ReturnEvent): Return event object
 
@@ -72,86 +184,196 @@ def active_eligible_rentals(return_event: ReturnEvent) -> List[Rental]:
         List[Rental]: List of eligible rentals
     """
     try:
-        rentals = list_rentals_for_user(return_event.user_id)
         asset = fetch_valid_asset(return_event.asset_id)
+        if rejected_by_membership("users", return_event.user_id):
+            return []
 
-        return [
-            rental for rental in rentals
-            if rental.status == "IN_PROGRESS"
-            and rental_is_of_asset_type(asset.asset_type, rental)
-            and rental_is_non_expired(rental, return_event.timestamp)
-        ]
+        return eligible_rentals_for_user(
+            return_event.user_id, return_event.timestamp, asset.asset_type)
 
-    except LookupError:
+    except AssetNotFoundError:
         return []
 
 
 @log_function_calls
-def find_oldest_rental_from(rentals: List[Rental]) -> Optional[Rental]:
+def oldest_eligible_rental(return_event: ReturnEvent) -> Optional[Rental]:
+    """Finds the oldest rental in progress, eligible, and not expired.
+
+    Equivalent to `find_oldest_rental_from(active_eligible_rentals(...))`,
+    but the database returns the single matching row once the migrations
+    are backfilled, see `rentals_backfilled`.
+
+    Args:
+        return_event (ReturnEvent): Return event object
+
+    Raises:
+        AssetNotFoundError: If the returned asset does not exist
+
+    Returns:
+        Optional[Rental]: Oldest eligible rental if found, None otherwise
+    """
+    asset = fetch_valid_asset(return_event.asset_id)
+    if rejected_by_membership("users", return_event.user_id):
+        return None
+
+    if not rentals_backfilled():
+        return find_oldest_rental_from(scan_eligible_rentals(
+            return_event.user_id, return_event.timestamp, asset.asset_type))
+
+    return find_oldest_eligible_rental(
+        return_event.user_id, asset.asset_type, return_event.timestamp)
+
+
+@log_function_calls
+def find_oldest_rental_from(rentals: Iterable[Rental]) -> Optional[Rental]:
     """Finds the oldest rental
 
+    Takes any iterable, such as `iter_rentals_for_user`, in a single pass
+    without building a list.
+
     Args:
-        rentals (List[Rental]): List of rentals
+        rentals (Iterable[Rental]): Rentals to pick from
 
     Returns:
         Optional[Rental]: Oldest rental if found, None otherwise
     """
-    try:
-        return min(rentals, key=lambda r: datetime.fromisoformat(r.created_at))
-    except ValueError:  # min() raises ValueError on an empty list
-        return None
+    return min(rentals, key=rental_created_at_ms, default=None)
 
 # ====================================================
 # Process Eligible Rental
 # ====================================================
 
+# Outbox topics for the downstream success and failure queues
+RESPONSE_TOPICS = {
+    "SUCCESS": "rental_returns.success",
+    "FAILED": "rental_returns.failure",
+}
+
+# Called with each response committed by `publish_response`, see `before_commit`
+_before_commit: ContextVar[Optional[Callable[[dict], None]]] = ContextVar(
+    "before_commit", default=None)
+
+
+@contextmanager
+def before_commit(hook: Callable[[dict], None]):
+    """Runs `hook(response)` in the transaction of each response committed in the block
+
+    Lets a caller record its own progress atomically with the rental update,
+    e.g. the replay checkpoint, see `replay.py`. The hook must not commit. It
+    runs again if the transaction is rolled back and retried. Responses
+    whose event wrote nothing, or that are not committed, never reach it.
+
+    Args:
+        hook (Callable[[dict], None]): Called with the response before the commit
+    """
+    token = _before_commit.set(hook)
+    try:
+        yield
+    finally:
+        _before_commit.reset(token)
+
 
 @log_function_calls
 def finalize_rental_return(
-        rental: Rental, return_event: ReturnEvent) -> Rental:
+        rental: Rental, return_event: ReturnEvent, commit: bool = True) -> Optional[Rental]:
     """Finalizes the rental return
 
     Args:
         rental (Rental): Rental object
         return_event (ReturnEvent): Return event object
+        commit (bool): Commit the update, False leaves the transaction open
 
     Returns:
-        Rental: Updated rental object
+        Optional[Rental]: Updated rental object, None if another worker
+            completed the rental first
     """
-    complete_rental(
+    return complete_rental(
         id=rental.id,
         status="COMPLETED",
         returned_at=return_event.timestamp.isoformat(),
-        returned_at_location_id=return_event.location_id
+        returned_at_location_id=return_event.location_id,
+        commit=commit
     )
 
-    return get_rental(rental.id)
+
+def publish_response(response: dict, commit: bool = True) -> dict:
+    """Writes a response to the outbox and commits
+
+    Any rental update made in the open transaction is committed with it, so
+    a response is published if and only if its update is. With
+    `TOPANGA_OUTBOX=off`, or for a failure unless
+    `TOPANGA_OUTBOX_FAILURES=on`, only the open transaction is committed,
+    and an event that wrote nothing costs no commit.
+
+    Args:
+        response (dict): Rental return response
+        commit (bool): Commit, False leaves the transaction open
+
+    Raises:
+        ValueError: If `TOPANGA_OUTBOX` or `TOPANGA_OUTBOX_FAILURES` is invalid
+
+    Returns:
+        dict: The same response
+    """
+    publish = get_outbox_mode() == "on" and (
+        response["status"] != "FAILED" or get_failure_outbox_mode() == "on")
+    connection = get_connection()
+
+    hook = _before_commit.get()
+    if commit and hook and (publish or connection.in_transaction):
+        hook(response)
+
+    if publish:
+        enqueue_message(RESPONSE_TOPICS[response["status"]], serialize_response(response),
+                        commit=commit)
+    elif commit:
+        connection.commit()  # Nothing to do outside a transaction
+    return response
 
 
 def complete_rental_return(return_event: ReturnEvent) -> dict:
     """Completes the oldest eligible rental for the user
 
+    If another worker completes the selected rental first, the next oldest
+    eligible rental is selected instead. Each conflict means one fewer
+    rental is in progress, so the loop always ends. The response is written
+    to the outbox in the same transaction as the rental update.
+
     Args:
         return_event (ReturnEvent): Return event object
 
     Returns:
         dict: Rental return response
     """
-    rental = find_oldest_rental_from(active_eligible_rentals(return_event))
+    while True:
+        try:
+            rental = oldest_eligible_rental(return_event)
+        except AssetNotFoundError:
+            return publish_response(create_failure_response(
+                f"Asset not found: {return_event.asset_id}", ErrorCode.ASSET_NOT_FOUND))
+
+        if not rental:
+            return publish_response(create_failure_response(
+                f"No active rentals found for user {return_event.user_id}"))
 
-    if not rental:
-        return create_failure_response(
-            f"No active rentals found for user {return_event.user_id}")
+        completed = finalize_rental_return(rental, return_event, commit=False)
+        if completed:
+            return publish_response(create_success_response(completed))
 
-    return create_success_response(
-        finalize_rental_return(rental, return_event))
+        metrics.increment("rentals.completion_conflicts")
 
 
-def process_rental_return(event: dict) -> dict:
+def process_rental_return(event: dict, retry_policy: RetryPolicy = None) -> dict:
     """Processe rental return events
 
+    The read-modify-write of the oldest eligible rental is retried on
+    transient database lock errors, see `retry.call_with_retry`. With SQL
+    tracing on, the statements it runs are counted as one event, see
+    `topanga_queries.tracing.trace_event`.
+
     Args:
         event (dict): JSON event data
+        retry_policy (RetryPolicy): Retry settings, defaults to `RetryPolicy.from_env()`
 
     Raises:
         ValueError: If the event data is invalid
@@ -159,21 +381,152 @@ def process_rental_return(event: dict) -> dict:
     Returns:
         dict: Rental return response
     """
+    from topanga_queries.tracing import trace_event  # Loaded once a connection is open
+
+    with trace_event():
+        return _process_rental_return(event, retry_policy)
+
+
+def _process_rental_return(event: dict, retry_policy: RetryPolicy = None) -> dict:
     try:
         return_event = parse_return_event(event)
-        return complete_rental_return(return_event)
+        return call_with_retry(complete_rental_return, return_event, policy=retry_policy)
 
     except json.JSONDecodeError as e:
-        return create_failure_response(f"JSON parsing error: {str(e)}")
+        response = create_failure_response(
+            f"JSON parsing error: {str(e)}", ErrorCode.INVALID_JSON)
+
+    except InvalidQRCodeError as e:
+        response = create_failure_response(
+            f"Invalid return event: {str(e)}", ErrorCode.INVALID_QR_CODE)
 
     except ValueError as e:
-        return create_failure_response(f"Invalid return event: {str(e)}")
+        response = create_failure_response(
+            f"Invalid return event: {str(e)}", ErrorCode.INVALID_EVENT)
 
     except KeyError as e:
-        return create_failure_response(f"Missing required key: {str(e)}")
+        response = create_failure_response(
+            f"Missing required key: {str(e)}", ErrorCode.MISSING_FIELD)
 
     except TypeError as e:
-        return create_failure_response(f"Unexpected data type: {str(e)}")
+        response = create_failure_response(
+            f"Unexpected data type: {str(e)}", ErrorCode.INVALID_TYPE)
 
     except OSError as e:
-        return create_failure_response(f"File system error: {str(e)}")
+        response = create_failure_response(
+            f"File system error: {str(e)}", ErrorCode.FILE_SYSTEM_ERROR)
+
+    except Exception as e:  # pylint: disable=broad-except
+        if not is_transient_db_error(e):
+            raise
+        response = create_failure_response(
+            f"Database busy, retries exhausted: {str(e)}", ErrorCode.DATABASE_BUSY)
+
+    return publish_failure_response(response)
+
+
+def publish_failure_response(response: dict) -> dict:
+    """Publishes a failure response, still returning it if the outbox is locked
+
+    Makes a single attempt. A failure is often published because the
+    database stayed locked past the retry deadline, and a second round of
+    retries would hold the event up for as long again.
+
+    Args:
+        response (dict): Failure response
+
+    Returns:
+        dict: The same response
+    """
+    try:
+        return publish_response(response)
+    except Exception as e:  # pylint: disable=broad-except
+        get_connection().rollback()
+        if not is_transient_db_error(e):
+            raise
+        logger.warning("Failed to publish failure response: %s", e)
+        metrics.increment("outbox.enqueue_failed")
+        return response
+
+# ====================================================
+# Process Coalesced Returns
+# A burst of returns from one user at one kiosk is resolved in a single
+# transaction, see `coalescer.py`
+# ====================================================
+
+
+def complete_rental_returns(return_events: List[ReturnEvent]) -> List[dict]:
+    """Completes a burst of returns from one user in a single transaction
+
+    Rentals are assigned in event order, exactly as calling
+    `complete_rental_return` for each event in turn would: each event gets
+    the oldest rental eligible for its asset and timestamp that an earlier
+    event did not take. The user's rentals are read once, and every update
+    and response is committed together.
+
+    Args:
+        return_events (List[ReturnEvent]): Return events of one user, in order
+
+    Returns:
+        List[dict]: Rental return response per event
+    """
+    user_id = return_events[0].user_id
+    if rejected_by_membership("users", user_id):
+        rentals = []
+    else:
+        rentals = eligible_rentals_for_user(
+            user_id, min(return_event.timestamp for return_event in return_events))
+
+    assets, taken, responses = {}, set(), []
+    for return_event in return_events:
+        try:
+            if return_event.asset_id not in assets:
+                assets[return_event.asset_id] = fetch_valid_asset(return_event.asset_id)
+            asset = assets[return_event.asset_id]
+        except AssetNotFoundError:
+            responses.append(publish_response(create_failure_response(
+                f"Asset not found: {return_event.asset_id}", ErrorCode.ASSET_NOT_FOUND),
+                commit=False))
+            continue
+
+        response = None
+        for rental in rentals:
+            if rental.id in taken or not rental_is_non_expired(rental, return_event.timestamp) \
+                    or not rental_is_of_asset_type(asset.asset_type, rental):
+                continue
+            taken.add(rental.id)
+            completed = finalize_rental_return(rental, return_event, commit=False)
+            if completed:
+                response = create_success_response(completed)
+                break
+            metrics.increment("rentals.completion_conflicts")
+
+        responses.append(publish_response(response or create_failure_response(
+            f"No active rentals found for user {user_id}"), commit=False))
+
+    get_connection().commit()
+    return responses
+
+
+def process_rental_returns(return_events: List[ReturnEvent],
+                           retry_policy: RetryPolicy = None) -> List[dict]:
+    """Processes a burst of parsed return events from one user
+
+    The whole burst is retried on transient database lock errors.
+
+    Args:
+        return_events (List[ReturnEvent]): Return events of one user, in order
+        retry_policy (RetryPolicy): Retry settings, defaults to `RetryPolicy.from_env()`
+
+    Returns:
+        List[dict]: Rental return response per event
+    """
+    try:
+        return call_with_retry(complete_rental_returns, return_events, policy=retry_policy)
+
+    except Exception as e:  # pylint: disable=broad-except
+        if not is_transient_db_error(e):
+            raise
+        return [publish_failure_response(create_failure_response(
+            f"Database busy, retries exhausted: {str(e)}", ErrorCode.DATABASE_BUSY))
+            for _ in return_events]
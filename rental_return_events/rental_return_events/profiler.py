@@ -0,0 +1,212 @@
+"""
+Opt-in profiling of the rental return pipeline.
+
+Profiling is enabled per run, with `--profile` on the command line or the
+`TOPANGA_PROFILE` environment variable:
+    sample   - a background thread samples the processing thread's stack
+               `TOPANGA_PROFILE_RATE` times per second (default 200) and
+               writes the samples in collapsed-stack format, ready for
+               flamegraph.pl or speedscope
+    cprofile - the run is wrapped in cProfile and written as a .pstats file
+
+Each profiled run also writes a JSON summary attributing time to the
+pipeline phases in `PHASES`. Output goes to `TOPANGA_PROFILE_DIR` (default
+`profiles/`). When profiling is off `profile_run` does nothing at all, and
+nothing on the per-event path checks for it.
+"""
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+PROFILE_MODES = ("sample", "cprofile")
+DEFAULT_SAMPLE_RATE = 200
+DEFAULT_PROFILE_DIR = "profiles"
+
+# Pipeline phase of each function. A sample counts towards the phase of its
+# innermost listed frame, so a query run while selecting a rental is DB read.
+PHASES = {
+    ("rental_return_events.handler", "parse_return_event"): "parse",
+    ("rental_return_events.processor", "oldest_eligible_rental"): "selection",
+    ("rental_return_events.processor", "active_eligible_rentals"): "selection",
+    ("rental_return_events.processor", "find_oldest_rental_from"): "selection",
+    ("topanga_queries.assets", "get_asset"): "db_read",
+    ("topanga_queries.users", "get_user"): "db_read",
+    ("topanga_queries.rentals", "get_rental"): "db_read",
+    ("topanga_queries.rentals", "find_oldest_eligible_rental"): "db_read",
+    ("topanga_queries.rentals", "list_active_rentals_for_user"): "db_read",
+    ("topanga_queries.rentals", "complete_rental"): "db_write",
+    ("topanga_queries.outbox", "enqueue_message"): "db_write",
+    ("rental_return_events.response", "create_success_response"): "serialization",
+    ("rental_return_events.response", "create_failure_response"): "serialization",
+    ("json", "dumps"): "serialization",
+}
+
+
+def get_profile_mode(mode: Optional[str] = None) -> Optional[str]:
+    """Profiling mode from the argument or `TOPANGA_PROFILE`, None if off.
+
+    Raises:
+        ValueError: If the mode is not one of `PROFILE_MODES`
+    """
+    mode = mode or os.getenv("TOPANGA_PROFILE") or None
+    if mode is not None and mode not in PROFILE_MODES:
+        raise ValueError(f"Invalid profile mode: {mode}")
+    return mode
+
+
+def _frame_key(frame) -> tuple:
+    return frame.f_globals.get("__name__", "?"), frame.f_code.co_name
+
+
+class SamplingProfiler:
+    """Samples the call stack of one thread from a background thread."""
+
+    def __init__(self, rate: float = DEFAULT_SAMPLE_RATE, thread_id: int = None):
+        self.interval = 1 / rate
+        self.thread_id = thread_id or threading.get_ident()
+        self.stacks = Counter()
+        self.phases = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self) -> None:
+        frame = sys._current_frames().get(self.thread_id)  # pylint: disable=protected-access
+        keys = []
+        while frame is not None:
+            keys.append(_frame_key(frame))
+            frame = frame.f_back
+        if not keys:
+            return
+
+        # `keys` runs from the innermost frame outwards
+        self.phases[next((PHASES[key] for key in keys if key in PHASES), "other")] += 1
+        self.stacks[";".join(f"{module}:{name}" for module, name in reversed(keys))] += 1
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self) -> None:
+        """Starts sampling."""
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops sampling."""
+        self._stop.set()
+        self._thread.join()
+
+    def write_collapsed(self, path: str) -> None:
+        """Writes one `frame;frame;frame count` line per distinct stack."""
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def cprofile_phases(stats: pstats.Stats) -> Dict[str, float]:
+    """Attributes cProfile time, in seconds, to pipeline phases.
+
+    A phase gets the cumulative time of its functions, less the time spent
+    in other phase functions they call directly.
+    """
+    phase_files = {}
+    for (module, function), phase in PHASES.items():
+        module_file = getattr(sys.modules.get(module), "__file__", None)
+        if module_file:
+            phase_files[(os.path.abspath(module_file), function)] = phase
+
+    phase_of = {}
+    for func in stats.stats:
+        filename, _, function = func
+        phase = phase_files.get((os.path.abspath(filename), function))
+        if phase:
+            phase_of[func] = phase
+
+    phases = Counter()
+    for func, phase in phase_of.items():
+        cumulative, callers = stats.stats[func][3], stats.stats[func][4]
+        phases[phase] += cumulative
+        for caller, caller_stats in callers.items():
+            if caller in phase_of:
+                phases[phase_of[caller]] -= caller_stats[3]
+    return dict(phases)
+
+
+def _write_summary(path: str, name: str, mode: str, elapsed: float,
+                   phases: Dict[str, float], samples: int = None) -> dict:
+    phases = {phase: max(seconds, 0.0) for phase, seconds in phases.items()}
+    phases["other"] = phases.get("other", 0.0) + max(elapsed - sum(phases.values()), 0.0)
+    summary = {
+        "run": name,
+        "mode": mode,
+        "elapsed_seconds": round(elapsed, 6),
+        "samples": samples,
+        "phases": {
+            phase: {"seconds": round(seconds, 6),
+                    "share": round(seconds / elapsed, 4) if elapsed else 0.0}
+            for phase, seconds in sorted(phases.items(), key=lambda item: -item[1])
+        },
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=4)
+    return summary
+
+
+@contextmanager
+def profile_run(name: str, mode: Optional[str] = None, output_dir: str = None):
+    """Profiles the enclosed block when profiling is enabled.
+
+    Args:
+        name (str): Run name, used in the output file names
+        mode (Optional[str]): 'sample' or 'cprofile', defaults to `TOPANGA_PROFILE`
+        output_dir (str): Output directory, defaults to `TOPANGA_PROFILE_DIR`
+
+    Yields:
+        Optional[str]: Output path prefix, None when profiling is off
+    """
+    mode = get_profile_mode(mode)
+    if mode is None:
+        yield None
+        return
+
+    output_dir = output_dir or os.getenv("TOPANGA_PROFILE_DIR", DEFAULT_PROFILE_DIR)
+    os.makedirs(output_dir, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    prefix = os.path.join(output_dir, f"{name}-{stamp}")
+
+    if mode == "sample":
+        profiler = SamplingProfiler(
+            float(os.getenv("TOPANGA_PROFILE_RATE", DEFAULT_SAMPLE_RATE)))
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    started = time.perf_counter()
+    try:
+        yield prefix
+    finally:
+        elapsed = time.perf_counter() - started
+        if mode == "sample":
+            profiler.stop()
+            profiler.write_collapsed(f"{prefix}.collapsed")
+            samples = sum(profiler.phases.values())
+            # Each sample stands for an equal share of the run
+            phases = {phase: elapsed * count / samples
+                      for phase, count in profiler.phases.items()} if samples else {}
+            _write_summary(f"{prefix}.summary.json", name, mode, elapsed, phases, samples)
+        else:
+            profiler.disable()
+            profiler.dump_stats(f"{prefix}.pstats")
+            _write_summary(f"{prefix}.summary.json", name, mode, elapsed,
+                           cprofile_phases(pstats.Stats(profiler)))
+        # stderr, so profiling never corrupts JSON printed to stdout
+        print(f"Profile written to {prefix}.*", file=sys.stderr)
@@ -0,0 +1,210 @@
+"""
+Publishes return results from the outbox to downstream queues.
+
+`process_rental_return` writes every response to the `outbox` table in the
+same transaction as the rental update. `OutboxPublisher` drains the table in
+batches from a background thread with its own database connection and hands
+each batch to a sink, so no network call sits on the return path.
+
+Delivery is at-least-once: a batch is deleted from the outbox only after the
+sink accepted it, so a crash in between publishes that batch again. Consumers
+should de-duplicate on the message `id`.
+
+Usage:
+    python -m rental_return_events.publisher <output.ndjson> [--once] [--verbose]
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from typing import List
+
+from topanga_queries import connect
+from topanga_queries.outbox import (OutboxMessage, delete_outbox_messages,
+    fetch_outbox_batch, outbox_backlog)
+
+from rental_return_events.logger import configure_logging, logger
+from rental_return_events.metrics import metrics
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_POLL_INTERVAL = 1.0
+
+
+# ====================================================
+# Sinks
+# A sink takes a batch of messages in `publish` and raises if any of them
+# could not be delivered. SNS/SQS clients plug in here.
+# ====================================================
+class MemorySink:
+    """Keeps published messages in a list, a stand-in queue for tests."""
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, messages: List[OutboxMessage]) -> None:
+        """Appends the batch to `messages`."""
+        self.messages.extend(messages)
+
+
+class NullSink:
+    """Counts and discards published messages, for load tests."""
+
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, messages: List[OutboxMessage]) -> None:
+        """Counts the batch."""
+        self.published += len(messages)
+
+
+class FileSink:
+    """Appends published messages to an NDJSON file."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def publish(self, messages: List[OutboxMessage]) -> None:
+        """Appends the batch and syncs it to disk before returning."""
+        with open(self.path, "a", encoding="utf-8") as f:
+            for message in messages:
+                f.write(json.dumps({
+                    "id": message.id,
+                    "topic": message.topic,
+                    "payload": message.payload,
+                }) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+# ====================================================
+# Publisher
+# ====================================================
+class OutboxPublisher:
+    """Drains the outbox into a sink in batches."""
+
+    def __init__(self, sink, batch_size: int = DEFAULT_BATCH_SIZE,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL, db_path: str = None):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.db_path = db_path
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _connect(self):
+        if self.db_path is None:
+            return connect()
+
+        import sqlite3  # Deferred so importing the package stays cheap
+
+        return sqlite3.connect(self.db_path)
+
+    def publish_batch(self, connection) -> int:
+        """Publishes the oldest batch of messages.
+
+        Args:
+            connection: Connection to the database holding the outbox
+
+        Raises:
+            Exception: Whatever the sink raised, the batch stays in the outbox
+
+        Returns:
+            int: Number of messages published
+        """
+        messages = fetch_outbox_batch(connection, self.batch_size)
+        if not messages:
+            return 0
+
+        started = time.monotonic()
+        self.sink.publish(messages)
+        delete_outbox_messages([message.id for message in messages], connection)
+
+        now_ms = time.time() * 1000
+        for message in messages:
+            metrics.observe("outbox.lag", max(0.0, now_ms - message.created_at_ms) / 1000)
+        metrics.observe("outbox.publish_batch", time.monotonic() - started)
+        metrics.increment("outbox.published", len(messages))
+        return len(messages)
+
+    def drain(self, connection=None) -> int:
+        """Publishes batches until the outbox is empty.
+
+        Returns:
+            int: Number of messages published
+        """
+        if connection is None:
+            connection = self._connect()
+            try:
+                return self.drain(connection)
+            finally:
+                connection.close()
+
+        published = 0
+        while not self._stop.is_set():
+            count = self.publish_batch(connection)
+            published += count
+            if count < self.batch_size:
+                break
+        return published
+
+    def run(self) -> None:
+        """Drains the outbox every `poll_interval` seconds until stopped."""
+        connection = self._connect()
+        try:
+            while not self._stop.is_set():
+                try:
+                    self.drain(connection)
+                except Exception as e:  # pylint: disable=broad-except
+                    connection.rollback()
+                    metrics.increment("outbox.publish_errors")
+                    logger.warning("Outbox publish failed, will retry: %s", e)
+
+                pending, oldest_age = outbox_backlog(connection)
+                metrics.observe("outbox.backlog_age", oldest_age or 0.0)
+                logger.debug("Outbox backlog: %d messages", pending)
+                self._stop.wait(self.poll_interval)
+        finally:
+            connection.close()
+
+    def start(self) -> None:
+        """Runs the publisher in a daemon thread."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="outbox-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None) -> None:
+        """Stops the background thread after its current batch."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+def main():
+    """Publishes the outbox to an NDJSON file."""
+    parser = argparse.ArgumentParser(
+        description="Publish return results from the outbox.")
+    parser.add_argument("output", help="NDJSON file to append messages to")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL)
+    parser.add_argument("--once", action="store_true",
+                        help="drain the outbox once and exit")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    configure_logging(verbose=args.verbose)
+
+    publisher = OutboxPublisher(FileSink(args.output), args.batch_size, args.poll_interval)
+    if args.once:
+        print(f"Published {publisher.drain()} messages")
+        return
+
+    try:
+        publisher.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+"""
+Replays NDJSON event archives through the rental return processor.
+
+Progress is checkpointed per archive path and byte range in the
+`replay_checkpoints` table of the database being replayed into. Returns are
+not idempotent, a replayed return completes the next oldest rental, so the
+checkpoint of an event that writes to the database is saved in the same
+transaction as its rental update and response. An interrupted replay
+resumes after the last committed event and never applies one twice.
+
+Lines that fail to parse and events that produce a FAILED response are
+appended to a dead-letter NDJSON file with the reason attached. The
+checkpoint records the size of the file, and entries written after it are
+truncated on resume, so each rejected event is dead-lettered once. A
+dead-letter file must therefore belong to a single byte range.
+
+Usage:
+    python -m rental_return_events.replay <archive.ndjson> [--shard I/N]
+        [--profile sample|cprofile] [--verbose]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from dataclasses import dataclass, asdict
+from datetime import datetime, timezone
+from typing import Optional
+
+from topanga_queries import get_connection
+
+from rental_return_events.archive import ArchiveReader, ArchiveRecord
+from rental_return_events.logger import configure_logging, logger
+from rental_return_events.processor import before_commit, process_rental_return
+from rental_return_events.profiler import PROFILE_MODES, profile_run
+
+# Events that write nothing between checkpoints, e.g. lines that fail to parse
+DEFAULT_CHECKPOINT_EVERY = 1000
+
+
+@dataclass
+class ReplayStats:
+    """Summary of a replay run"""
+    archive: str
+    start_offset: int
+    end_offset: int
+    resumed_from: int
+    offset: int = 0
+    processed: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    elapsed_seconds: float = 0.0
+
+    @property
+    def events_per_second(self) -> float:
+        """Throughput of the run"""
+        if not self.elapsed_seconds:
+            return 0.0
+        return self.processed / self.elapsed_seconds
+
+    def to_dict(self):
+        """Converts the stats to a dictionary for JSON serialization"""
+        stats = asdict(self)
+        stats["events_per_second"] = round(self.events_per_second, 2)
+        return stats
+
+
+class CheckpointStore:
+    """Stores replay progress per archive byte range in the replayed database."""
+
+    def __init__(self, connection=None):
+        """
+        Args:
+            connection: Database to store progress in, defaults to `get_connection()`
+        """
+        self.conn = connection or get_connection()
+        self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS replay_checkpoints(
+                    archive TEXT NOT NULL,
+                    start_offset INTEGER NOT NULL,
+                    end_offset INTEGER NOT NULL,
+                    offset INTEGER NOT NULL,
+                    processed INTEGER NOT NULL,
+                    failed INTEGER NOT NULL,
+                    dead_letter_size INTEGER NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (archive, start_offset, end_offset)
+                );
+                """)
+        self.conn.commit()
+
+    def load(self, archive: str, start: int, end: int) -> Optional[tuple]:
+        """Returns the saved (offset, processed, failed, dead_letter_size) for a byte range."""
+        return self.conn.execute(
+            """
+            SELECT offset, processed, failed, dead_letter_size FROM replay_checkpoints
+            WHERE archive = ? AND start_offset = ? AND end_offset = ?
+            """,
+            (archive, start, end),
+        ).fetchone()
+
+    def save(self, archive: str, start: int, end: int, offset: int, processed: int,
+             failed: int, dead_letter_size: int, commit: bool = True) -> None:
+        """Saves the resume offset, total counters and dead-letter size for a byte range.
+
+        Pass `commit=False` to save in the open transaction, e.g. together
+        with the return the checkpoint moves past.
+        """
+        self.conn.execute(
+            """
+            INSERT OR REPLACE INTO replay_checkpoints
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (archive, start, end, offset, processed, failed, dead_letter_size,
+             datetime.now(timezone.utc).isoformat()),
+        )
+        if commit:
+            self.conn.commit()
+
+
+def write_dead_letter(dead_letter, offset: int, reason: str,
+                      event: Optional[dict] = None, raw: Optional[str] = None,
+                      response: Optional[dict] = None) -> None:
+    """Appends a rejected event to the dead-letter file as one NDJSON line."""
+    entry = {
+        "offset": offset,
+        "reason": reason,
+        "event": event,
+        "raw": raw,
+        "response": response,
+    }
+    dead_letter.write(json.dumps(entry) + "\n")
+
+
+def rejection(record: ArchiveRecord, response: dict) -> Optional[dict]:
+    """Dead-letter entry of an event with a FAILED response, None if it succeeded."""
+    if response["status"] != "FAILED":
+        return None
+    return {"reason": response["message"], "event": record.event, "response": response}
+
+
+def truncate_dead_letter(dead_letter, size: int) -> None:
+    """Drops the dead-letter entries written after the first `size` bytes."""
+    dead_letter.seek(size)
+    dead_letter.truncate()
+
+
+def replay_archive(archive_path: str, dead_letter_path: str,
+                   start: int = 0, end: Optional[int] = None,
+                   checkpoint_every: int = DEFAULT_CHECKPOINT_EVERY) -> ReplayStats:
+    """Replays the events of an archive byte range through the processor.
+
+    Memory use does not grow with the archive: events are streamed from the
+    memory-mapped file and only counters are kept. Each event that commits
+    a response checkpoints in that transaction, after its dead-letter entry
+    is flushed. Events that write nothing are replayed harmlessly if lost,
+    and are checkpointed every `checkpoint_every` events. If processing
+    raises, progress up to the last completed event is checkpointed before
+    the error propagates.
+
+    Args:
+        archive_path (str): Path to the NDJSON archive
+        dead_letter_path (str): Path to the NDJSON dead-letter file of this byte range
+        start (int): Start of the byte range to replay
+        end (Optional[int]): End of the byte range, defaults to end of file
+        checkpoint_every (int): Number of events between checkpoints of
+            events that write nothing
+
+    Returns:
+        ReplayStats: Counters and throughput for this run
+    """
+    archive = os.path.abspath(archive_path)
+    checkpoints = CheckpointStore()
+
+    with ArchiveReader(archive) as reader, \
+            open(dead_letter_path, "a", encoding="utf-8") as dead_letter:
+        end = reader.size if end is None else end
+        checkpoint = checkpoints.load(archive, start, end)
+        if checkpoint is None:
+            offset, processed, failed = start, 0, 0
+        else:
+            offset, processed, failed, dead_letter_size = checkpoint
+            if dead_letter.tell() > dead_letter_size:
+                # Written for events after the checkpoint, which are replayed
+                truncate_dead_letter(dead_letter, dead_letter_size)
+        stats = ReplayStats(archive, start, end, resumed_from=offset, offset=offset)
+
+        if offset != start:
+            logger.info("Resuming replay of %s at offset %d", archive, offset)
+
+        # Dead-letter size after the last completed event
+        completed_size = dead_letter.tell()
+
+        def write_outcome(record: ArchiveRecord, entry: Optional[dict]) -> None:
+            """Dead-letters a rejected event after the last completed one.
+
+            Repeating it for the same event, e.g. when its transaction is
+            retried, still leaves a single entry.
+            """
+            if dead_letter.tell() != completed_size:
+                truncate_dead_letter(dead_letter, completed_size)
+            if entry:
+                write_dead_letter(dead_letter, record.offset, **entry)
+            dead_letter.flush()
+
+        def save_checkpoint(offset: int, run_processed: int, run_failed: int,
+                            commit: bool = True) -> None:
+            checkpoints.save(archive, start, end, offset, processed + run_processed,
+                             failed + run_failed, dead_letter.tell(), commit=commit)
+
+        since_checkpoint = 0
+        started = time.perf_counter()
+        try:
+            for record in reader.iter_records(offset, end):
+                committed = []
+
+                def checkpoint_in_transaction(response: dict, record=record) -> None:
+                    entry = rejection(record, response)
+                    write_outcome(record, entry)
+                    save_checkpoint(record.next_offset, stats.processed + 1,
+                                    stats.failed + bool(entry), commit=False)
+                    committed.append(response)
+
+                if record.error:
+                    entry = {"reason": record.error, "raw": record.raw}
+                else:
+                    with before_commit(checkpoint_in_transaction):
+                        entry = rejection(record, process_rental_return(record.event))
+                if not committed:
+                    write_outcome(record, entry)
+
+                stats.processed += 1
+                stats.failed += bool(entry)
+                stats.succeeded += not entry
+                stats.offset = record.next_offset
+                completed_size = dead_letter.tell()
+
+                since_checkpoint = 0 if committed else since_checkpoint + 1
+                if since_checkpoint >= checkpoint_every:
+                    save_checkpoint(stats.offset, stats.processed, stats.failed)
+                    since_checkpoint = 0
+        finally:
+            # Drops the entry of an event that did not complete
+            if dead_letter.tell() != completed_size:
+                truncate_dead_letter(dead_letter, completed_size)
+            save_checkpoint(stats.offset, stats.processed, stats.failed)
+            stats.elapsed_seconds = time.perf_counter() - started
+
+    return stats
+
+
+def parse_shard(shard: str) -> tuple:
+    """Parses a shard argument of the form I/N into (index, count)."""
+    try:
+        index, count = (int(part) for part in shard.split("/"))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"Invalid shard: {shard}") from e
+
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Invalid shard: {shard}")
+    return index, count
+
+
+def default_dead_letter_path(archive: str, index: int, count: int) -> str:
+    """Dead-letter file of a shard, each shard truncates its own on resume."""
+    if count == 1:
+        return f"{archive}.dead.ndjson"
+    return f"{archive}.dead-{index}-of-{count}.ndjson"
+
+
+def main():
+    """Replays an NDJSON archive and prints the run summary as JSON."""
+    parser = argparse.ArgumentParser(
+        description="Replay an NDJSON archive of return events.")
+    parser.add_argument("archive", help="NDJSON archive of return events")
+    parser.add_argument("--dead-letter", help="NDJSON dead-letter file of this shard "
+                        "(default: <archive>.dead.ndjson, <archive>.dead-I-of-N.ndjson "
+                        "with --shard)")
+    parser.add_argument("--shard", type=parse_shard, default=(0, 1),
+                        help="replay shard I of N, e.g. 0/4")
+    parser.add_argument("--checkpoint-every", type=int,
+                        default=DEFAULT_CHECKPOINT_EVERY,
+                        help="events that write nothing between checkpoints")
+    parser.add_argument("--profile", choices=PROFILE_MODES,
+                        help="profile the replay (default: TOPANGA_PROFILE)")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    configure_logging(verbose=args.verbose)
+
+    if not os.path.exists(args.archive):
+        print(f"File not found: {args.archive}")
+        sys.exit(1)
+
+    index, count = args.shard
+    with ArchiveReader(args.archive) as reader:
+        start, end = reader.shards(count)[index]
+
+    with profile_run(f"replay-{index}-of-{count}", args.profile):
+        stats = replay_archive(
+            args.archive,
+            args.dead_letter or default_dead_letter_path(args.archive, index, count),
+            start=start,
+            end=end,
+            checkpoint_every=args.checkpoint_every,
+        )
+    print(json.dumps(stats.to_dict(), indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,39 @@
 """Response module for rental return events"""
+import json
+from enum import Enum
 from typing import Optional
 from dataclasses import dataclass, asdict
 
 from topanga_queries.rentals import Rental
 
 
+class ErrorCode(str, Enum):
+    """Why a rental return failed, sent as `error_code` in failure responses"""
+    NO_ELIGIBLE_RENTAL = "NO_ELIGIBLE_RENTAL"
+    ASSET_NOT_FOUND = "ASSET_NOT_FOUND"
+    INVALID_QR_CODE = "INVALID_QR_CODE"
+    INVALID_EVENT = "INVALID_EVENT"
+    MISSING_FIELD = "MISSING_FIELD"
+    INVALID_TYPE = "INVALID_TYPE"
+    INVALID_JSON = "INVALID_JSON"
+    FILE_SYSTEM_ERROR = "FILE_SYSTEM_ERROR"
+    DATABASE_BUSY = "DATABASE_BUSY"
+
+
+# The `error` text sent with each code
+ERROR_DESCRIPTIONS = {
+    ErrorCode.NO_ELIGIBLE_RENTAL: "No eligible rental found",
+    ErrorCode.ASSET_NOT_FOUND: "Asset not found",
+    ErrorCode.INVALID_QR_CODE: "Invalid QR code",
+    ErrorCode.INVALID_EVENT: "Invalid return event",
+    ErrorCode.MISSING_FIELD: "Missing required field",
+    ErrorCode.INVALID_TYPE: "Unexpected data type",
+    ErrorCode.INVALID_JSON: "Invalid JSON",
+    ErrorCode.FILE_SYSTEM_ERROR: "File system error",
+    ErrorCode.DATABASE_BUSY: "Database busy",
+}
+
+
 @dataclass
 class RentalReturnResponse:
     """Response object for rental return"""
@@ -14,6 +43,7 @@ class RentalReturnResponse:
     rental_returned_at: Optional[str] = None
     rental_status: Optional[str] = None
     error: Optional[str] = None
+    error_code: Optional[str] = None  # An `ErrorCode` value when FAILED
 
     def to_dict(self):
         """Converts the response object to a dictionary for JSON serialization"""
@@ -37,18 +67,56 @@ def create_success_response(rental: Rental) -> dict:
         rental_status=rental.status
     ).to_dict()
 
+# ====================================================
+# Failure Response Templates
+# Failure responses differ only in their message, so the response for each
+# error code is built, and serialized, once. The JSON is kept split around
+# the message, which is the only part encoded per response.
+# ====================================================
+
 
-def create_failure_response(message: str) -> dict:
+_FAILURE_TEMPLATES = {
+    code: RentalReturnResponse(
+        status="FAILED", message="", error=description, error_code=code.value).to_dict()
+    for code, description in ERROR_DESCRIPTIONS.items()
+}
+_MESSAGE_PLACEHOLDER = json.dumps("\0message\0")
+_FAILURE_JSON = {  # Keyed by `error_code` as it appears in a response
+    code.value: tuple(json.dumps({**template, "message": "\0message\0"}).split(_MESSAGE_PLACEHOLDER))
+    for code, template in _FAILURE_TEMPLATES.items()
+}
+
+
+def create_failure_response(message: str, code: ErrorCode = ErrorCode.NO_ELIGIBLE_RENTAL) -> dict:
     """Creates a failure response dictionary
 
     Args:
         message (str): The error message
+        code (ErrorCode): Why the return failed
 
     Returns:
         dict: The failure response dictionary
     """
-    return RentalReturnResponse(
-        status="FAILED",
-        message=message,
-        error="No eligible rental found"
-    ).to_dict()
+    response = _FAILURE_TEMPLATES[code].copy()
+    response["message"] = message
+    return response
+
+
+def serialize_response(response: dict) -> str:
+    """Encodes a response as JSON
+
+    Failure responses are filled into their pre-serialized template, so only
+    the message is encoded. Equivalent to `json.dumps(response)`.
+
+    Args:
+        response (dict): A response from `create_success_response` or
+            `create_failure_response`
+
+    Returns:
+        str: The JSON encoded response
+    """
+    template = _FAILURE_JSON.get(response["error_code"])
+    if template is None:
+        return json.dumps(response)
+    prefix, suffix = template
+    return prefix + json.dumps(response["message"]) + suffix
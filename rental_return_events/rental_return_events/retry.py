@@ -0,0 +1,125 @@
+"""
+Retry policy for transient SQLite lock errors.
+
+SQLite allows a single writer at a time. A connection waiting for the write
+lock first spins in SQLite's busy handler for `busy_timeout_ms`, then fails
+with `database is locked`. `call_with_retry` rolls back and retries such
+failures with jittered exponential backoff until a deadline, recording
+retries, the time of each attempt that failed on a lock, and backoff time in
+`metrics`.
+
+The busy timeout is set when the shared connection opens, from the same
+`TOPANGA_RETRY_BUSY_TIMEOUT_MS` as `RetryPolicy.from_env`, so
+`call_with_retry` only issues `PRAGMA busy_timeout` for a policy with a
+different timeout.
+"""
+import os
+import random
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+from topanga_queries import get_busy_timeout_ms, get_connection
+
+from rental_return_events.metrics import metrics
+
+
+@dataclass
+class RetryPolicy:
+    """Backoff settings for retrying transient database errors"""
+    busy_timeout_ms: int = 1000  # SQLite busy handler wait per attempt
+    base_delay: float = 0.01  # Backoff before the first retry, in seconds
+    max_delay: float = 0.5  # Cap on a single backoff, in seconds
+    deadline: float = 10.0  # Give up once this many seconds have passed
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        """Builds a policy from `TOPANGA_RETRY_*` environment variables."""
+        defaults = cls()
+        return cls(
+            busy_timeout_ms=get_busy_timeout_ms(),
+            base_delay=float(os.getenv("TOPANGA_RETRY_BASE_DELAY", defaults.base_delay)),
+            max_delay=float(os.getenv("TOPANGA_RETRY_MAX_DELAY", defaults.max_delay)),
+            deadline=float(os.getenv("TOPANGA_RETRY_DEADLINE", defaults.deadline)),
+        )
+
+    def backoff(self, attempt: int) -> float:
+        """Returns a "full jitter" delay for the given retry attempt."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+def is_transient_db_error(error: Exception) -> bool:
+    """Returns True for SQLite lock errors that are worth retrying
+
+    Args:
+        error (Exception): Raised exception
+
+    Returns:
+        bool: True if the database was locked or busy
+    """
+    import sqlite3  # Already loaded once a connection exists
+
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and (
+        "locked" in message or "busy" in message)
+
+
+# (connection, busy timeout in ms) last set by `call_with_retry`
+_busy_timeout = (None, None)
+
+
+def _set_busy_timeout(connection, busy_timeout_ms: int) -> None:
+    """Sets the busy timeout on the shared connection unless it already has it."""
+    global _busy_timeout
+
+    # A newly opened shared connection has the timeout from the environment
+    current = _busy_timeout[1] if _busy_timeout[0] is connection else get_busy_timeout_ms()
+    if busy_timeout_ms != current:
+        connection.execute(f"PRAGMA busy_timeout = {int(busy_timeout_ms)};")
+    _busy_timeout = (connection, busy_timeout_ms)
+
+
+def call_with_retry(func: Callable, *args, policy: RetryPolicy = None, **kwargs):
+    """Calls `func`, retrying transient database errors with backoff.
+
+    `func` must be safe to re-run from the start: whenever it raises, the
+    open transaction is rolled back, before retrying or re-raising.
+
+    Args:
+        func (Callable): Read-modify-write operation to run
+        policy (RetryPolicy): Retry settings, defaults to `RetryPolicy.from_env()`
+
+    Raises:
+        sqlite3.OperationalError: If the deadline passes without success
+
+    Returns:
+        The result of `func`
+    """
+    policy = policy or RetryPolicy.from_env()
+    connection = get_connection()
+    _set_busy_timeout(connection, policy.busy_timeout_ms)
+
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        attempt_started = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+
+        except Exception as e:
+            connection.rollback()
+            if not is_transient_db_error(e):
+                raise
+
+            # The whole attempt, mostly the busy handler's wait for the lock
+            metrics.observe("db.locked_attempt", time.monotonic() - attempt_started)
+
+            delay = policy.backoff(attempt)
+            if time.monotonic() - started + delay > policy.deadline:
+                metrics.increment("db.retry_exhausted")
+                raise
+
+            metrics.increment("db.retries")
+            metrics.observe("db.retry_backoff", delay)
+            time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,187 @@
+"""
+Priority scheduler in front of `process_rental_return`.
+
+Live kiosk returns and backfill replays compete for the single SQLite
+writer. `EventScheduler` keeps a queue per priority and always processes
+live events first. Backfill events are paced so they take at most
+`backfill_share` of the worker's time: after a backfill event that took
+`t` seconds, the next one waits `t * (1 - share) / share` seconds, and live
+events are processed in the gap.
+
+`submit` can be called from any thread and returns a future for the
+response. `run` processes events on the calling thread, which must be the
+thread that uses the shared database connection. After `shutdown`, new
+events are refused and `run` returns once the queued events are drained.
+
+Metrics, per queue (`live` or `backfill`):
+    scheduler.<queue>.depth      gauge, events waiting
+    scheduler.<queue>.wait       timer, time from submit to processing
+    scheduler.<queue>.latency    timer, time from submit to response
+    scheduler.<queue>.processed  counter
+    scheduler.backfill.throttled timer, time backfill was held back while
+                                 backfill events were waiting
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from queue import Full
+
+from rental_return_events.metrics import metrics
+from rental_return_events.processor import process_rental_return
+from rental_return_events.retry import RetryPolicy
+
+PRIORITIES = ("live", "backfill")
+DEFAULT_BACKFILL_SHARE = 0.2
+DEFAULT_MAX_DEPTH = 1000
+
+
+@dataclass
+class ScheduledEvent:
+    """An event waiting in a scheduler queue"""
+    event: dict
+    priority: str
+    submitted_at: float = field(default_factory=time.monotonic)
+    future: Future = field(default_factory=Future)
+
+
+class EventScheduler:
+    """Processes live events first and backfill events in a capped share of time."""
+
+    def __init__(self, backfill_share: float = DEFAULT_BACKFILL_SHARE,
+                 max_depth: int = DEFAULT_MAX_DEPTH, retry_policy: RetryPolicy = None):
+        """
+        Args:
+            backfill_share (float): Largest share of processing time backfill may use, in (0, 1]
+            max_depth (int): Events per queue before `submit` blocks
+            retry_policy (RetryPolicy): Passed to `process_rental_return`
+
+        Raises:
+            ValueError: If `backfill_share` is out of range
+        """
+        if not 0 < backfill_share <= 1:
+            raise ValueError(f"Invalid backfill share: {backfill_share}")
+
+        self.backfill_share = backfill_share
+        self.max_depth = max_depth
+        self.retry_policy = retry_policy
+        self._queues = {priority: deque() for priority in PRIORITIES}
+        self._condition = threading.Condition()
+        self._closed = False
+        self._backfill_ready_at = 0.0
+
+    def depth(self, priority: str) -> int:
+        """Number of events waiting in a queue."""
+        with self._condition:
+            return len(self._queues[priority])
+
+    def _update_depth(self, priority: str) -> None:
+        metrics.gauge(f"scheduler.{priority}.depth", len(self._queues[priority]))
+
+    def submit(self, event: dict, priority: str = "live", timeout: float = None) -> Future:
+        """Queues an event, waiting while its queue is full.
+
+        Args:
+            event (dict): Return event, as passed to `process_rental_return`
+            priority (str): 'live' or 'backfill'
+            timeout (float): Seconds to wait for room in a full queue, None waits forever
+
+        Raises:
+            ValueError: If the priority is unknown
+            RuntimeError: If the scheduler is shut down
+            queue.Full: If the queue is still full after `timeout`
+
+        Returns:
+            Future: Resolves to the response, or the exception processing raised
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Invalid priority: {priority}")
+
+        with self._condition:
+            has_room = self._condition.wait_for(
+                lambda: self._closed or len(self._queues[priority]) < self.max_depth, timeout)
+            if self._closed:
+                raise RuntimeError("Scheduler is shut down")
+            if not has_room:
+                raise Full(f"{priority} queue is full")
+
+            scheduled = ScheduledEvent(event, priority, time.monotonic())
+            self._queues[priority].append(scheduled)
+            self._update_depth(priority)
+            self._condition.notify_all()
+        return scheduled.future
+
+    def _next_event(self):
+        """Waits for the next event to process, None once shut down and drained."""
+        with self._condition:
+            throttled_since = None
+            while True:
+                now = time.monotonic()
+                if self._queues["live"]:
+                    priority = "live"
+                # Backfill is no longer held back once shutting down, so the drain ends
+                elif self._queues["backfill"] and (
+                        self._closed or now >= self._backfill_ready_at):
+                    priority = "backfill"
+                elif self._closed and not self._queues["backfill"]:
+                    return None
+                else:
+                    wait = None
+                    if self._queues["backfill"]:
+                        throttled_since = throttled_since or now
+                        wait = self._backfill_ready_at - now
+                    self._condition.wait(wait)
+                    continue
+
+                if priority == "backfill" and throttled_since is not None:
+                    metrics.observe("scheduler.backfill.throttled", now - throttled_since)
+
+                scheduled = self._queues[priority].popleft()
+                self._update_depth(priority)
+                self._condition.notify_all()  # Room for a blocked `submit`
+                return scheduled
+
+    def _process(self, scheduled: ScheduledEvent) -> None:
+        started = time.monotonic()
+        priority = scheduled.priority
+        metrics.observe(f"scheduler.{priority}.wait", started - scheduled.submitted_at)
+
+        if not scheduled.future.set_running_or_notify_cancel():
+            return
+
+        try:
+            scheduled.future.set_result(process_rental_return(scheduled.event, self.retry_policy))
+        except Exception as e:  # pylint: disable=broad-except
+            scheduled.future.set_exception(e)
+
+        finished = time.monotonic()
+        if priority == "backfill":
+            with self._condition:
+                self._backfill_ready_at = finished + (finished - started) * (
+                    1 - self.backfill_share) / self.backfill_share
+        metrics.observe(f"scheduler.{priority}.latency", finished - scheduled.submitted_at)
+        metrics.increment(f"scheduler.{priority}.processed")
+
+    def run(self) -> None:
+        """Processes events on this thread until shut down and drained."""
+        while True:
+            scheduled = self._next_event()
+            if scheduled is None:
+                return
+            self._process(scheduled)
+
+    def shutdown(self, drain: bool = True) -> None:
+        """Refuses new events and lets `run` return.
+
+        Args:
+            drain (bool): Process the queued events first, otherwise cancel them
+        """
+        with self._condition:
+            self._closed = True
+            if not drain:
+                for priority, queue in self._queues.items():
+                    while queue:
+                        queue.popleft().future.cancel()
+                    self._update_depth(priority)
+            self._condition.notify_all()
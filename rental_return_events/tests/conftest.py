@@ -3,35 +3,73 @@
 import os
 import sys
 import json
+import sqlite3
 import pytest
 
 from topanga_queries.bootstrap.db import initialize_challenge_db
-from topanga_queries import reset_db_connection
+from topanga_queries import get_connection, reset_db_connection
 from rental_return_events.logger import configure_logging
 from env_setup import DB_TEST_PATH, EVENTS_DIR
+import perf
 
 # Add package to sys path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-# Define paths and set up environment before importing topanga and rental_return_events packages
-DB_TEST_PATH = os.path.join(os.path.dirname(__file__), "challenge.test.db")  # Inside `tests/`
+# Define paths and set up environment before importing topanga and rental_return_events packages.
+# Each pytest-xdist worker (`pytest -n 4`) gets a database file of its own.
+WORKER_ID = os.getenv("PYTEST_XDIST_WORKER", "")
+DB_TEST_PATH = os.path.join(  # Inside `tests/`
+    os.path.dirname(__file__), f"challenge.test.{WORKER_ID}.db" if WORKER_ID else "challenge.test.db")
 os.environ["TOPANGA_DB_PATH"] = DB_TEST_PATH
 
+# `TOPANGA_TEST_DB` selects how each test gets a clean database:
+#   template  - bootstrapped once per session, kept in memory and restored
+#               for each test with the SQLite backup API (default)
+#   bootstrap - deleted and bootstrapped from scratch for each test
+TEST_DB_MODES = ("template", "bootstrap")
+TEST_DB_MODE = os.getenv("TOPANGA_TEST_DB", "template")
+if TEST_DB_MODE not in TEST_DB_MODES:
+    raise ValueError(f"Invalid TOPANGA_TEST_DB: {TEST_DB_MODE}")
+
 # Suppress debug logging during tests
 configure_logging(verbose=False)
 
-# Initialize the test database
-initialize_challenge_db()
 
-@pytest.fixture(scope="function", autouse=True)
-def refresh_test_db():
-    """Creates a clean database and resets db_connection before each test."""
-    if os.path.exists(DB_TEST_PATH):
-        os.remove(DB_TEST_PATH)
+def remove_test_db():
+    """Deletes the test database with its WAL, so no stale WAL is replayed."""
+    for path in (DB_TEST_PATH, f"{DB_TEST_PATH}-wal", f"{DB_TEST_PATH}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+
 
-    db_connection = reset_db_connection()
+@pytest.fixture(scope="session")
+def template_db():
+    """Bootstraps the test database once and keeps an in-memory copy of it."""
+    remove_test_db()
+    reset_db_connection()
     initialize_challenge_db()
 
+    template = sqlite3.connect(":memory:")
+    get_connection().backup(template)
+
+    yield template
+
+    template.close()
+
+
+@pytest.fixture(scope="function", autouse=True)
+def refresh_test_db(request):
+    """Creates a clean database and resets db_connection before each test."""
+    if TEST_DB_MODE == "template":
+        template = request.getfixturevalue("template_db")
+        db_connection = reset_db_connection()
+        # Overwrites every page of the test database, whatever the last test left
+        template.backup(db_connection)
+    else:
+        remove_test_db()
+        db_connection = reset_db_connection()
+        initialize_challenge_db()
+
     yield db_connection
 
     db_connection.close()
@@ -48,3 +86,17 @@ def load_event():
             return json.load(f)
 
     return _load_event
+
+
+def pytest_terminal_summary(terminalreporter):
+    """Prints the benchmark timings, and stores them in update mode."""
+    if not perf.results:
+        return
+
+    terminalreporter.section("performance")
+    for line in perf.summary_lines():
+        terminalreporter.write_line(line)
+
+    if perf.get_perf_mode() == "update":
+        perf.write_baselines()
+        terminalreporter.write_line(f"Baselines written to {perf.BASELINES_PATH}")
@@ -0,0 +1,230 @@
+"""
+Helpers for the performance regression tests in `test_perf.py`.
+
+`TOPANGA_PERF` selects what the benchmarks do; they are skipped when unset:
+    run     - measure and print the timings
+    compare - fail any benchmark slower than its baseline by more than
+              `TOPANGA_PERF_TOLERANCE` (default 0.5, i.e. 50%)
+    update  - measure and write the timings to `perf_baselines.json`
+
+Each baseline is stored with the time of a fixed calibration workload,
+measured right after the benchmark, and comparisons scale by the ratio of
+the calibration times then and now. A slower machine, or one that slowed
+down partway through the run, then does not read as a regression.
+"""
+import json
+import os
+import random
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from itertools import count
+from typing import Callable, Dict, List, Tuple
+
+import pytest
+
+from topanga_queries.bootstrap.db import generate_rental_record
+from topanga_queries.bootstrap.events import REFERENCE_NOW, encode_qr
+from topanga_queries.membership import invalidate_id_filters
+from topanga_queries.rentals import RENTAL_COLUMNS
+
+PERF_MODES = ("run", "compare", "update")
+DEFAULT_TOLERANCE = 0.5
+PERF_REPEATS = 7
+PERF_ATTEMPTS = 3
+PERF_SEED = 20250210
+# Dataset sizes, in rentals
+PERF_SIZES = {"1k": 1_000, "10k": 10_000, "100k": 100_000}
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "perf_baselines.json")
+
+# Benchmark name -> (seconds per call, calibration seconds)
+results: Dict[str, Tuple[float, float]] = {}
+
+
+def get_perf_mode():
+    """Benchmark mode from `TOPANGA_PERF`, None if benchmarks are off."""
+    mode = os.getenv("TOPANGA_PERF") or None
+    if mode is not None and mode not in PERF_MODES:
+        raise ValueError(f"Invalid TOPANGA_PERF: {mode}")
+    return mode
+
+
+def measure(call: Callable[[int], object], number: int, repeats: int = PERF_REPEATS) -> float:
+    """Seconds per call in the fastest of `repeats` batches of `number` calls.
+
+    The fastest batch is the one least disturbed by other processes, so it
+    varies least between runs. `call` gets a running index, so benchmarks
+    that use up data, such as a rental that can only be returned once, take
+    a different item each call.
+    """
+    index = count()
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for _ in range(number):
+            call(next(index))
+        timings.append((time.perf_counter() - started) / number)
+    return min(timings)
+
+
+def calibration_seconds() -> float:
+    """Time of a fixed CPU-bound workload."""
+    payload = [{"id": str(n), "values": list(range(20))} for n in range(200)]
+    return measure(lambda _: (sum(n * n for n in range(10_000)), json.dumps(payload)),
+                   10, repeats=10)
+
+
+def load_baselines() -> dict:
+    """Stored baselines, name -> {"seconds", "calibration_seconds"}."""
+    if not os.path.exists(BASELINES_PATH):
+        return {}
+    with open(BASELINES_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def allowed_seconds(baseline: dict, calibration: float, tolerance: float = 0.0) -> float:
+    """The baseline time scaled to the current calibration, plus a tolerance."""
+    return (baseline["seconds"] * calibration / baseline["calibration_seconds"]
+            * (1 + tolerance))
+
+
+def benchmark(name: str, call: Callable[[int], object], number: int) -> float:
+    """Measures a benchmark and records it; in compare mode, fails if it regressed.
+
+    A timing over the allowed time is measured again, up to `PERF_ATTEMPTS`
+    times in all, so a burst of load on the machine is not reported as a
+    regression. A real regression is slow on every attempt.
+
+    Args:
+        name (str): Benchmark name, including the dataset size
+        call (Callable[[int], object]): Code to time, gets a running index
+            that keeps counting across attempts
+        number (int): Calls per batch
+
+    Returns:
+        float: Seconds per call
+    """
+    index = count()
+    baseline = load_baselines().get(name)
+    compare = get_perf_mode() == "compare"
+    if compare and baseline is None:
+        pytest.fail(f"No baseline for {name}, record one with TOPANGA_PERF=update")
+
+    tolerance = float(os.getenv("TOPANGA_PERF_TOLERANCE", DEFAULT_TOLERANCE))
+    for _ in range(PERF_ATTEMPTS if compare else 1):
+        seconds = measure(lambda _: call(next(index)), number)
+        calibration = calibration_seconds()
+        if name not in results or seconds / calibration < results[name][0] / results[name][1]:
+            results[name] = seconds, calibration
+        if not compare or seconds <= allowed_seconds(baseline, calibration, tolerance):
+            return seconds
+
+    seconds, calibration = results[name]
+    pytest.fail(f"{name} regressed: {seconds * 1e6:.1f}us per call, allowed "
+                f"{allowed_seconds(baseline, calibration, tolerance) * 1e6:.1f}us "
+                f"({baseline['seconds'] * 1e6:.1f}us baseline)")
+
+
+def write_baselines() -> None:
+    """Merges this session's timings into the stored baselines."""
+    baselines = load_baselines()
+    for name, (seconds, calibration) in results.items():
+        baselines[name] = {"seconds": float(f"{seconds:.4g}"),
+                           "calibration_seconds": float(f"{calibration:.4g}")}
+
+    with open(BASELINES_PATH, "w", encoding="utf-8") as f:
+        json.dump(dict(sorted(baselines.items())), f, indent=4)
+        f.write("\n")
+
+
+def summary_lines() -> List[str]:
+    """One line per benchmark run this session, against its baseline."""
+    baselines = load_baselines()
+    lines = []
+    for name, (seconds, calibration) in sorted(results.items()):
+        baseline = baselines.get(name)
+        change = (f"{seconds / allowed_seconds(baseline, calibration) - 1:+.1%}"
+                  if baseline else "new")
+        lines.append(f"{name:<45} {seconds * 1e6:>10.1f}us  {change}")
+    return lines
+
+# ====================================================
+# Seeded Datasets
+# ====================================================
+
+
+@dataclass
+class PerfDataset:
+    """Rentals seeded for the benchmarks"""
+    size: int
+    # (user_id, asset_id) once per returnable rental, in a seeded order
+    returnable: List[Tuple[str, str]]
+    heavy_user: Tuple[str, str]
+
+
+def return_event(user_id: str, asset_id: str) -> dict:
+    """Builds a return event at `REFERENCE_NOW`."""
+    return {
+        "timestamp": REFERENCE_NOW.isoformat(),
+        "location_id": "topanga-location-02",
+        "user_qr_data": encode_qr(user_id),
+        "asset_qr_data": encode_qr(asset_id),
+    }
+
+
+def seed_dataset(connection, size: int, seed: int = PERF_SEED) -> PerfDataset:
+    """Seeds about `size` rentals, the same ones for the same seed.
+
+    Users have 1 to 19 rentals each: 60% in progress, 30% completed and 10%
+    expired. One heavy user has `size / 10` rentals in progress, up to 1000.
+
+    Args:
+        connection: Connection to a bootstrapped database
+        size (int): Number of rentals
+        seed (int): Random seed
+
+    Returns:
+        PerfDataset: Who can return what
+    """
+    rng = random.Random(seed)
+    assets = [row[0] for row in connection.execute("SELECT id FROM assets ORDER BY id;")]
+    rows, returnable, users = [], [], []
+
+    def add_rental(user_id: str, asset_id: str, kind: str) -> None:
+        created_at = REFERENCE_NOW - timedelta(minutes=rng.randint(60, 60 * 24 * 9))
+        if kind == "expired":
+            rows.append(generate_rental_record(
+                f"perf-r{len(rows):07}", user_id, asset_id, "topanga-location-01",
+                REFERENCE_NOW - timedelta(days=20), 1, "IN_PROGRESS"))
+        elif kind == "completed":
+            rows.append(generate_rental_record(
+                f"perf-r{len(rows):07}", user_id, asset_id, "topanga-location-01", created_at,
+                10, "COMPLETED", "topanga-location-03", created_at + timedelta(hours=2)))
+        else:
+            rows.append(generate_rental_record(
+                f"perf-r{len(rows):07}", user_id, asset_id, "topanga-location-01", created_at,
+                10, "IN_PROGRESS"))
+            returnable.append((user_id, asset_id))
+
+    heavy_user = ("perf_heavy", assets[0])
+    users.append((heavy_user[0], "Perf heavy user"))
+    for _ in range(min(size // 10, 1000)):
+        add_rental(*heavy_user, "in_progress")
+
+    user = 0
+    while len(rows) < size:
+        user_id, asset_id = f"perf_u{user:06}", rng.choice(assets)
+        users.append((user_id, f"Perf user {user}"))
+        for _ in range(min(rng.randint(1, 19), size - len(rows))):
+            add_rental(user_id, asset_id, rng.choices(
+                ("in_progress", "completed", "expired"), (6, 3, 1))[0])
+        user += 1
+
+    connection.executemany("INSERT INTO users(id, name) VALUES (?, ?);", users)
+    connection.executemany(
+        f"INSERT INTO rentals({RENTAL_COLUMNS}) VALUES ({', '.join('?' * 10)});", rows)
+    connection.commit()
+    invalidate_id_filters()
+
+    rng.shuffle(returnable)
+    return PerfDataset(size, returnable, heavy_user)
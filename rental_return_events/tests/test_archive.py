@@ -0,0 +1,91 @@
+"""Test the NDJSON event archive reader."""
+import json
+
+import pytest
+
+from rental_return_events.archive import ArchiveReader, shard_ranges
+
+
+def write_archive(path, events):
+    """Writes events to an NDJSON archive, one per line."""
+    with open(path, "w", encoding="utf-8") as f:
+        for event in events:
+            f.write(event if isinstance(event, str) else json.dumps(event))
+            f.write("\n")
+
+
+def test_iter_records(tmp_path, load_event):
+    """Test reading valid, blank and invalid lines from an archive."""
+
+    archive = tmp_path / "events.ndjson"
+    write_archive(archive, [load_event("event_01.json"), "", "{not json", "[1, 2]"])
+
+    with ArchiveReader(str(archive)) as reader:
+        records = list(reader.iter_records())
+
+    assert len(records) == 3
+    assert records[0].event == load_event("event_01.json")
+    assert records[1].error.startswith("Invalid JSON")
+    assert records[1].raw == "{not json"
+    assert records[2].error == "Invalid event: expected a JSON object"
+    assert records[-1].next_offset == archive.stat().st_size
+
+
+def test_shards_are_disjoint(tmp_path):
+    """Test that shards cover every line exactly once."""
+
+    archive = tmp_path / "events.ndjson"
+    write_archive(archive, [{"n": n, "pad": "x" * (n % 7)} for n in range(100)])
+
+    with ArchiveReader(str(archive)) as reader:
+        seen = [record.event["n"]
+                for start, end in reader.shards(7)
+                for record in reader.iter_records(start, end)]
+
+    assert seen == list(range(100))
+
+
+def test_resume_from_position(tmp_path):
+    """Test that reading resumes after the last line read."""
+
+    archive = tmp_path / "events.ndjson"
+    write_archive(archive, [{"n": n} for n in range(10)])
+
+    with ArchiveReader(str(archive)) as reader:
+        for record in reader.iter_records():
+            if record.event["n"] == 3:
+                break
+        resumed = [record.event["n"] for record in reader.iter_records(reader.position)]
+
+    assert resumed == list(range(4, 10))
+
+
+def test_empty_archive(tmp_path):
+    """Test that an empty archive yields nothing."""
+
+    archive = tmp_path / "events.ndjson"
+    archive.write_bytes(b"")
+
+    with ArchiveReader(str(archive)) as reader:
+        assert not list(reader.iter_records())
+        assert shard_ranges(reader.size, 3) == [(0, 0), (0, 0), (0, 0)]
+
+
+def test_close_during_iteration(tmp_path, load_event):
+    """Test the archive can be closed while iterations are suspended mid-file."""
+
+    archive = tmp_path / "events.ndjson"
+    write_archive(archive, [load_event("event_01.json")] * 3)
+
+    reader = ArchiveReader(str(archive))
+    records = reader.iter_records()
+    lines = reader.iter_lines()
+    next(records)
+    _, _, line = next(lines)
+
+    reader.close()
+
+    with pytest.raises(ValueError):
+        line.tobytes()  # Released
+    assert list(records) == []
+    assert list(lines) == []
@@ -0,0 +1,105 @@
+"""Test coalescing bursts of returns from one user into one transaction."""
+import threading
+import time
+from datetime import timedelta
+
+from topanga_queries.bootstrap.db import generate_rental_record
+from topanga_queries.bootstrap.events import REFERENCE_NOW
+from topanga_queries.rentals import RENTAL_COLUMNS
+from rental_return_events.coalescer import EventCoalescer
+from rental_return_events.metrics import metrics
+from rental_return_events.processor import process_rental_return
+from perf import return_event
+
+
+def seed_burst(connection):
+    """Adds user tpg_u0009 with clamshell and bowl rentals of different ages, one expired."""
+    connection.execute("INSERT INTO users VALUES ('tpg_u0009', 'Burst');")
+    connection.executemany(
+        f"INSERT INTO rentals({RENTAL_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);", [
+            generate_rental_record(rental_id, "tpg_u0009", asset_id, "topanga-location-01",
+                                   REFERENCE_NOW - timedelta(days=age), days, "IN_PROGRESS")
+            for rental_id, asset_id, age, days in [
+                ("burst-c1", "tpg_a00001", 5, 10), ("burst-c2", "tpg_a00006", 4, 10),
+                ("burst-b1", "tpg_a00002", 3, 10), ("burst-x1", "tpg_a00001", 12, 1)]])
+    connection.commit()
+
+
+def run_coalescer(coalescer, events):
+    """Submits the events, then processes them all on this thread."""
+    futures = [coalescer.submit(event) for event in events]
+    coalescer.shutdown()
+    coalescer.run()
+    return [future.result() for future in futures]
+
+
+BURST = [return_event("tpg_u0009", asset_id) for asset_id in (
+    "tpg_a00001", "tpg_a00002", "tpg_a00500", "tpg_a00011", "tpg_a00001", "tpg_a00001")]
+
+
+def test_coalesced_matches_sequential(refresh_test_db, template_db, monkeypatch):
+    """Test a burst gets the responses sequential processing gives, in one commit."""
+
+    monkeypatch.setenv("TOPANGA_OUTBOX_FAILURES", "on")
+    seed_burst(refresh_test_db)
+    sequential = [process_rental_return(event) for event in BURST]
+
+    template_db.backup(refresh_test_db)
+    seed_burst(refresh_test_db)
+    statements = []
+    refresh_test_db.set_trace_callback(statements.append)
+    coalesced = run_coalescer(EventCoalescer(window=10), BURST)
+    refresh_test_db.set_trace_callback(None)
+
+    assert coalesced == sequential
+    assert [r["rental_id"] for r in coalesced[:2]] == ["burst-c1", "burst-b1"]
+    assert coalesced[2]["error_code"] == "ASSET_NOT_FOUND"
+    assert statements.count("COMMIT") == 1
+    assert refresh_test_db.execute(
+        "SELECT COUNT(*) FROM outbox;").fetchone()[0] == len(BURST)
+
+
+def test_groups_per_location_and_user(refresh_test_db):
+    """Test groups split by location, keep a user's order, and cap their size."""
+
+    seed_burst(refresh_test_db)
+    metrics.reset()
+    events = [
+        {**BURST[0], "location_id": "topanga-location-02"},
+        {**BURST[1], "location_id": "topanga-location-03"},  # Closes the first group
+        {**BURST[3], "location_id": "topanga-location-02"},
+        {"timestamp": "not a time"},  # Answered on its own
+        return_event("tpg_u0001", "tpg_a00001"),
+        return_event("tpg_u0001", "tpg_a00001"),  # Fills its group
+    ]
+
+    responses = run_coalescer(EventCoalescer(window=10, max_events=2), events)
+
+    assert [r["rental_id"] for r in responses[:3]] == ["burst-c1", "burst-b1", "burst-c2"]
+    assert [r["status"] for r in responses[3:]] == ["FAILED", "SUCCESS", "FAILED"]
+    assert metrics.snapshot()["counters"]["coalescer.groups"] == 4
+    assert metrics.snapshot()["counters"]["coalescer.events"] == 5
+
+
+def test_window_closes_group(refresh_test_db):
+    """Test events after the window start a new group, processed as they arrive."""
+
+    seed_burst(refresh_test_db)
+    metrics.reset()
+    coalescer = EventCoalescer(window=0.05)
+    futures = []
+
+    def kiosk():
+        futures.extend(coalescer.submit(event) for event in BURST[:2])
+        time.sleep(0.2)
+        futures.append(coalescer.submit(BURST[3]))
+        coalescer.shutdown()
+
+    thread = threading.Thread(target=kiosk)
+    thread.start()
+    coalescer.run()
+    thread.join()
+
+    assert [future.result()["rental_id"] for future in futures] == [
+        "burst-c1", "burst-b1", "burst-c2"]
+    assert metrics.snapshot()["counters"]["coalescer.groups"] == 2
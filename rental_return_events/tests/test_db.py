@@ -1,6 +1,21 @@
 """Tests for the database connection and schema."""
+import sqlite3
+import sys
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+
 import pytest
 
+from topanga_queries import reset_db_connection
+from topanga_queries.bootstrap.db import generate_rental_record, init_tables
+from topanga_queries.migrations import (MIGRATIONS, SCHEMA_VERSION, canonical_asset_types_sql,
+    check_schema_version, dry_run_migrations, get_schema_version, migrate_eligibility_groups,
+    migrate_epoch_ms_rounding, migrate_epoch_timestamps, run_migrations)
+from topanga_queries.rentals import (ACCEPTS_ASSET_TYPE, NOT_EXPIRED, RENTAL_COLUMNS,
+    RENTAL_SELECT, find_oldest_eligible_rental, iter_rentals_for_user, list_rentals_for_user,
+    to_epoch_ms)
+from rental_return_events.main import main
+
 def test_db_connection(refresh_test_db):
     """Test if the database connection can be established."""
 
@@ -37,7 +52,8 @@ def test_table_schema(refresh_test_db):
         "assets": {"id", "asset_type"},
         "rentals": {
             "id", "user_id", "asset_id", "created_at_location_id", "created_at",
-            "expires_at", "status", "eligible_asset_types", "returned_at_location_id", "returned_at"
+            "expires_at", "status", "eligible_asset_types", "returned_at_location_id", "returned_at",
+            "created_at_ms", "expires_at_ms", "returned_at_ms", "eligible_group_id"
         },
     }
 
@@ -48,3 +64,223 @@ def test_table_schema(refresh_test_db):
         assert expected_columns == actual_columns, f"Table `{table}` schema mismatch!"
 
     cur.close()
+
+
+def test_epoch_columns_backfilled(refresh_test_db):
+    """Test the epoch migration backfills rows and tracks new writes."""
+
+    cur = refresh_test_db.cursor()
+    cur.execute("UPDATE rentals SET created_at_ms = NULL, expires_at_ms = NULL;")
+    refresh_test_db.commit()
+
+    migrate_epoch_timestamps(cur, chunk_size=3)
+
+    cur.execute("SELECT created_at, created_at_ms, expires_at, expires_at_ms FROM rentals;")
+    for created_at, created_at_ms, expires_at, expires_at_ms in cur.fetchall():
+        assert created_at_ms == to_epoch_ms(datetime.fromisoformat(created_at))
+        assert expires_at_ms == to_epoch_ms(datetime.fromisoformat(expires_at))
+
+    # Writes keep the epoch columns in step, whatever the UTC offset
+    cur.execute("UPDATE rentals SET returned_at = '2025-02-10T13:00:00.250+02:00';")
+    cur.execute("SELECT DISTINCT returned_at_ms FROM rentals;")
+    assert cur.fetchall() == [(to_epoch_ms(datetime(2025, 2, 10, 11, 0, 0, 250000, timezone.utc)),)]
+    cur.close()
+
+
+@pytest.mark.parametrize("returned_at", [
+    "2025-02-10T11:00:00.9999+00:00",  # Rounds up to the next second
+    "2025-02-10T11:59:59.9996+00:00",  # And to the next hour
+    "2025-02-10T11:00:00.0005+00:00",  # Half a millisecond rounds up
+    "2025-02-10T11:00:00.123456+00:00",
+])
+def test_sub_millisecond_epoch(refresh_test_db, returned_at):
+    """Test SQL and Python agree on epoch milliseconds of sub-millisecond times."""
+
+    expected = to_epoch_ms(datetime.fromisoformat(returned_at))
+    assert expected % 1000 in (0, 1, 123)
+
+    refresh_test_db.execute("UPDATE rentals SET returned_at = ?;", (returned_at,))
+    assert refresh_test_db.execute(
+        "SELECT DISTINCT returned_at_ms FROM rentals;").fetchall() == [(expected,)]
+
+    # Values written before the rounding fix are recomputed by its migration
+    refresh_test_db.execute("UPDATE rentals SET returned_at_ms = returned_at_ms - 1;")
+    refresh_test_db.commit()
+    migrate_epoch_ms_rounding(refresh_test_db.cursor(), chunk_size=2)
+    assert refresh_test_db.execute(
+        "SELECT DISTINCT returned_at_ms FROM rentals;").fetchall() == [(expected,)]
+
+
+def test_eligibility_groups_migrated(refresh_test_db):
+    """Test JSON eligibility is normalised into shared asset type groups."""
+
+    cur = refresh_test_db.cursor()
+    cur.execute("""
+                UPDATE rentals SET eligible_asset_types = '["clamshell", "3-compartment"]'
+                WHERE eligible_asset_types = '["3-compartment", "clamshell"]';
+                """)
+    cur.execute("UPDATE rentals SET eligible_group_id = NULL;")
+    refresh_test_db.commit()
+
+    migrate_eligibility_groups(cur, chunk_size=3)
+
+    cur.execute("""
+                SELECT DISTINCT asset_type_groups.asset_types
+                FROM rentals JOIN asset_type_groups ON asset_type_groups.id = eligible_group_id;
+                """)
+    assert sorted(cur.fetchall()) == [
+        ('["3-compartment","clamshell"]',), ('["large-bowl","small-bowl"]',)]
+
+    for asset_types, key in [('["b", "a", "b"]', '["a","b"]'), ("[]", "[]")]:
+        cur.execute(f"SELECT {canonical_asset_types_sql('?')};", (asset_types,))
+        assert cur.fetchone() == (key,)
+    cur.close()
+
+
+def test_oldest_eligible_rental_query_plan(refresh_test_db):
+    """Test the oldest eligible rental lookup is driven by one index."""
+
+    cur = refresh_test_db.cursor()
+    cur.execute(f"""
+                EXPLAIN QUERY PLAN {RENTAL_SELECT}
+                WHERE user_id = ? AND status = 'IN_PROGRESS' AND {NOT_EXPIRED}
+                AND {ACCEPTS_ASSET_TYPE}
+                ORDER BY created_at_ms LIMIT 1
+                """, ("tpg_u0001", 0, "clamshell"))
+    plan = " | ".join(row[3] for row in cur.fetchall())
+    cur.close()
+
+    assert "rentals_user_id_status_created_at_ms_group" in plan
+    assert "TEMP B-TREE" not in plan
+
+    rental = find_oldest_eligible_rental(
+        "tpg_u0001", "clamshell", datetime(2025, 2, 10, tzinfo=timezone.utc))
+    assert rental.asset_id == "tpg_a00001"
+
+
+def test_iter_rentals_for_user(refresh_test_db):
+    """Test rentals stream oldest first in chunks, filtered in SQL, and can stop early."""
+
+    created_at = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    refresh_test_db.executemany(
+        f"INSERT INTO rentals({RENTAL_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+        [generate_rental_record(f"h{n:02}", "tpg_u0002", "tpg_a00001", "topanga-location-01",
+                                created_at + timedelta(hours=n), 60,
+                                "COMPLETED" if n % 3 else "IN_PROGRESS")
+         for n in range(30)])
+    refresh_test_db.commit()
+
+    rentals = list(iter_rentals_for_user("tpg_u0002", chunk_size=4))
+    assert sorted(rentals, key=lambda r: r.id) == sorted(
+        list_rentals_for_user("tpg_u0002"), key=lambda r: r.id)
+    assert [r.created_at_ms for r in rentals] == sorted(r.created_at_ms for r in rentals)
+    assert len(rentals) == 30 + len([r for r in rentals if not r.id.startswith("h")])
+
+    in_progress = iter_rentals_for_user(
+        "tpg_u0002", "IN_PROGRESS", as_of=created_at, asset_type="clamshell", chunk_size=4)
+    assert [r.id for r in islice(in_progress, 3)] == ["h00", "h03", "h06"]
+    in_progress.close()
+
+    plan = " | ".join(row[3] for row in refresh_test_db.execute(
+        f"EXPLAIN QUERY PLAN {RENTAL_SELECT} WHERE user_id = ? ORDER BY created_at_ms;",
+        ("tpg_u0002",)))
+    assert "rentals_user_id_created_at_ms" in plan and "TEMP B-TREE" not in plan
+
+    # h00 expires at 2025-03-02T00:00, h03 three hours later
+    assert next(iter_rentals_for_user("tpg_u0002", "IN_PROGRESS", as_of=datetime(
+        2025, 3, 2, 1, tzinfo=timezone.utc))).id == "h03"
+
+
+def test_schema_version(refresh_test_db):
+    """Test bootstrap records the schema version and the check is cached."""
+
+    assert get_schema_version(refresh_test_db) == SCHEMA_VERSION
+    assert check_schema_version() == SCHEMA_VERSION
+
+    refresh_test_db.execute("PRAGMA user_version = 1;")
+    assert check_schema_version() == SCHEMA_VERSION  # Cached for this connection
+
+    connection = reset_db_connection()
+    with pytest.raises(ValueError, match="older than"):
+        check_schema_version(connection)
+
+
+def create_unmigrated_db(path):
+    """Creates a database with the original schema and one rental."""
+    connection = sqlite3.connect(path)
+    cur = connection.cursor()
+    init_tables(cur)
+    cur.execute("INSERT INTO rentals VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);", generate_rental_record(
+        "r1", "tpg_u0001", "tpg_a00001", "topanga-location-01",
+        datetime(2025, 2, 5, 12, tzinfo=timezone.utc), 10, "IN_PROGRESS"))
+    connection.commit()
+    cur.close()
+    return connection
+
+
+def test_schema_version_hints(tmp_path):
+    """Test an unversioned database with tables is told to migrate, an empty one to initialize."""
+
+    legacy = create_unmigrated_db(tmp_path / "legacy.db")
+    with pytest.raises(ValueError, match="run migrate-db"):
+        check_schema_version(legacy)
+    legacy.close()
+
+    empty = sqlite3.connect(tmp_path / "empty.db")
+    with pytest.raises(ValueError, match="not initialized"):
+        check_schema_version(empty)
+    empty.close()
+
+
+def test_cli_hints_migration(refresh_test_db, monkeypatch, capsys):
+    """Test the CLI tells an older database with records to migrate, not to bootstrap."""
+
+    refresh_test_db.execute("PRAGMA user_version = 0;")
+    reset_db_connection()
+    monkeypatch.setattr(sys, "argv", ["main.py", "event_01.json"])
+
+    with pytest.raises(SystemExit):
+        main()
+
+    output = capsys.readouterr().out
+    assert "schema version 0 is older than" in output
+    assert "Migrate with: migrate-db" in output
+    assert "bootstrap" not in output
+
+
+def test_run_migrations(tmp_path):
+    """Test pending migrations are applied in order, recorded, and only once."""
+
+    connection = create_unmigrated_db(tmp_path / "old.db")
+
+    results = run_migrations(connection, chunk_size=1)
+
+    assert [result.version for result in results] == [m.version for m in MIGRATIONS]
+    assert get_schema_version(connection) == SCHEMA_VERSION
+    assert connection.execute(
+        "SELECT version FROM schema_migrations ORDER BY version;").fetchall() == [
+            (m.version,) for m in MIGRATIONS]
+    assert connection.execute(
+        "SELECT expires_at_ms IS NOT NULL, eligible_group_id IS NOT NULL FROM rentals;"
+    ).fetchall() == [(1, 1)]
+
+    assert run_migrations(connection) == []
+    connection.close()
+
+
+def test_dry_run_migrations(tmp_path):
+    """Test a dry run migrates a copy and leaves the database untouched."""
+
+    connection = create_unmigrated_db(tmp_path / "old.db")
+
+    results = dry_run_migrations(connection, copy_path=str(tmp_path / "copy.db"))
+
+    assert len(results) == len(MIGRATIONS)
+    assert get_schema_version(connection) == 0
+    assert "expires_at_ms" not in {
+        row[1] for row in connection.execute("PRAGMA table_info(rentals);")}
+
+    copy = sqlite3.connect(tmp_path / "copy.db")
+    assert get_schema_version(copy) == SCHEMA_VERSION
+    copy.close()
+    connection.close()
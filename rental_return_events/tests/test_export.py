@@ -0,0 +1,120 @@
+"""Test the columnar export of the rentals table."""
+import ast
+import sqlite3
+import zipfile
+from array import array
+
+import pytest
+
+from topanga_queries import get_db_path
+from topanga_queries import export
+from topanga_queries.export import export_npz, export_rentals, pyarrow_available
+
+
+def read_npy(archive, name):
+    """Reads a one dimensional `.npy` array from an archive without numpy."""
+    data = archive.read(f"{name}.npy")
+    assert data[:8] == b"\x93NUMPY\x01\x00"
+    header_length = int.from_bytes(data[8:10], "little")
+    header = ast.literal_eval(data[10:10 + header_length].decode("latin1"))
+    body = data[10 + header_length:]
+    assert (10 + header_length) % 64 == 0
+
+    descr = header["descr"]
+    if descr.startswith("|S"):
+        width = int(descr[2:])
+        values = [body[i:i + width].rstrip(b"\0").decode("utf-8")
+                  for i in range(0, len(body), width)]
+    else:
+        values = array({4: "i", 8: "q"}[int(descr[2:])])
+        values.frombytes(body)
+        values = values.tolist()
+
+    assert len(values) == header["shape"][0]
+    return values
+
+
+def test_export_npz(refresh_test_db, tmp_path):
+    """Test the NPZ export decodes back to the rentals table."""
+
+    path = str(tmp_path / "rentals.npz")
+    result = export_rentals(path, "npz", chunk_size=7)
+
+    rentals = refresh_test_db.execute("""
+        SELECT rentals.id, status, returned_at_location_id, asset_type,
+               created_at_ms, COALESCE(returned_at_ms, -1)
+        FROM rentals LEFT JOIN assets ON assets.id = rentals.asset_id
+        ORDER BY rentals.rowid;
+    """).fetchall()
+
+    assert result.rows == len(rentals)
+    assert result.chunks == -(-len(rentals) // 7)
+    assert result.rows_per_second > 0
+
+    with zipfile.ZipFile(path) as archive:
+        statuses = read_npy(archive, "status_dictionary")
+        locations = read_npy(archive, "returned_at_location_id_dictionary")
+        asset_types = read_npy(archive, "asset_type_dictionary")
+        exported = list(zip(
+            read_npy(archive, "id"),
+            [statuses[code] for code in read_npy(archive, "status")],
+            [locations[code] if code >= 0 else None
+             for code in read_npy(archive, "returned_at_location_id")],
+            [asset_types[code] for code in read_npy(archive, "asset_type")],
+            read_npy(archive, "created_at_ms"),
+            read_npy(archive, "returned_at_ms"),
+        ))
+
+    assert exported == rentals
+
+
+def test_export_format_checks(tmp_path):
+    """Test unknown formats, and Parquet without pyarrow, are rejected."""
+
+    with pytest.raises(ValueError):
+        export_rentals(str(tmp_path / "rentals.csv"), "csv")
+
+    if not pyarrow_available():
+        with pytest.raises(ValueError):
+            export_rentals(str(tmp_path / "rentals.parquet"), "parquet")
+        assert export_rentals(str(tmp_path / "rentals.npz")).output_format == "npz"
+
+
+def test_export_reads_one_snapshot(refresh_test_db, tmp_path, monkeypatch):
+    """Test a longer row committed mid-export is left out rather than overflowing its column."""
+
+    string_widths = export._string_widths
+
+    def commit_longer_row(connection):
+        widths = string_widths(connection)
+        refresh_test_db.execute(
+            "INSERT INTO rentals SELECT 'a-much-longer-rental-id-than-any-other', user_id, "
+            "asset_id, created_at_location_id, created_at, expires_at, status, "
+            "eligible_asset_types, returned_at_location_id, returned_at, created_at_ms, "
+            "expires_at_ms, returned_at_ms, eligible_group_id FROM rentals LIMIT 1;")
+        refresh_test_db.commit()
+        return widths
+
+    monkeypatch.setattr(export, "_string_widths", commit_longer_row)
+    rows = refresh_test_db.execute("SELECT COUNT(*) FROM rentals;").fetchone()[0]
+    reader = sqlite3.connect(get_db_path())
+
+    assert export_npz(str(tmp_path / "rentals.npz"), chunk_size=3, connection=reader)[0] == rows
+    with zipfile.ZipFile(tmp_path / "rentals.npz") as archive:
+        assert len(read_npy(archive, "id")) == rows
+    reader.close()
+
+
+def test_export_parquet(refresh_test_db, tmp_path):
+    """Test the Parquet export reads back as the rentals table."""
+    pq = pytest.importorskip("pyarrow.parquet")
+
+    path = str(tmp_path / "rentals.parquet")
+    result = export_rentals(path, "parquet", chunk_size=7)
+
+    rentals = refresh_test_db.execute(
+        "SELECT id, status, created_at_ms FROM rentals ORDER BY rowid;").fetchall()
+    table = pq.read_table(path).to_pydict()
+
+    assert result.rows == len(rentals)
+    assert list(zip(table["id"], table["status"], table["created_at_ms"])) == rentals
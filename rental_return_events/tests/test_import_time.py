@@ -0,0 +1,54 @@
+"""Test importing the service is cheap and side-effect free."""
+import os
+import subprocess
+import sys
+
+import pytest
+
+from perf import PERF_ATTEMPTS, calibration_seconds, get_perf_mode
+
+# Cumulative import time budget for the processor, in microseconds, on a
+# machine where `calibration_seconds()` takes BUDGET_CALIBRATION_SECONDS
+IMPORT_BUDGET_US = 150_000
+BUDGET_CALIBRATION_SECONDS = 0.001
+
+
+def import_times(module, cwd):
+    """Imports `module` in a fresh interpreter and returns `-X importtime` results."""
+    env = dict(os.environ, TOPANGA_DB_PATH=os.path.join(cwd, "lazy.db"))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd, env=env, capture_output=True, text=True, check=True)
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_import_does_no_io(tmp_path):
+    """Test importing the processor opens no database and creates no files."""
+
+    times = import_times("rental_return_events.processor", str(tmp_path))
+
+    assert "rental_return_events.processor" in times
+    assert "sqlite3" not in times
+    assert "tabulate" not in times
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.mark.skipif(get_perf_mode() != "compare",
+                    reason="set TOPANGA_PERF=compare to check the import budget")
+def test_import_time_budget(tmp_path):
+    """Test the processor imports within the cold start budget, scaled to this machine."""
+
+    budget = IMPORT_BUDGET_US * calibration_seconds() / BUDGET_CALIBRATION_SECONDS
+    fastest = min(
+        import_times("rental_return_events.processor", str(tmp_path))[
+            "rental_return_events.processor"]
+        for _ in range(PERF_ATTEMPTS))
+
+    assert fastest < budget
@@ -0,0 +1,91 @@
+"""Test the load generator and soak test harness."""
+import os
+
+from topanga_queries import get_connection
+
+from rental_return_events.loadgen import (EXPECTED_STATUS, CliDriver, EventGenerator,
+    InProcessDriver, delete_load_rentals, parse_mix, run_load, seed_load_rentals)
+
+
+def test_generator_falls_back_when_rentals_run_out():
+    """Test returns stop once every seeded rental is used, then duplicates follow."""
+
+    pool = seed_load_rentals(users=2, rentals_per_user=2, expired_users=0)
+    generator = EventGenerator(pool, parse_mix("return=1"), seed=1)
+
+    returns = [generator.next_event() for _ in range(4)]
+    # Not sent again before the original is processed
+    assert generator.next_event()[0] == "invalid_qr"
+    for _, event in returns:
+        generator.processed(event)
+    kinds = [generator.next_event()[0] for _ in range(4)]
+
+    assert [kind for kind, _ in returns] == ["return"] * 4
+    assert set(kinds) == {"duplicate"}
+    assert all(remaining == 0 for _, remaining in pool.returnable.values())
+
+
+def test_run_load_in_process():
+    """Test a short run processes the mix with the expected statuses and reports windows."""
+
+    pool = seed_load_rentals(users=50, rentals_per_user=2, expired_users=5)
+    windows = []
+
+    report = run_load(InProcessDriver(), EventGenerator(pool, seed=1), kiosks=3,
+                      rates=[40.0], step_duration=1.0, report_every=0.25,
+                      on_window=windows.append)
+
+    [step] = report["steps"]
+
+    assert step["processed"] > 0
+    assert step["processed"] + step["backlog"] == step["emitted"]
+    assert step["errors"] == 0
+    for kind, statuses in step["by_kind"].items():
+        assert list(statuses) == [EXPECTED_STATUS[kind]]
+    assert windows == step["windows"] and len(windows) >= 4
+    assert step["db_bytes"] > 0
+    assert report["saturated_at_rate"] is None
+
+
+def test_run_load_drains_outbox(monkeypatch):
+    """Test responses left in the outbox are not counted in the database growth."""
+
+    monkeypatch.setenv("TOPANGA_OUTBOX_FAILURES", "on")
+    pool = seed_load_rentals(users=50, rentals_per_user=2, expired_users=5)
+
+    report = run_load(InProcessDriver(), EventGenerator(pool, seed=1), kiosks=3,
+                      rates=[40.0], step_duration=0.5, drain=True)
+
+    assert report["steps"][0]["processed"] > 0
+    assert get_connection().execute("SELECT COUNT(*) FROM outbox;").fetchone() == (0,)
+
+
+def test_delete_load_rentals():
+    """Test the seeded users and rentals of a run are deleted, others are kept."""
+
+    pool = seed_load_rentals(users=3, rentals_per_user=2, expired_users=1)
+    other = seed_load_rentals(users=1, rentals_per_user=1, expired_users=0)
+    connection = get_connection()
+
+    def seeded(run_id):
+        return (
+            connection.execute("SELECT COUNT(*) FROM users WHERE id GLOB ?;",
+                               (f"load_{run_id}_*",)).fetchone()[0],
+            connection.execute("SELECT COUNT(*) FROM rentals WHERE id GLOB ?;",
+                               (f"load-{run_id}-*",)).fetchone()[0],
+        )
+
+    delete_load_rentals(pool)
+
+    assert seeded(pool.run_id) == (0, 0)
+    assert seeded(other.run_id) == (1, 1)
+
+
+def test_cli_driver_removes_its_directory():
+    """Test the event file directory is removed when the driver is closed."""
+
+    with CliDriver(workers=2) as driver:
+        directory = driver.directory
+        assert os.path.isdir(directory)
+
+    assert not os.path.exists(directory)
@@ -0,0 +1,77 @@
+"""Test the incrementally maintained per-location return statistics."""
+from datetime import datetime, timedelta, timezone
+
+from topanga_queries.rentals import get_rental
+from topanga_queries.stats import get_in_progress_counts, list_return_stats, rebuild_location_stats
+from rental_return_events.processor import process_rental_return
+
+
+def stats_snapshot():
+    """Returns the current return stats and in-progress counts."""
+    return list_return_stats(), get_in_progress_counts()
+
+
+def test_stats_match_group_by(refresh_test_db):
+    """Test the trigger-maintained stats equal an ad-hoc GROUP BY over rentals."""
+
+    in_progress = dict(refresh_test_db.execute("""
+        SELECT created_at_location_id, COUNT(*) FROM rentals
+        WHERE status = 'IN_PROGRESS' GROUP BY 1;
+    """).fetchall())
+    returns = refresh_test_db.execute("""
+        SELECT COUNT(*) FROM rentals
+        WHERE status != 'IN_PROGRESS' AND returned_at_location_id IS NOT NULL;
+    """).fetchone()[0]
+
+    assert get_in_progress_counts() == in_progress
+    assert sum(row.returns for row in list_return_stats()) == returns
+
+
+def test_stats_updated_with_completion(load_event):
+    """Test completing a rental moves it from in progress to returns in one step."""
+
+    before_returns, before_in_progress = stats_snapshot()
+    response = process_rental_return(load_event("event_01.json"))
+    rental = get_rental(response["rental_id"])
+
+    returned_at = datetime.fromisoformat(rental.returned_at).astimezone(timezone.utc)
+    hour = returned_at.replace(minute=0, second=0, microsecond=0)
+    [row] = list_return_stats(rental.returned_at_location_id, since=hour,
+                              until=hour + timedelta(hours=1))
+    previous = {(r.location_id, r.hour, r.asset_type): r.returns for r in before_returns}
+
+    assert row.hour == hour
+    assert row.returns == previous.get((row.location_id, row.hour, row.asset_type), 0) + 1
+    assert get_in_progress_counts().get(rental.created_at_location_id, 0) == \
+        before_in_progress[rental.created_at_location_id] - 1
+
+    # Incremental maintenance and a rebuild from scratch agree
+    after = stats_snapshot()
+    rebuild_location_stats()
+    assert stats_snapshot() == after
+
+
+def test_return_without_time_not_counted(refresh_test_db):
+    """Test a rental returned without a valid time is written, and left out of the stats."""
+
+    def totals():
+        returns, in_progress = stats_snapshot()
+        return sum(row.returns for row in returns), sum(in_progress.values())
+
+    before = totals()
+    refresh_test_db.execute("""
+        UPDATE rentals SET status = 'COMPLETED', returned_at = NULL,
+            returned_at_location_id = 'topanga-location-02'
+        WHERE id = (SELECT id FROM rentals WHERE status = 'IN_PROGRESS' LIMIT 1);
+    """)
+    refresh_test_db.execute("""
+        UPDATE rentals SET returned_at = 'not a time'
+        WHERE id = (SELECT id FROM rentals WHERE status = 'COMPLETED'
+                    AND returned_at IS NOT NULL AND returned_at_location_id IS NOT NULL LIMIT 1);
+    """)
+    refresh_test_db.commit()
+
+    assert totals() == (before[0] - 1, before[1] - 1)
+    after = stats_snapshot()
+    rebuild_location_stats()
+    assert stats_snapshot() == after
@@ -0,0 +1,109 @@
+"""Test the in-memory membership filters for user and asset ids."""
+import time
+
+from topanga_queries import membership
+from topanga_queries.bootstrap.events import encode_qr
+from topanga_queries.membership import (BloomFilter, IdFilter, bloom_memory_bytes,
+    get_id_filter, invalidate_id_filters, may_exist)
+from rental_return_events.processor import process_rental_return
+from rental_return_events.metrics import metrics
+
+
+def test_bloom_filter():
+    """Test added ids are always found and few others are, at the reported size."""
+
+    bloom = BloomFilter(10_000, 0.01)
+    for n in range(10_000):
+        bloom.add(f"tpg_u{n:07}")
+
+    assert all(f"tpg_u{n:07}" in bloom for n in range(10_000))
+    false_positives = sum(f"tpg_x{n:07}" in bloom for n in range(10_000))
+    assert false_positives < 200
+    assert bloom.memory_bytes == bloom_memory_bytes(10_000, 0.01)
+    assert bloom_memory_bytes(10_000_000) == 11_981_323  # 11.4 MiB
+
+
+def test_filter_refreshed(refresh_test_db):
+    """Test ids inserted after the filter is built are found, also in a reused rowid."""
+
+    assert may_exist("users", "tpg_u0001")
+    assert not may_exist("users", "tpg_u9001")
+
+    refresh_test_db.execute("INSERT INTO users VALUES ('tpg_u9001', 'New');")
+    refresh_test_db.commit()
+    invalidate_id_filters()
+    assert may_exist("users", "tpg_u9001")
+
+    # SQLite gives the deleted newest row's rowid to the next insert
+    refresh_test_db.execute("DELETE FROM users WHERE id = 'tpg_u9001';")
+    refresh_test_db.execute("INSERT INTO users VALUES ('tpg_u9002', 'Newer');")
+    refresh_test_db.commit()
+    invalidate_id_filters()
+    assert may_exist("users", "tpg_u9002")
+    assert get_id_filter("users").bloom.count == 6
+
+
+def test_unknown_ids_rejected_without_query(refresh_test_db, load_event):
+    """Test events for unknown assets and users read no table before failing."""
+
+    metrics.reset()
+    may_exist("users", "tpg_u0001")
+    may_exist("assets", "tpg_a00001")
+    statements = []
+    refresh_test_db.set_trace_callback(statements.append)
+
+    response = process_rental_return(load_event("event_03.json"))  # Unknown asset
+
+    refresh_test_db.set_trace_callback(None)
+    assert response["error_code"] == "ASSET_NOT_FOUND"
+    assert not [s for s in statements if s.lstrip().upper().startswith("SELECT")]
+    assert metrics.snapshot()["counters"]["membership.assets.rejected"] == 1
+
+    event = {**load_event("event_01.json"), "user_qr_data": encode_qr("tpg_u9001")}
+    response = process_rental_return(event)
+    assert response["message"] == "No active rentals found for user tpg_u9001"
+    assert metrics.snapshot()["counters"]["membership.users.rejected"] == 1
+
+
+def test_filter_refreshed_on_timer(refresh_test_db, monkeypatch):
+    """Test a miss refreshes only once the refresh interval has passed."""
+
+    id_filter = IdFilter("users", refresh_seconds=60)
+    assert "tpg_u0001" in id_filter
+    refresh_test_db.execute("INSERT INTO users VALUES ('tpg_u9001', 'New');")
+    refresh_test_db.commit()
+
+    assert "tpg_u9001" not in id_filter  # Refreshed less than a minute ago
+
+    now = time.monotonic()
+    monkeypatch.setattr(membership.time, "monotonic", lambda: now + 60)
+    assert "tpg_u9001" in id_filter
+
+
+def test_unknown_ids_between_returns_skip_database(refresh_test_db, load_event):
+    """Test unknown ids are rejected without touching the database, also after commits.
+
+    An unknown user's event still looks up its asset, to tell a missing
+    asset from a missing rental, and runs nothing else.
+    """
+
+    unknown = [
+        load_event("event_03.json"),  # Unknown asset
+        {**load_event("event_01.json"), "user_qr_data": encode_qr("tpg_u9001")},
+    ]
+    statements = []
+
+    def trace(statement):
+        if statement != "SELECT * FROM assets WHERE id = 'tpg_a00001'":
+            statements.append(statement)
+
+    for event in (load_event("event_01.json"), load_event("event_02.json")):
+        assert process_rental_return(event)["status"] == "SUCCESS"
+
+        refresh_test_db.set_trace_callback(trace)
+        for _ in range(3):
+            for unknown_event in unknown:
+                assert process_rental_return(unknown_event)["status"] == "FAILED"
+        refresh_test_db.set_trace_callback(None)
+
+    assert not statements
@@ -0,0 +1,99 @@
+"""Test running against a shared-cache in-memory database."""
+import os
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import topanga_queries
+from topanga_queries import flush_to_disk, get_db_path, get_read_connection, reset_db_connection
+from topanga_queries.rentals import complete_rental, get_rental, list_rentals_for_user
+
+
+def disk_status(rental_id):
+    """Reads a rental status straight from the database file."""
+    connection = sqlite3.connect(get_db_path())
+    try:
+        return connection.execute(
+            "SELECT status FROM rentals WHERE id = ?;", (rental_id,)).fetchone()[0]
+    finally:
+        connection.close()
+
+
+@pytest.fixture
+def memory_storage(monkeypatch):
+    """Switches `topanga_queries` to in-memory storage for one test."""
+    monkeypatch.setenv("TOPANGA_STORAGE", "memory")
+    yield reset_db_connection()
+    monkeypatch.undo()
+    reset_db_connection()
+
+
+def test_memory_storage_flushed_to_disk(memory_storage, monkeypatch):
+    """Test the in-memory database is seeded from disk and only written back on flush."""
+
+    rental = list_rentals_for_user("tpg_u0003")[0]
+    complete_rental(rental.id, "COMPLETED", "2025-02-10T12:00:00+00:00", "topanga-location-01")
+
+    monkeypatch.setenv("TOPANGA_READ_MODE", "ro")
+    assert get_read_connection() is not memory_storage
+    assert get_rental(rental.id).status == "COMPLETED"
+    assert disk_status(rental.id) == "IN_PROGRESS"
+
+    assert flush_to_disk()
+    assert disk_status(rental.id) == "COMPLETED"
+    assert not os.path.exists(f"{get_db_path()}.tmp")  # Moved into place
+
+
+def test_reset_flushes_memory_storage(memory_storage):
+    """Test reconnecting writes the in-memory database back before closing it."""
+
+    rental = list_rentals_for_user("tpg_u0003")[0]
+    complete_rental(rental.id, "COMPLETED", "2025-02-10T12:00:00+00:00", "topanga-location-01")
+
+    reset_db_connection()
+
+    assert disk_status(rental.id) == "COMPLETED"
+
+
+def test_periodic_flush(monkeypatch):
+    """Test the flush thread writes committed changes back to disk."""
+
+    monkeypatch.setenv("TOPANGA_STORAGE", "memory")
+    monkeypatch.setenv("TOPANGA_FLUSH_INTERVAL", "0.05")
+    reset_db_connection()
+    try:
+        rental = list_rentals_for_user("tpg_u0003")[0]
+        complete_rental(rental.id, "COMPLETED", "2025-02-10T12:00:00+00:00",
+                        "topanga-location-01")
+
+        deadline = time.monotonic() + 5
+        while disk_status(rental.id) != "COMPLETED" and time.monotonic() < deadline:
+            time.sleep(0.02)
+
+        assert disk_status(rental.id) == "COMPLETED"
+    finally:
+        monkeypatch.undo()
+        reset_db_connection()
+
+
+def test_flush_thread_registered_at_exit_once(monkeypatch):
+    """Test restarting the flush thread does not add exit handlers."""
+
+    handlers = []
+    monkeypatch.setattr(topanga_queries, "atexit", SimpleNamespace(
+        register=handlers.append,
+        unregister=lambda func: handlers.remove(func) if func in handlers else None))
+    monkeypatch.setenv("TOPANGA_STORAGE", "memory")
+    monkeypatch.setenv("TOPANGA_FLUSH_INTERVAL", "60")
+    try:
+        for _ in range(3):
+            reset_db_connection()
+            assert topanga_queries._flush_thread.is_alive()
+
+        assert handlers.count(topanga_queries._flush_stop.set) == 1
+        assert handlers.count(flush_to_disk) == 1
+    finally:
+        monkeypatch.undo()
+        reset_db_connection()
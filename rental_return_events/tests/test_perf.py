@@ -0,0 +1,130 @@
+"""Performance regression tests for the rental return hot paths.
+
+Skipped unless `TOPANGA_PERF` is set, see `perf.py`.
+"""
+import json
+import sqlite3
+
+import pytest
+
+from topanga_queries.rentals import RENTAL_SELECT, Rental, to_epoch_ms
+from topanga_queries.bootstrap.events import REFERENCE_NOW
+from rental_return_events.handler import parse_return_event
+from rental_return_events.processor import (active_eligible_rentals, find_oldest_rental_from,
+    finalize_rental_return, process_rental_return)
+from rental_return_events.response import (ErrorCode, create_failure_response,
+    create_success_response, serialize_response)
+from perf import (PERF_ATTEMPTS, PERF_REPEATS, PERF_SIZES, benchmark, get_perf_mode,
+    return_event, seed_dataset)
+
+# Calls per batch for the benchmarks that use up a rental each call
+WRITES = 25
+# Rentals they can use up, over every batch of every attempt
+WRITES_TOTAL = WRITES * PERF_REPEATS * PERF_ATTEMPTS
+
+pytestmark = pytest.mark.skipif(
+    get_perf_mode() is None, reason="set TOPANGA_PERF=run|compare|update to benchmark")
+
+
+@pytest.fixture(scope="session")
+def datasets(template_db):
+    """Builds each dataset once, as an in-memory copy of the test template."""
+    built = {}
+
+    def build(size_name):
+        if size_name not in built:
+            connection = sqlite3.connect(":memory:")
+            template_db.backup(connection)
+            built[size_name] = connection, seed_dataset(connection, PERF_SIZES[size_name])
+        return built[size_name]
+
+    yield build
+
+    for connection, _ in built.values():
+        connection.close()
+
+
+@pytest.fixture(params=list(PERF_SIZES))
+def dataset(request, datasets, refresh_test_db):
+    """Restores a seeded dataset into the test database."""
+    connection, seeded = datasets(request.param)
+    connection.backup(refresh_test_db)
+    return request.param, seeded
+
+
+def in_progress_rentals(connection, limit):
+    """Unexpired rentals in progress, in id order."""
+    return [Rental(*row) for row in connection.execute(
+        f"{RENTAL_SELECT} WHERE status = 'IN_PROGRESS' AND expires_at_ms > ? "
+        "ORDER BY id LIMIT ?;", (to_epoch_ms(REFERENCE_NOW), limit))]
+
+
+def test_parse_return_event():
+    """Benchmark event parsing and QR decoding."""
+
+    event = return_event("tpg_u0001", "tpg_a00001")
+
+    benchmark("parse_return_event", lambda _: parse_return_event(event), 2000)
+
+
+def test_active_eligible_rentals(dataset):
+    """Benchmark listing a typical user's eligible rentals."""
+
+    size, seeded = dataset
+    events = [parse_return_event(return_event(*pair))
+              for pair in seeded.returnable[:500] if pair != seeded.heavy_user]
+
+    assert all(active_eligible_rentals(event) for event in events[:10])
+    benchmark(f"active_eligible_rentals[{size}]",
+              lambda i: active_eligible_rentals(events[i % len(events)]), 200)
+
+
+def test_find_oldest_rental_from(dataset):
+    """Benchmark picking the oldest of the heavy user's rentals."""
+
+    size, seeded = dataset
+    rentals = active_eligible_rentals(parse_return_event(return_event(*seeded.heavy_user)))
+
+    assert len(rentals) == min(PERF_SIZES[size] // 10, 1000)
+    benchmark(f"find_oldest_rental_from[{size}]",
+              lambda _: find_oldest_rental_from(rentals), 1000)
+
+
+def test_finalize_rental_return(dataset, refresh_test_db):
+    """Benchmark completing a rental, one commit per call."""
+
+    size, _ = dataset
+    rentals = in_progress_rentals(refresh_test_db, WRITES_TOTAL)
+    event = parse_return_event(return_event("tpg_u0001", "tpg_a00001"))
+
+    benchmark(f"finalize_rental_return[{size}]",
+              lambda i: finalize_rental_return(rentals[i], event), WRITES)
+    assert refresh_test_db.execute(
+        "SELECT status FROM rentals WHERE id = ?;", (rentals[0].id,)).fetchone() == ("COMPLETED",)
+
+
+def test_process_rental_return(dataset):
+    """Benchmark the whole return path, from event to outbox."""
+
+    size, seeded = dataset
+    events = [return_event(*pair) for pair in seeded.returnable[:WRITES_TOTAL]]
+    statuses = []
+
+    benchmark(f"process_rental_return[{size}]",
+              lambda i: statuses.append(process_rental_return(events[i])["status"]), WRITES)
+    assert set(statuses) == {"SUCCESS"}
+
+
+def test_serialize_response(refresh_test_db):
+    """Benchmark building and serializing a success response."""
+
+    [rental] = in_progress_rentals(refresh_test_db, 1)
+
+    benchmark("serialize_response", lambda _: json.dumps(create_success_response(rental)), 2000)
+
+
+def test_serialize_failure_response():
+    """Benchmark building and serializing a failure response from its template."""
+
+    benchmark("serialize_failure_response", lambda _: serialize_response(create_failure_response(
+        "No active rentals found for user tpg_u0005", ErrorCode.NO_ELIGIBLE_RENTAL)), 2000)
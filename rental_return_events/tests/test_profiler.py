@@ -0,0 +1,66 @@
+"""Test the opt-in profiling of the processing pipeline."""
+import json
+import os
+
+import pytest
+
+from rental_return_events.processor import process_rental_return
+from rental_return_events.profiler import get_profile_mode, profile_run
+
+
+def run_events(load_event, repeat=20):
+    """Processes the example events repeatedly, enough for a few samples."""
+    for _ in range(repeat):
+        for name in ("event_01.json", "event_03.json", "event_04.json"):
+            process_rental_return(load_event(name))
+
+
+def test_profiling_off_by_default(load_event, tmp_path, monkeypatch):
+    """Test nothing is profiled or written unless profiling is enabled."""
+
+    monkeypatch.delenv("TOPANGA_PROFILE", raising=False)
+
+    with profile_run("off", output_dir=str(tmp_path)) as prefix:
+        run_events(load_event, repeat=1)
+
+    assert prefix is None
+    assert not os.listdir(tmp_path)
+
+    with pytest.raises(ValueError):
+        get_profile_mode("perf")
+
+
+def test_sampling_profile(load_event, tmp_path, monkeypatch):
+    """Test sampling writes collapsed stacks and a phase summary."""
+
+    monkeypatch.setenv("TOPANGA_PROFILE_RATE", "2000")
+
+    with profile_run("sampled", "sample", output_dir=str(tmp_path)) as prefix:
+        run_events(load_event, repeat=200)
+
+    with open(f"{prefix}.collapsed", encoding="utf-8") as f:
+        stacks = [line.rsplit(" ", 1) for line in f]
+    with open(f"{prefix}.summary.json", encoding="utf-8") as f:
+        summary = json.load(f)
+
+    assert stacks and all(int(count) > 0 for _, count in stacks)
+    assert any("rental_return_events.processor:process_rental_return" in stack
+               for stack, _ in stacks)
+    assert summary["samples"] == sum(int(count) for _, count in stacks)
+    assert "db_read" in summary["phases"]
+
+
+def test_cprofile_profile(load_event, tmp_path):
+    """Test cProfile mode writes stats and attributes time to every phase."""
+
+    with profile_run("traced", "cprofile", output_dir=str(tmp_path)) as prefix:
+        run_events(load_event, repeat=2)
+
+    with open(f"{prefix}.summary.json", encoding="utf-8") as f:
+        summary = json.load(f)
+
+    assert os.path.getsize(f"{prefix}.pstats") > 0
+    assert {"parse", "selection", "db_read", "db_write", "serialization"} <= \
+        set(summary["phases"])
+    assert sum(phase["seconds"] for phase in summary["phases"].values()) == \
+        pytest.approx(summary["elapsed_seconds"], rel=0.05)
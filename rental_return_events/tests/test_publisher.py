@@ -0,0 +1,139 @@
+"""Test the outbox and the batched downstream publisher."""
+import json
+import sqlite3
+
+import pytest
+
+from topanga_queries.outbox import fetch_outbox_batch, outbox_backlog
+from topanga_queries.rentals import get_rental
+from rental_return_events import processor
+from rental_return_events.metrics import metrics
+from rental_return_events.processor import process_rental_return
+from rental_return_events.publisher import FileSink, MemorySink, OutboxPublisher
+
+
+def test_responses_written_to_outbox(load_event, monkeypatch):
+    """Test success and failure responses land on their outbox topics."""
+
+    monkeypatch.setenv("TOPANGA_OUTBOX_FAILURES", "on")
+    success = process_rental_return(load_event("event_01.json"))
+    failure = process_rental_return(load_event("event_03.json"))
+
+    messages = fetch_outbox_batch()
+
+    assert [message.topic for message in messages] == [
+        "rental_returns.success", "rental_returns.failure"]
+    assert [message.payload for message in messages] == [success, failure]
+
+
+def test_outbox_write_rolls_back_rental(load_event, monkeypatch):
+    """Test a rental is not completed when its outbox write fails."""
+
+    def broken_enqueue(topic, payload, commit=True):
+        raise RuntimeError("outbox unavailable")
+
+    monkeypatch.setattr(processor, "enqueue_message", broken_enqueue)
+    rental = processor.oldest_eligible_rental(
+        processor.parse_return_event(load_event("event_01.json")))
+
+    with pytest.raises(RuntimeError):
+        process_rental_return(load_event("event_01.json"))
+
+    assert get_rental(rental.id).status == "IN_PROGRESS"
+
+
+def test_outbox_off(load_event, monkeypatch):
+    """Test rentals are still completed with the outbox switched off."""
+
+    monkeypatch.setenv("TOPANGA_OUTBOX", "off")
+    response = process_rental_return(load_event("event_01.json"))
+
+    assert get_rental(response["rental_id"]).status == "COMPLETED"
+    assert outbox_backlog() == (0, None)
+
+
+def test_failures_not_published_by_default(refresh_test_db, load_event):
+    """Test a failure response writes nothing unless failure publishing is on."""
+
+    statements = []
+    refresh_test_db.set_trace_callback(statements.append)
+    response = process_rental_return({"timestamp": "not a time"})
+    refresh_test_db.set_trace_callback(None)
+
+    assert response["status"] == "FAILED"
+    assert statements == []
+    assert outbox_backlog() == (0, None)
+
+    process_rental_return(load_event("event_03.json"))  # Unknown asset
+    assert outbox_backlog() == (0, None)
+
+
+def test_failure_response_published_once(monkeypatch):
+    """Test a failure response is returned after one locked publish attempt."""
+
+    monkeypatch.setenv("TOPANGA_OUTBOX_FAILURES", "on")
+    attempts = []
+
+    def locked_enqueue(topic, payload, commit=True):
+        attempts.append(topic)
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(processor, "enqueue_message", locked_enqueue)
+    metrics.reset()
+
+    response = process_rental_return({"timestamp": "not a time"})
+
+    assert response["status"] == "FAILED"
+    assert attempts == ["rental_returns.failure"]
+    assert metrics.snapshot()["counters"]["outbox.enqueue_failed"] == 1
+
+
+def test_publisher_drains_in_batches(load_event, monkeypatch):
+    """Test the publisher delivers every message in batches and empties the outbox."""
+
+    monkeypatch.setenv("TOPANGA_OUTBOX_FAILURES", "on")
+    for name in ("event_01.json", "event_02.json", "event_03.json", "event_04.json"):
+        process_rental_return(load_event(name))
+
+    metrics.reset()
+    sink = MemorySink()
+    publisher = OutboxPublisher(sink, batch_size=3)
+
+    assert publisher.drain() == 4
+    assert [message.id for message in sink.messages] == sorted(
+        message.id for message in sink.messages)
+    assert outbox_backlog() == (0, None)
+    assert metrics.snapshot()["counters"]["outbox.published"] == 4
+    assert metrics.snapshot()["timers"]["outbox.lag"]["count"] == 4
+
+
+def test_publisher_redelivers_after_sink_failure(load_event, tmp_path):
+    """Test a batch the sink rejected stays in the outbox and is published again."""
+
+    process_rental_return(load_event("event_01.json"))
+
+    class FlakySink(FileSink):
+        failures = 1
+
+        def publish(self, messages):
+            super().publish(messages)
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("sink unavailable")
+
+    sink = FlakySink(str(tmp_path / "published.ndjson"))
+    publisher = OutboxPublisher(sink)
+
+    with pytest.raises(ConnectionError):
+        publisher.drain()
+    assert outbox_backlog()[0] == 1
+
+    assert publisher.drain() == 1
+    assert outbox_backlog()[0] == 0
+
+    with open(sink.path, encoding="utf-8") as f:
+        delivered = [json.loads(line) for line in f]
+
+    # At-least-once: the message was delivered twice, with the same id
+    assert len(delivered) == 2
+    assert delivered[0] == delivered[1]
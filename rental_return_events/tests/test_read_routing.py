@@ -0,0 +1,76 @@
+"""Test routing of read-only queries to a separate connection."""
+import sqlite3
+
+import pytest
+
+from topanga_queries import get_connection, get_read_connection, refresh_snapshot
+from topanga_queries.bootstrap.events import encode_qr
+from topanga_queries.rentals import complete_rental, get_rental, list_rentals_for_user
+from rental_return_events.processor import process_rental_return
+
+
+def test_primary_mode_shares_connection():
+    """Test reads use the write connection by default."""
+
+    assert get_read_connection() is get_connection()
+
+
+def test_read_only_mode(monkeypatch):
+    """Test `ro` mode reads committed writes and cannot write."""
+
+    monkeypatch.setenv("TOPANGA_READ_MODE", "ro")
+    rental = list_rentals_for_user("tpg_u0003")[0]
+
+    assert get_read_connection() is not get_connection()
+    with pytest.raises(sqlite3.OperationalError):
+        get_read_connection().execute("DELETE FROM rentals;")
+
+    complete_rental(rental.id, "COMPLETED", "2025-02-10T12:00:00+00:00", "topanga-location-01")
+
+    assert get_rental(rental.id).status == "COMPLETED"
+
+
+def test_snapshot_mode(monkeypatch):
+    """Test `snapshot` mode reads a copy that is refreshed periodically."""
+
+    monkeypatch.setenv("TOPANGA_READ_MODE", "snapshot")
+    monkeypatch.setenv("TOPANGA_SNAPSHOT_INTERVAL", "3600")
+    rental = list_rentals_for_user("tpg_u0003")[0]
+
+    updated = complete_rental(
+        rental.id, "COMPLETED", "2025-02-10T12:00:00+00:00", "topanga-location-01")
+
+    assert updated.status == "COMPLETED"  # Writers read back from the primary
+    assert get_rental(rental.id).status == "IN_PROGRESS"
+
+    refresh_snapshot()
+
+    assert get_rental(rental.id).status == "COMPLETED"
+
+
+def test_snapshot_mode_returns_new_asset(monkeypatch, load_event):
+    """Test an asset added after the snapshot was taken can be returned."""
+
+    monkeypatch.setenv("TOPANGA_READ_MODE", "snapshot")
+    monkeypatch.setenv("TOPANGA_SNAPSHOT_INTERVAL", "3600")
+    refresh_snapshot()
+
+    connection = get_connection()
+    connection.execute("UPDATE rentals SET asset_id = 'tpg_a09001' WHERE asset_id = 'tpg_a00001';")
+    connection.execute("INSERT INTO assets VALUES ('tpg_a09001', 'clamshell');")
+    connection.commit()
+    event = {**load_event("event_01.json"), "asset_qr_data": encode_qr("tpg_a09001")}
+
+    assert process_rental_return(event)["status"] == "SUCCESS"
+
+
+def test_read_connection_follows_mode(monkeypatch):
+    """Test switching read modes opens a connection for the new mode."""
+
+    monkeypatch.setenv("TOPANGA_READ_MODE", "ro")
+    read_only = get_read_connection()
+    monkeypatch.setenv("TOPANGA_READ_MODE", "snapshot")
+    snapshot = get_read_connection()
+
+    assert snapshot is not read_only
+    snapshot.execute("DELETE FROM rentals;")  # A private copy, so writable
@@ -5,12 +5,16 @@ from datetime import datetime, timezone
 import pytest
 
 from topanga_queries.rentals import Rental
-from rental_return_events.response import create_success_response, create_failure_response
+from rental_return_events.response import (ErrorCode, create_success_response,
+    create_failure_response, serialize_response)
 from rental_return_events.handler import (ReturnEvent, decode_qr,
     convert_timestamp, parse_return_event)
+from rental_return_events import processor
+from rental_return_events.metrics import metrics
 from rental_return_events.processor import (rental_is_of_asset_type, rental_is_non_expired,
     fetch_valid_asset, active_eligible_rentals, find_oldest_rental_from,
-    complete_rental_return, process_rental_return)
+    finalize_rental_return, oldest_eligible_rental, complete_rental_return,
+    process_rental_return)
 
 # =========================
 # return_event_received.py
@@ -87,7 +91,8 @@ def test_create_success_response():
         "rental_id": "2152d14c-708d-4053-9f3f-246fd472f1aa",
         "rental_returned_at": "2025-02-10T11:00:00+00:00",
         "rental_status": "COMPLETED",
-        "error": None
+        "error": None,
+        "error_code": None
     }
 
     result = create_success_response(rental)
@@ -106,13 +111,35 @@ def test_create_failure_response():
         "rental_id": None,
         "rental_returned_at": None,
         "rental_status": None,
-        "error": "No eligible rental found"
+        "error": "No eligible rental found",
+        "error_code": "NO_ELIGIBLE_RENTAL"
     }
 
     result = create_failure_response(message)
 
     assert result == expected
 
+
+def test_failure_response_templates(load_event):
+    """Test each failure gets its error code and serializes like json.dumps."""
+
+    bad_qr = dict(load_event("event_01.json"), asset_qr_data="%%not-base64%%")
+    missing = {"timestamp": "2025-02-10T11:00:00+00:00"}
+
+    codes = [process_rental_return(event)["error_code"] for event in (
+        load_event("event_03.json"), bad_qr, missing, dict(bad_qr, asset_qr_data=1))]
+
+    assert codes == ["ASSET_NOT_FOUND", "INVALID_QR_CODE", "MISSING_FIELD", "INVALID_TYPE"]
+
+    for code in ErrorCode:
+        response = create_failure_response('Quotes " and \\ and ü', code)
+        assert response["error_code"] == code.value
+        assert serialize_response(response) == json.dumps(response)
+
+    success = create_success_response(
+        oldest_eligible_rental(parse_return_event(load_event("event_01.json"))))
+    assert serialize_response(success) == json.dumps(success)
+
 # =========================-
 # process_rental_return.py
 # =========================
@@ -189,6 +216,23 @@ def test_active_eligible_rentals(load_event):
     assert "clamshell" in result[0].eligible_asset_types
 
 
+@pytest.mark.parametrize("version, not_backfilled", [
+    (0, "created_at_ms = NULL, expires_at_ms = NULL"),
+    (1, "eligible_group_id = NULL"),
+])
+def test_eligible_rentals_during_backfill(refresh_test_db, load_event, version, not_backfilled):
+    """Test rentals not yet backfilled are still found while a migration runs."""
+
+    refresh_test_db.execute(f"UPDATE rentals SET {not_backfilled};")
+    refresh_test_db.execute(f"PRAGMA user_version = {version};")  # Backfill still running
+    refresh_test_db.commit()
+    event_01 = parse_return_event(load_event("event_01.json"))
+
+    assert [r.asset_id for r in active_eligible_rentals(event_01)] == ["tpg_a00001"]
+    assert oldest_eligible_rental(event_01).asset_id == "tpg_a00001"
+    assert complete_rental_return(event_01)["rental_status"] == "COMPLETED"
+
+
 def test_find_oldest_rental_from():
     """Test the find oldest rental function."""
 
@@ -221,6 +265,8 @@ def test_find_oldest_rental_from():
     result = find_oldest_rental_from(rentals)
 
     assert result.id == "2152d14c-708d-4053-9f3f-246fd472f1aa"
+    assert find_oldest_rental_from(reversed(rentals)).id == result.id  # Any iterable
+    assert find_oldest_rental_from(iter([])) is None
 
 
 def test_complete_rental_return01(load_event):
@@ -275,6 +321,40 @@ def test_complete_rental_return05(load_event):
     assert result["rental_status"] == "COMPLETED"
 
 
+def test_complete_rental_return_conflict(load_event, monkeypatch):
+    """Test a rental completed by another worker is not completed twice."""
+
+    return_event = parse_return_event(load_event("event_04.json"))
+    stale = oldest_eligible_rental(return_event)
+
+    assert finalize_rental_return(stale, return_event).status == "COMPLETED"
+    assert finalize_rental_return(stale, return_event) is None
+
+    # Hand the stale selection to the processor once, as if it lost the race
+    selections = iter([stale])
+    monkeypatch.setattr(processor, "oldest_eligible_rental",
+                        lambda event: next(selections, None) or oldest_eligible_rental(event))
+    metrics.reset()
+
+    result = complete_rental_return(return_event)
+
+    # The user had a single eligible rental, so re-selection finds nothing
+    assert result["status"] == "FAILED"
+    assert metrics.snapshot()["counters"]["rentals.completion_conflicts"] == 1
+
+
+def test_complete_rental_return_lookup_error(load_event, monkeypatch):
+    """Test only a missing asset is reported as ASSET_NOT_FOUND."""
+
+    def broken_lookup(event):
+        raise KeyError("eligible_asset_types")
+
+    monkeypatch.setattr(processor, "oldest_eligible_rental", broken_lookup)
+
+    with pytest.raises(KeyError):
+        complete_rental_return(parse_return_event(load_event("event_01.json")))
+
+
 def test_process_rental_return(load_event):
     """Test if the rental return process runs without errors."""
 
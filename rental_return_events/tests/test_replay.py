@@ -0,0 +1,119 @@
+"""Test replaying event archives through the processor."""
+import json
+import subprocess
+import sys
+
+import pytest
+
+from rental_return_events.processor import process_rental_return
+from rental_return_events.replay import CheckpointStore, replay_archive
+from perf import return_event
+from test_archive import write_archive
+from test_coalescer import seed_burst
+
+# Replays an archive and exits without any cleanup, as on SIGKILL, after
+# processing the given number of events
+KILLED_REPLAY = """
+import os, sys
+from rental_return_events import replay
+
+process, calls = replay.process_rental_return, []
+
+def process_then_kill(event):
+    response = process(event)
+    calls.append(event)
+    if len(calls) == int(sys.argv[3]):
+        os._exit(1)
+    return response
+
+replay.process_rental_return = process_then_kill
+replay.replay_archive(sys.argv[1], sys.argv[2])
+"""
+
+
+def test_replay_archive(tmp_path, load_event):
+    """Test replay routes failures to the dead-letter file and checkpoints."""
+
+    archive = tmp_path / "events.ndjson"
+    dead_letter = tmp_path / "dead.ndjson"
+    write_archive(archive, [
+        load_event("event_01.json"),
+        load_event("event_03.json"),  # Unknown asset
+        "{not json",
+        load_event("event_02.json"),
+    ])
+
+    stats = replay_archive(str(archive), str(dead_letter))
+
+    assert (stats.processed, stats.succeeded, stats.failed) == (4, 2, 2)
+    assert stats.offset == archive.stat().st_size
+
+    entries = [json.loads(line) for line in dead_letter.read_text().splitlines()]
+    assert [entry["reason"] for entry in entries] == [
+        "Asset not found: tpg_a00500",
+        entries[1]["reason"],
+    ]
+    assert entries[1]["reason"].startswith("Invalid JSON")
+    assert entries[1]["raw"] == "{not json"
+
+    assert CheckpointStore().load(str(archive), 0, archive.stat().st_size) == (
+        stats.offset, 4, 2, dead_letter.stat().st_size)
+
+
+def test_replay_resumes_from_checkpoint(tmp_path, load_event, monkeypatch):
+    """Test an interrupted replay resumes after the last processed event."""
+
+    archive = tmp_path / "events.ndjson"
+    dead_letter = tmp_path / "dead.ndjson"
+    write_archive(archive, [load_event("event_01.json"), load_event("event_02.json")])
+
+    calls = []
+
+    def interrupt(event):
+        calls.append(event)
+        if len(calls) > 1:
+            raise RuntimeError("interrupted")
+        return process_rental_return(event)
+
+    with monkeypatch.context() as patch:
+        patch.setattr("rental_return_events.replay.process_rental_return", interrupt)
+        with pytest.raises(RuntimeError):
+            replay_archive(str(archive), str(dead_letter))
+
+    first_line = archive.read_text().index("\n") + 1
+    stats = replay_archive(str(archive), str(dead_letter))
+    assert (stats.resumed_from, stats.processed, stats.succeeded) == (first_line, 1, 1)
+
+    stats = replay_archive(str(archive), str(dead_letter))
+    assert stats.resumed_from == archive.stat().st_size
+    assert stats.processed == 0
+
+
+def test_replay_killed_between_checkpoints(refresh_test_db, tmp_path):
+    """Test a replay killed between checkpoints resumes without reapplying returns."""
+
+    seed_burst(refresh_test_db)
+    archive = tmp_path / "events.ndjson"
+    dead_letter = tmp_path / "dead.ndjson"
+    write_archive(archive, [
+        return_event("tpg_u0009", "tpg_a00001"),
+        "{not json",
+        return_event("tpg_u0009", "tpg_a00500"),  # Unknown asset
+        return_event("tpg_u0009", "tpg_a00001"),
+    ])
+
+    killed = subprocess.run([sys.executable, "-c", KILLED_REPLAY, str(archive),
+                             str(dead_letter), "2"], cwd=tmp_path, check=False)
+    assert killed.returncode == 1
+
+    stats = replay_archive(str(archive), str(dead_letter))
+
+    # Replayed from the start, the first return would complete burst-c2 again
+    assert stats.succeeded == 1
+    assert refresh_test_db.execute(
+        "SELECT id FROM rentals WHERE id LIKE 'burst-c%' AND status = 'COMPLETED' "
+        "ORDER BY id;").fetchall() == [("burst-c1",), ("burst-c2",)]
+
+    entries = [json.loads(line) for line in dead_letter.read_text().splitlines()]
+    assert [entry["reason"][:12] for entry in entries] == ["Invalid JSON", "Asset not fo"]
+    assert CheckpointStore().load(str(archive), 0, archive.stat().st_size)[1:3] == (4, 2)
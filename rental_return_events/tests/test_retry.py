@@ -0,0 +1,204 @@
+"""Test retrying rental completion on transient database lock errors."""
+import dataclasses
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from datetime import timedelta
+
+import pytest
+
+from topanga_queries.bootstrap.db import REFERENCE_NOW, generate_rental_record, init_tables
+from topanga_queries.bootstrap.events import encode_qr
+from topanga_queries.migrations import run_migrations
+from topanga_queries.rentals import RENTAL_COLUMNS
+from rental_return_events.metrics import metrics
+from rental_return_events.retry import RetryPolicy, call_with_retry
+
+FAST_POLICY = RetryPolicy(busy_timeout_ms=1, base_delay=0.001, max_delay=0.02, deadline=10)
+# Completion time allowed per return under lock contention
+SECONDS_PER_RETURN = 0.2
+
+
+def test_call_with_retry():
+    """Test lock errors are retried and counted until the call succeeds."""
+
+    metrics.reset()
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise sqlite3.OperationalError("database is locked")
+        return "done"
+
+    assert call_with_retry(flaky, policy=FAST_POLICY) == "done"
+    assert metrics.snapshot()["counters"]["db.retries"] == 2
+
+
+def test_call_with_retry_deadline():
+    """Test lock errors propagate once the deadline has passed."""
+
+    def locked():
+        raise sqlite3.OperationalError("database is locked")
+
+    with pytest.raises(sqlite3.OperationalError):
+        call_with_retry(locked, policy=RetryPolicy(base_delay=0.01, deadline=0.05))
+
+    with pytest.raises(sqlite3.OperationalError):  # Not transient, never retried
+        call_with_retry(sqlite3.connect(":memory:").execute, "SELECT * FROM missing")
+
+
+def test_busy_timeout_set_once(refresh_test_db):
+    """Test the busy timeout is set when connecting, not on every call."""
+
+    statements = []
+    refresh_test_db.set_trace_callback(statements.append)
+    for policy in (RetryPolicy(), RetryPolicy(), FAST_POLICY, FAST_POLICY):
+        call_with_retry(lambda: None, policy=policy)
+    refresh_test_db.set_trace_callback(None)
+
+    assert statements == ["PRAGMA busy_timeout = 1;"]
+    assert refresh_test_db.execute("PRAGMA busy_timeout;").fetchone() == (1,)
+
+
+def seed_contention_db(path, user_ids, rentals_per_user=1):
+    """Creates a database with returnable rentals for each user."""
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL;")
+    cur = connection.cursor()
+    init_tables(cur)
+    run_migrations(connection)
+    cur.execute("INSERT INTO assets VALUES ('tpg_a00001', 'clamshell');")
+    cur.executemany("INSERT INTO users VALUES (?, ?);", [(user_id, user_id) for user_id in user_ids])
+    cur.executemany(
+        f"INSERT INTO rentals({RENTAL_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+        [generate_rental_record(f"r-{user_id}-{n}", user_id, "tpg_a00001",
+                                "topanga-location-01", REFERENCE_NOW - timedelta(days=1, hours=n),
+                                10, "IN_PROGRESS")
+         for user_id in user_ids for n in range(rentals_per_user)])
+    connection.commit()
+    connection.close()
+
+
+# Returns the NDJSON events on stdin and reports the responses and counters
+RETURN_WORKER = """
+import json, sys, time
+from rental_return_events.metrics import metrics
+from rental_return_events.processor import process_rental_return
+from rental_return_events.retry import RetryPolicy
+
+policy = RetryPolicy(**json.loads(sys.argv[1]))
+events = [json.loads(line) for line in sys.stdin]
+started = time.perf_counter()
+responses = [process_rental_return(event, policy) for event in events]
+print(json.dumps({"seconds": time.perf_counter() - started,
+                  "statuses": [response["status"] for response in responses],
+                  "rental_ids": [response["rental_id"] for response in responses],
+                  "counters": metrics.snapshot()["counters"]}))
+"""
+
+
+def return_event(user_id):
+    """Builds a return event for the seeded rental of `user_id`."""
+    return {
+        "timestamp": REFERENCE_NOW.isoformat(),
+        "location_id": "topanga-location-02",
+        "user_qr_data": encode_qr(user_id),
+        "asset_qr_data": encode_qr("tpg_a00001"),
+    }
+
+
+def hold_write_lock(db_path, stop):
+    """Repeatedly holds the write lock to force contention."""
+    connection = sqlite3.connect(db_path, isolation_level=None)
+    while not stop.is_set():
+        connection.execute("BEGIN IMMEDIATE;")
+        time.sleep(0.02)
+        connection.execute("COMMIT;")
+        time.sleep(0.005)
+    connection.close()
+
+
+def run_return_workers(db_path, cwd, user_ids_per_worker, policy=FAST_POLICY):
+    """Runs one worker process per list of user IDs and returns their reports."""
+    env = dict(os.environ, TOPANGA_DB_PATH=db_path)
+    policy = json.dumps(dataclasses.asdict(policy))
+    processes = [
+        subprocess.Popen([sys.executable, "-c", RETURN_WORKER, policy], env=env,
+                         cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        for _ in user_ids_per_worker
+    ]
+    # Feed every worker before reading any output so they run concurrently
+    for process, user_ids in zip(processes, user_ids_per_worker):
+        process.stdin.write(
+            "".join(json.dumps(return_event(user_id)) + "\n" for user_id in user_ids))
+        process.stdin.close()
+    reports = [json.loads(process.stdout.read()) for process in processes]
+    for process in processes:
+        process.wait(timeout=60)
+    return reports
+
+
+def test_concurrent_returns_under_lock_contention(tmp_path):
+    """Test concurrent processes complete every return despite lock contention."""
+
+    db_path = str(tmp_path / "contention.db")
+    workers, per_worker = 4, 15
+    user_ids = [f"tpg_u{n:04}" for n in range(workers * per_worker)]
+    seed_contention_db(db_path, user_ids)
+
+    stop = threading.Event()
+    holder = threading.Thread(target=hold_write_lock, args=(db_path, stop))
+    holder.start()
+
+    try:
+        reports = run_return_workers(
+            db_path, tmp_path, [user_ids[n::workers] for n in range(workers)])
+    finally:
+        stop.set()
+        holder.join()
+
+    statuses = [status for report in reports for status in report["statuses"]]
+    assert statuses == ["SUCCESS"] * len(user_ids)
+    assert sum(report["counters"].get("db.retries", 0) for report in reports) > 0
+    # Each return needs only one of the 5ms gaps between lock holds, so even
+    # a slow machine is far inside this; a retry livelock is not
+    assert max(report["seconds"] for report in reports) < per_worker * SECONDS_PER_RETURN
+
+    connection = sqlite3.connect(db_path)
+    assert connection.execute(
+        "SELECT COUNT(*) FROM rentals WHERE status = 'COMPLETED';").fetchone() == (len(user_ids),)
+    connection.close()
+
+
+def test_concurrent_duplicate_returns(tmp_path):
+    """Test duplicate returns racing for the same rentals complete each rental once."""
+
+    db_path = str(tmp_path / "duplicates.db")
+    workers = 4
+    user_ids = [f"tpg_u{n:04}" for n in range(50)]
+    seed_contention_db(db_path, user_ids, rentals_per_user=workers)
+
+    # Every worker returns one asset for every user, in the same order, so
+    # they all pick the same oldest rental. A long busy timeout lets a loser
+    # wait out the winner's commit and then run its update, rather than
+    # failing on the lock and re-selecting.
+    reports = run_return_workers(db_path, tmp_path, [user_ids] * workers,
+                                 policy=RetryPolicy(busy_timeout_ms=5000))
+
+    counters = [report["counters"] for report in reports]
+    assert sum(counter.get("rentals.completion_conflicts", 0) for counter in counters) > 0
+
+    rental_ids = [rental_id for report in reports for rental_id in report["rental_ids"]]
+    assert [status for report in reports for status in report["statuses"]] == \
+        ["SUCCESS"] * len(rental_ids)
+    assert len(set(rental_ids)) == len(user_ids) * workers
+
+    connection = sqlite3.connect(db_path)
+    assert connection.execute(
+        "SELECT COUNT(*) FROM rentals WHERE status != 'COMPLETED';").fetchone() == (0,)
+    connection.close()
@@ -0,0 +1,119 @@
+"""Test the priority scheduler for live and backfill events."""
+import time
+from queue import Full
+from types import SimpleNamespace
+
+import pytest
+
+from rental_return_events import scheduler as scheduler_module
+from rental_return_events.metrics import metrics
+from rental_return_events.scheduler import EventScheduler
+
+
+@pytest.fixture
+def processed(monkeypatch):
+    """Replaces processing with a 10ms stand-in and records the event order."""
+    order = []
+
+    def fake_process(event, retry_policy=None):
+        time.sleep(0.01)
+        order.append(event["id"])
+        return {"status": "SUCCESS", "id": event["id"]}
+
+    monkeypatch.setattr(scheduler_module, "process_rental_return", fake_process)
+    return order
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces the scheduler's clock with one that only moves when told to."""
+    fake = SimpleNamespace(now=100.0)
+    fake.monotonic = lambda: fake.now
+
+    def sleep(seconds):
+        fake.now += seconds
+
+    fake.sleep = sleep
+    monkeypatch.setattr(scheduler_module, "time", fake)
+    return fake
+
+
+def test_live_before_backfill(load_event):
+    """Test queued live events are processed before backfill and responses resolve."""
+
+    metrics.reset()
+    scheduler = EventScheduler(backfill_share=1.0)
+    backfill = [scheduler.submit(load_event("event_02.json"), "backfill") for _ in range(2)]
+    live = scheduler.submit(load_event("event_01.json"), "live")
+    scheduler.shutdown()
+    scheduler.run()
+
+    assert live.result()["status"] == "SUCCESS"
+    assert [future.result()["status"] for future in backfill] == ["SUCCESS", "FAILED"]
+
+    snapshot = metrics.snapshot()
+    assert snapshot["gauges"]["scheduler.backfill.depth"] == 0
+    assert snapshot["timers"]["scheduler.backfill.wait"]["max_seconds"] >= \
+        snapshot["timers"]["scheduler.live.wait"]["max_seconds"]
+
+
+def test_backfill_throttled_to_share(clock, monkeypatch):
+    """Test backfill keeps to its share of time and live events use the gaps."""
+
+    order = []
+
+    def fake_process(event, retry_policy=None):
+        clock.now += 0.01
+        order.append(event["id"])
+        return {"status": "SUCCESS", "id": event["id"]}
+
+    monkeypatch.setattr(scheduler_module, "process_rental_return", fake_process)
+    metrics.reset()
+    scheduler = EventScheduler(backfill_share=0.25)
+    monkeypatch.setattr(scheduler._condition, "wait", clock.sleep)
+    for n in range(3):
+        scheduler.submit({"id": f"b{n}"}, "backfill")
+
+    def step():
+        scheduler._process(scheduler._next_event())
+
+    step()
+    # 10ms of backfill is followed by a 30ms gap at a 25% share
+    assert scheduler._backfill_ready_at == pytest.approx(100.04)
+
+    scheduler.submit({"id": "l0"}, "live")
+    step()  # Runs in the gap
+    assert clock.now == pytest.approx(100.02)
+
+    step()  # Waits out the rest of the gap
+    assert clock.now == pytest.approx(100.05)
+    assert scheduler._backfill_ready_at == pytest.approx(100.08)
+
+    scheduler.shutdown()
+    step()  # Not held back while draining
+    assert scheduler._next_event() is None
+
+    assert order == ["b0", "l0", "b1", "b2"]
+    throttled = metrics.snapshot()["timers"]["scheduler.backfill.throttled"]
+    assert throttled["count"] == 1
+    assert throttled["total_seconds"] == pytest.approx(0.02)
+
+
+def test_shutdown_without_drain(processed):
+    """Test queued events are cancelled and new ones refused after shutdown."""
+
+    scheduler = EventScheduler(max_depth=2)
+    futures = [scheduler.submit({"id": n}, "backfill") for n in range(2)]
+
+    with pytest.raises(Full):
+        scheduler.submit({"id": 3}, "backfill", timeout=0.01)
+
+    scheduler.shutdown(drain=False)
+    scheduler.run()
+
+    assert all(future.cancelled() for future in futures)
+    assert not processed
+    with pytest.raises(RuntimeError):
+        scheduler.submit({"id": 4})
+    with pytest.raises(ValueError):
+        EventScheduler(backfill_share=0)
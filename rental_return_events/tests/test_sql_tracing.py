@@ -0,0 +1,98 @@
+"""Test the SQL query tracer and slow-query log."""
+import logging
+
+import pytest
+
+from topanga_queries import get_connection, reset_db_connection
+from topanga_queries.tracing import (TracingConnection, fingerprint, get_event_query_stats,
+    get_query_stats, reset_query_stats)
+from rental_return_events.processor import process_rental_return
+
+
+@pytest.fixture
+def traced_connection(monkeypatch):
+    """Reconnects with tracing enabled and every query counted as slow."""
+    monkeypatch.setenv("TOPANGA_SQL_TRACE", "1")
+    monkeypatch.setenv("TOPANGA_SLOW_QUERY_MS", "0")
+    reset_query_stats()
+    yield reset_db_connection()
+    monkeypatch.undo()
+    reset_db_connection()
+
+
+def test_fingerprint():
+    """Test literals and placeholder lists are normalised away."""
+
+    assert fingerprint("SELECT *\n  FROM rentals WHERE id = 'abc' AND n > 10;") == \
+        "SELECT * FROM rentals WHERE id = ? AND n > ?"
+    assert fingerprint("DELETE FROM outbox WHERE id IN (?, ?,?)") == \
+        "DELETE FROM outbox WHERE id IN (?, ...)"
+
+
+def test_queries_traced(traced_connection, load_event, caplog):
+    """Test a return records per-query stats and logs slow queries with their plan."""
+
+    assert isinstance(get_connection(), TracingConnection)
+
+    with caplog.at_level(logging.WARNING, logger="topanga_queries.sql"):
+        response = process_rental_return(load_event("event_01.json"))
+
+    assert response["status"] == "SUCCESS"
+
+    stats = get_query_stats()
+    [select_asset] = [s for s in stats.values() if s.fingerprint.startswith(
+        "SELECT * FROM assets")]
+    [update] = [s for s in stats.values() if s.fingerprint.startswith("UPDATE rentals")]
+
+    assert select_asset.count >= 1 and select_asset.rows >= 1
+    assert update.count == 1 and update.total_seconds > 0
+    assert all(s.slow == s.count for s in stats.values())
+
+    slow_logs = [r.getMessage() for r in caplog.records if r.name == "topanga_queries.sql"]
+    assert any("SEARCH assets USING INDEX" in message for message in slow_logs)
+
+
+def test_queries_counted_per_event(traced_connection, load_event):
+    """Test each return's statements are counted apart, with the worst event's breakdown."""
+
+    process_rental_return(load_event("event_03.json"))  # Loads the membership filters
+    reset_query_stats()
+
+    process_rental_return(load_event("event_01.json"))
+    process_rental_return(load_event("event_03.json"))
+
+    stats = get_event_query_stats()
+    assert stats.events == 2 and sum(stats.histogram.values()) == 2
+    assert stats.max_queries == max(stats.histogram) == sum(stats.max_event.values())
+    # No N+1: a return runs each of its statements once
+    assert set(stats.max_event.values()) == {1}
+    assert any(key.startswith("UPDATE rentals") for key in stats.max_event)
+
+
+def test_full_scan_visible_in_plan(traced_connection, caplog):
+    """Test an unindexed lookup shows up as a SCAN in the slow-query log."""
+
+    with caplog.at_level(logging.WARNING, logger="topanga_queries.sql"):
+        rows = get_connection().execute(
+            "SELECT id FROM rentals WHERE returned_at_location_id = ?;",
+            ("topanga-location-01",)).fetchall()
+
+    stats = get_query_stats()[
+        "SELECT id FROM rentals WHERE returned_at_location_id = ?"]
+
+    assert stats.rows == len(rows)
+    assert "SCAN rentals" in caplog.records[-1].getMessage()
+
+
+def test_vm_steps_counted(traced_connection):
+    """Test the progress handler attributes VM steps to the running query."""
+
+    get_connection().execute("""
+        WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < 10000)
+        SELECT count(*) FROM n;
+    """).fetchone()
+
+    [stats] = [s for s in get_query_stats().values() if s.fingerprint.startswith("WITH")]
+
+    assert stats.rows == 1
+    assert stats.vm_steps >= 10000
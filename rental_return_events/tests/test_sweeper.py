@@ -0,0 +1,32 @@
+"""Test the expiry sweeper."""
+from datetime import timedelta
+
+from topanga_queries.bootstrap.db import REFERENCE_NOW
+from topanga_queries.sweeper import sweep_expired_rentals
+from rental_return_events.handler import parse_return_event
+from rental_return_events.processor import active_eligible_rentals
+
+
+def test_sweep_expired_rentals(refresh_test_db):
+    """Test overdue rentals are flagged in chunks and nothing else changes."""
+
+    result = sweep_expired_rentals(REFERENCE_NOW + timedelta(days=4), chunk_size=4)
+
+    assert (result.flagged, result.chunks) == (6, 2)
+
+    statuses = dict(refresh_test_db.execute(
+        "SELECT status, COUNT(*) FROM rentals GROUP BY status").fetchall())
+    assert statuses == {"IN_PROGRESS": 1, "FLAGGED": 6, "COMPLETED": 3}
+
+    # Sweeping again finds nothing left to flag
+    assert sweep_expired_rentals(REFERENCE_NOW + timedelta(days=4)).flagged == 0
+
+
+def test_flagged_rentals_are_not_returnable(load_event):
+    """Test a flagged rental is no longer a return candidate."""
+
+    sweep_expired_rentals(REFERENCE_NOW + timedelta(days=4))
+
+    event_02 = parse_return_event(load_event("event_02.json"))
+
+    assert active_eligible_rentals(event_02) == []
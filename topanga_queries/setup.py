@@ -8,6 +8,10 @@ setup(
     entry_points={
         "console_scripts": [
             "reset-db=topanga_queries.scripts.reset_db:initialize_challenge_db",
+            "migrate-db=topanga_queries.scripts.migrate_db:main",
+            "sweep-expired=topanga_queries.scripts.sweep_expired:main",
+            "rebuild-location-stats=topanga_queries.scripts.rebuild_location_stats:main",
+            "export-rentals=topanga_queries.scripts.export_rentals:main",
         ],
     },
 )
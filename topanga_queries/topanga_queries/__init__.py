@@ -1,49 +1,316 @@
+import atexit
 import os
-import sqlite3
-import sys
+import threading
+import time
 
-#print("Connecting to/creating challenge.db at:", os.getcwd())
-
-DB_NAME = os.getenv("TOPANGA_DB_PATH", "challenge.db")
+# Importing the package does no I/O: the connection is opened on first use,
+# from `TOPANGA_DB_PATH` as set at that point.
+DEFAULT_DB_NAME = "challenge.db"
 db_connection = None
 
+# `TOPANGA_STORAGE` selects where the database lives:
+#   disk   - the `TOPANGA_DB_PATH` file, in WAL mode (default)
+#   memory - a shared-cache in-memory database, seeded from the file with the
+#            backup API when first connected and written back to it on
+#            shutdown, by `flush_to_disk`, and every `TOPANGA_FLUSH_INTERVAL`
+#            seconds if set. Shared cache lets the read connection, the
+#            outbox publisher and the flush thread open the same database.
+STORAGE_MODES = ("disk", "memory")
+MEMORY_DB_URI = "file:topanga_queries?mode=memory&cache=shared"
+_flush_stop = threading.Event()
+_flush_thread = None
+
+# SQLite busy handler wait on the shared connection before a write fails with
+# "database is locked", from `TOPANGA_RETRY_BUSY_TIMEOUT_MS`. Set when the
+# connection opens; `rental_return_events.retry` only changes it for a retry
+# policy with a different timeout.
+DEFAULT_BUSY_TIMEOUT_MS = 1000
+
+# Read-only query functions go through `get_read_connection`, routed by
+# `TOPANGA_READ_MODE`:
+#   primary  - the shared `db_connection` (default)
+#   ro       - a separate `mode=ro` connection to the same database file
+#   snapshot - a private copy made with the backup API, refreshed every
+#              `TOPANGA_SNAPSHOT_INTERVAL` seconds
+READ_MODES = ("primary", "ro", "snapshot")
+DEFAULT_SNAPSHOT_INTERVAL = 60.0
+read_connection = None
+_read_connection_mode = None  # The read mode `read_connection` was opened for
+_snapshot_taken_at = None
+
+
+def get_db_path() -> str:
+    """Path of the database `db_connection` opens."""
+    return os.getenv("TOPANGA_DB_PATH", DEFAULT_DB_NAME)
+
+
+def get_busy_timeout_ms() -> int:
+    """Busy timeout of the shared connection from `TOPANGA_RETRY_BUSY_TIMEOUT_MS`."""
+    return int(os.getenv("TOPANGA_RETRY_BUSY_TIMEOUT_MS", DEFAULT_BUSY_TIMEOUT_MS))
+
+
+def get_storage_mode() -> str:
+    """Storage mode from `TOPANGA_STORAGE`."""
+    mode = os.getenv("TOPANGA_STORAGE", "disk")
+    if mode not in STORAGE_MODES:
+        raise ValueError(f"Invalid TOPANGA_STORAGE: {mode}")
+    return mode
+
+
+def _connection_options() -> dict:
+    """Extra `sqlite3.connect` arguments, a tracing factory when enabled."""
+    from topanga_queries.tracing import TracingConnection, tracing_enabled
+
+    return {"factory": TracingConnection} if tracing_enabled() else {}
+
+
+def connect(db_name: str = None):
+    """Open a new connection to the configured database.
+
+    Background workers use this to get a connection of their own, since a
+    connection can only be used by the thread that opened it.
+    """
+    import sqlite3  # Deferred so importing the package stays cheap
+
+    if get_storage_mode() == "memory":
+        return sqlite3.connect(MEMORY_DB_URI, uri=True, **_connection_options())
+
+    connection = sqlite3.connect(db_name or get_db_path(), **_connection_options())
+    connection.execute("PRAGMA journal_mode=WAL;")
+    connection.commit()
+    return connection
+
+
+def _connect(db_name: str):
+    connection = connect(db_name)
+    connection.execute(f"PRAGMA busy_timeout = {get_busy_timeout_ms()};")
+
+    if get_storage_mode() == "memory":
+        if os.path.exists(db_name):
+            load_from_disk(connection, db_name)
+        atexit.unregister(flush_to_disk)  # Registered once, however often we reconnect
+        atexit.register(flush_to_disk)
+        _start_flush_thread()
+
+    return connection
+
+
 def initialize_db_connection():
     """Initialize `db_connection` if not already connected."""
     global db_connection
 
-    # Determine which database to use (default to "challenge.db", override in tests)
     if db_connection is None:
-        DB_NAME = "challenge.db"
-        db_connection = sqlite3.connect(DB_NAME)
-        db_connection.execute("PRAGMA journal_mode=WAL;")
-        db_connection.commit()
+        db_connection = _connect(get_db_path())
+
+    return db_connection
+
+
+def get_connection():
+    """Return the shared `db_connection`, connecting on first use."""
+    if db_connection is None:
+        return initialize_db_connection()
+    return db_connection
+
+
+def get_read_mode() -> str:
+    """Read routing mode from `TOPANGA_READ_MODE`."""
+    mode = os.getenv("TOPANGA_READ_MODE", "primary")
+    if mode not in READ_MODES:
+        raise ValueError(f"Invalid TOPANGA_READ_MODE: {mode}")
+    return mode
+
+
+def _connect_read_only(db_name: str):
+    import sqlite3
+    from pathlib import Path
+
+    if get_storage_mode() == "memory":
+        connection = connect()
+        connection.execute("PRAGMA query_only = ON;")
+        return connection
+
+    # A read-only connection never takes the write lock, so heavy reads do
+    # not contend with the kiosk write transactions
+    return sqlite3.connect(f"{Path(db_name).resolve().as_uri()}?mode=ro", uri=True,
+                           **_connection_options())
+
+
+def refresh_snapshot():
+    """Copy the database into the read snapshot with the SQLite backup API."""
+    global read_connection, _read_connection_mode, _snapshot_taken_at
+    import sqlite3
+
+    _close_read_connection_unless("snapshot")
+    if read_connection is None:
+        read_connection = sqlite3.connect(os.getenv("TOPANGA_SNAPSHOT_PATH", ":memory:"),
+                                          **_connection_options())
+        _read_connection_mode = "snapshot"
+
+    source = _connect_read_only(get_db_path())
+    try:
+        source.backup(read_connection)
+    finally:
+        source.close()
+
+    _snapshot_taken_at = time.monotonic()
+    return read_connection
+
+
+def _close_read_connection_unless(mode: str) -> None:
+    """Closes `read_connection` if it was opened for another read mode."""
+    global read_connection, _read_connection_mode
+
+    if read_connection is not None and _read_connection_mode != mode:
+        read_connection.close()
+        read_connection = None
+        _read_connection_mode = None
+
+
+def get_read_connection():
+    """Return the connection read-only queries should use.
+
+    Only use this for queries that can tolerate the lag of the configured
+    read mode; anything that reads its own writes must use `get_connection`.
+    """
+    global read_connection, _read_connection_mode
+
+    mode = get_read_mode()
+    if mode == "primary":
+        return get_connection()
+
+    _close_read_connection_unless(mode)
+    if mode == "ro":
+        if read_connection is None:
+            read_connection = _connect_read_only(get_db_path())
+            _read_connection_mode = "ro"
+        return read_connection
+
+    interval = float(os.getenv("TOPANGA_SNAPSHOT_INTERVAL", DEFAULT_SNAPSHOT_INTERVAL))
+    if read_connection is None or time.monotonic() - _snapshot_taken_at >= interval:
+        return refresh_snapshot()
+    return read_connection
+
+# ====================================================
+# In-memory storage
+# ====================================================
+def _has_schema(connection) -> bool:
+    return connection.execute("SELECT COUNT(*) FROM sqlite_master;").fetchone()[0] > 0
+
+
+def load_from_disk(connection, db_name: str = None) -> None:
+    """Copy the database file into `connection` with the SQLite backup API."""
+    import sqlite3
+
+    source = sqlite3.connect(db_name or get_db_path())
+    try:
+        source.backup(connection)
+    finally:
+        source.close()
+
+
+def flush_to_disk(connection=None) -> bool:
+    """Write the in-memory database back to `TOPANGA_DB_PATH`.
+
+    The database is first copied to a private in-memory staging copy, so
+    writers are only held up for an in-memory copy and not for the slower
+    write to disk. The copy is written to `TOPANGA_DB_PATH` + ".tmp" and
+    moved over the file with `os.replace`, so a crash part way through
+    leaves the previous file intact. Does nothing in `disk` storage mode,
+    and never replaces the file with an empty database.
+
+    Args:
+        connection: Open connection to the in-memory database, defaults to
+            `db_connection`
+
+    Returns:
+        bool: True if the database was written to disk
+    """
+    import sqlite3
+
+    connection = connection or db_connection
+    if get_storage_mode() != "memory" or connection is None:
+        return False
+
+    staging = sqlite3.connect(":memory:")
+    try:
+        try:
+            connection.backup(staging)
+        except sqlite3.ProgrammingError:  # Connection already closed
+            return False
+        if not _has_schema(staging):
+            return False
+
+        path = get_db_path()
+        temporary_path = f"{path}.tmp"
+        for stale in (temporary_path, f"{temporary_path}-journal"):
+            if os.path.exists(stale):
+                os.remove(stale)
+
+        target = sqlite3.connect(temporary_path)
+        try:
+            staging.backup(target)
+        finally:
+            target.close()
+
+        # A WAL left by the file being replaced would be replayed over the new one
+        for stale in (f"{path}-wal", f"{path}-shm"):
+            if os.path.exists(stale):
+                os.remove(stale)
+        os.replace(temporary_path, path)
+    finally:
+        staging.close()
+    return True
+
+
+def _flush_periodically(interval: float) -> None:
+    while not _flush_stop.wait(interval):
+        if db_connection is None:
+            continue
+        # A connection of its own: `db_connection` belongs to another thread
+        connection = connect()
+        try:
+            flush_to_disk(connection)
+        finally:
+            connection.close()
+
+
+def _start_flush_thread() -> None:
+    global _flush_thread
+
+    interval = float(os.getenv("TOPANGA_FLUSH_INTERVAL", "0"))
+    if interval <= 0 or (_flush_thread and _flush_thread.is_alive()):
+        return
+
+    _flush_stop.clear()
+    _flush_thread = threading.Thread(
+        target=_flush_periodically, args=(interval,), name="topanga-flush", daemon=True)
+    _flush_thread.start()
+    atexit.unregister(_flush_stop.set)  # Registered once, however often the thread restarts
+    atexit.register(_flush_stop.set)
 
-initialize_db_connection()
 
 # ====================================================
 # Used For Testing
-# Resets db_connection for every topanga_queries submodule
-# This way we avoid needing to make source code changes to topanga_queries
+# Reconnects every topanga_queries submodule, since they all go through
+# `get_connection`
 # ====================================================
 def reset_db_connection():
     """Closes and reopens the database connection to ensure it points to the latest DB."""
-    global db_connection
+    global db_connection, _flush_thread
+
+    if _flush_thread:
+        _flush_stop.set()
+        _flush_thread.join()
+        _flush_thread = None
 
     if db_connection:
+        # The last connection to a memory database takes its changes with it
+        flush_to_disk(db_connection)
         db_connection.close()  # Close old db connection
+    _close_read_connection_unless(None)  # Whatever mode it was opened for
 
     # Reload the db environment variable and reconnect
     new_db_name = os.getenv("TOPANGA_DB_PATH", "challenge.test.db")
-    db_connection = sqlite3.connect(new_db_name)
-    db_connection.execute("PRAGMA journal_mode=WAL;")
-    db_connection.commit()
-
-    # Update the db_connection in the topanga_queries module
-    sys.modules["topanga_queries"].db_connection = db_connection
-
-    # Update the db_connection in all topanga_queries submodules
-    for module in sys.modules:
-        if module.startswith("topanga_queries.") and hasattr(sys.modules[module], "db_connection"):
-            setattr(sys.modules[module], "db_connection", db_connection)
-    
-    return db_connection
\ No newline at end of file
+    db_connection = _connect(new_db_name)
+
+    return db_connection
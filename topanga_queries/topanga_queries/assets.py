@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 
-from topanga_queries import db_connection
+from topanga_queries import get_connection
 
 
 @dataclass
@@ -12,6 +12,9 @@ class Asset:
 def get_asset(id: str) -> Asset:
     """Get Asset from database.
 
+    Reads through the write connection, not `get_read_connection`: returns
+    look assets up, and must see an asset as soon as it is committed.
+
     Args:
         id (str): Asset `id`
 
@@ -21,7 +24,7 @@ def get_asset(id: str) -> Asset:
     Returns:
         Asset: Asset dataclass instance
     """
-    cur = db_connection.cursor()
+    cur = get_connection().cursor()
     cur.execute("""SELECT * FROM assets WHERE id = ?""", (id,))
     record = cur.fetchone()
     if record:
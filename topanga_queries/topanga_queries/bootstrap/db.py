@@ -2,7 +2,9 @@ import json
 import uuid
 from datetime import datetime, timedelta, timezone
 
-from topanga_queries import db_connection
+from topanga_queries import get_connection
+from topanga_queries.migrations import run_migrations
+from topanga_queries.rentals import RENTAL_COLUMNS
 
 def init_tables(cur) -> None:
     cur.execute("""
@@ -34,14 +36,15 @@ def init_tables(cur) -> None:
     print("Tables created in DB")
 
 
-def _init_records(cur, table_name: str, data: list) -> None:
+def _init_records(cur, table_name: str, columns: str, data: list) -> None:
     cur.execute(f"DELETE FROM {table_name};")  # Clear all existing records
     col_placeholders = ",".join(["?" for _ in range(len(data[0]))])
+    # Name the columns so migrations can add derived columns to the table
     cur.executemany(
-        f"INSERT INTO {table_name} VALUES({col_placeholders})",
+        f"INSERT INTO {table_name}({columns}) VALUES({col_placeholders})",
         data,
     )
-    db_connection.commit()
+    cur.connection.commit()
     print(f"{table_name} records added")
 
 
@@ -53,7 +56,7 @@ def init_users(cur) -> list:
         ("tpg_u0004", "Wesley J."),
         ("tpg_u0005", "Don B."),
     ]
-    _init_records(cur, "users", users)
+    _init_records(cur, "users", "id, name", users)
     # Return all user IDs
     return users
 
@@ -61,7 +64,7 @@ def init_users(cur) -> list:
 def init_assets(cur) -> list:
     ASSET_TYPES = ["3-compartment", "clamshell", "large-bowl", "small-bowl", "mug"]
     assets = [(f"tpg_a{n:05}", ASSET_TYPES[n % 5]) for n in range(1, 51)]
-    _init_records(cur, "assets", assets)
+    _init_records(cur, "assets", "id, asset_type", assets)
     # Return all asset IDs
     return assets
 
@@ -210,12 +213,13 @@ def init_rentals(cur):
         ),
     ]
 
-    _init_records(cur, "rentals", rentals)
+    _init_records(cur, "rentals", RENTAL_COLUMNS, rentals)
 
 
 def initialize_challenge_db():
-    cur = db_connection.cursor()
+    cur = get_connection().cursor()
     init_tables(cur)
+    run_migrations()
 
     init_users(cur)
     init_assets(cur)
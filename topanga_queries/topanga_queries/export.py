@@ -0,0 +1,297 @@
+"""Columnar export of the rentals table for analytics.
+
+Rentals are read in rowid order, `chunk_size` rows at a time, straight into
+per-column buffers without building `Rental` objects. Statuses, locations and
+asset types are dictionary encoded as integer codes and timestamps are epoch
+milliseconds, so memory use is bounded by the chunk size plus the (small)
+dictionaries.
+
+The output is Parquet when `pyarrow` is installed and a compressed NumPy
+`.npz` archive otherwise. The `.npz` writer only needs the standard library:
+each column is spilled to a temporary file per chunk and copied into the
+archive as one `.npy` array at the end. Loaded with `numpy.load`, it holds
+one array per column plus a `<column>_dictionary` array for every dictionary
+encoded column; missing values are stored as -1.
+"""
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from array import array
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, List
+
+from topanga_queries import get_read_connection
+
+DEFAULT_CHUNK_SIZE = 10000
+FORMATS = ("parquet", "npz")
+
+# Fixed width byte string columns
+STRING_COLUMNS = ("id", "user_id", "asset_id")
+# Columns stored as integer codes into a per-column dictionary
+DICTIONARY_COLUMNS = ("asset_type", "status", "created_at_location_id",
+                      "returned_at_location_id")
+# Integer columns and their `array` typecode
+INTEGER_COLUMNS = {
+    "created_at_ms": "q",
+    "expires_at_ms": "q",
+    "returned_at_ms": "q",
+    "eligible_group_id": "i",
+}
+EXPORT_COLUMNS = STRING_COLUMNS + DICTIONARY_COLUMNS + tuple(INTEGER_COLUMNS)
+
+EXPORT_SELECT = """
+    SELECT rentals.rowid, rentals.id, rentals.user_id, rentals.asset_id,
+           assets.asset_type, rentals.status, rentals.created_at_location_id,
+           rentals.returned_at_location_id, rentals.created_at_ms,
+           rentals.expires_at_ms, rentals.returned_at_ms, rentals.eligible_group_id
+    FROM rentals LEFT JOIN assets ON assets.id = rentals.asset_id
+    WHERE rentals.rowid > ?
+    ORDER BY rentals.rowid
+    LIMIT ?
+"""
+
+
+@dataclass
+class ExportResult:
+    path: str
+    output_format: str
+    rows: int
+    chunks: int
+    elapsed_seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        """Throughput of the export"""
+        if not self.elapsed_seconds:
+            return 0.0
+        return self.rows / self.elapsed_seconds
+
+
+def pyarrow_available() -> bool:
+    """Whether the optional pyarrow dependency is installed."""
+    try:
+        import pyarrow  # pylint: disable=unused-import
+    except ImportError:
+        return False
+    return True
+
+
+class DictionaryEncoder:
+    """Assigns a stable integer code to each distinct value, None is -1."""
+
+    def __init__(self):
+        self.codes: Dict[str, int] = {}
+
+    def encode(self, value) -> int:
+        if value is None:
+            return -1
+        return self.codes.setdefault(value, len(self.codes))
+
+    @property
+    def values(self) -> List[str]:
+        return list(self.codes)
+
+
+@contextmanager
+def read_transaction(connection):
+    """Runs the reads made inside in one transaction, so they all see one snapshot.
+
+    Rows committed by other connections meanwhile are not seen, so an export
+    that reads in several queries gets a consistent table.
+    """
+    if connection.in_transaction:  # Already reading from one snapshot
+        yield
+        return
+
+    connection.execute("BEGIN;")
+    try:
+        yield
+    finally:
+        connection.rollback()  # Nothing was written
+
+
+def iter_rental_chunks(chunk_size: int = DEFAULT_CHUNK_SIZE, connection=None):
+    """Yield rentals as lists of row tuples, in `EXPORT_COLUMNS` order.
+
+    Pages through `rentals` by rowid, so every chunk is an index range scan
+    no matter how far into the table it is.
+
+    Args:
+        chunk_size (int): Rows per chunk
+        connection: Connection to read from, defaults to `get_read_connection()`
+    """
+    connection = connection or get_read_connection()
+    last_rowid = 0
+    while True:
+        rows = connection.execute(EXPORT_SELECT, (last_rowid, chunk_size)).fetchall()
+        if not rows:
+            return
+        last_rowid = rows[-1][0]
+        yield [row[1:] for row in rows]
+
+
+# ====================================================
+# NPZ writer
+# ====================================================
+def _npy_header(descr: str, length: int) -> bytes:
+    """Build a version 1.0 `.npy` header for a one dimensional array."""
+    header = f"{{'descr': '{descr}', 'fortran_order': False, 'shape': ({length},), }}"
+    # Magic string, version and header length take 10 bytes; the header is
+    # padded so the data starts on a 64 byte boundary
+    padding = 64 - (10 + len(header) + 1) % 64
+    header = header + " " * padding + "\n"
+    return b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header.encode("latin1")
+
+
+def _fixed_width(values, width: int) -> bytes:
+    encoded = [(value or "").encode("utf-8") for value in values]
+    for value in encoded:
+        if len(value) > width:
+            raise ValueError(f"Value longer than its column width {width}: {value!r}")
+    return b"".join(value.ljust(width, b"\0") for value in encoded)
+
+
+def _string_widths(connection) -> Dict[str, int]:
+    widths = connection.execute(
+        f"SELECT {', '.join(f'MAX(LENGTH(CAST({c} AS BLOB)))' for c in STRING_COLUMNS)}"
+        " FROM rentals;").fetchone()
+    return {column: max(width or 0, 1) for column, width in zip(STRING_COLUMNS, widths)}
+
+
+def _write_npy(archive: zipfile.ZipFile, name: str, descr: str, length: int, source) -> None:
+    with archive.open(f"{name}.npy", "w", force_zip64=True) as f:
+        f.write(_npy_header(descr, length))
+        shutil.copyfileobj(source, f, 1 << 20)
+
+
+def export_npz(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE, connection=None) -> tuple:
+    """Export rentals to a compressed `.npz` archive.
+
+    The string column widths and every chunk are read in one transaction,
+    so rows committed during the export cannot outgrow the widths.
+
+    Returns:
+        tuple: (rows, chunks) written
+    """
+    connection = connection or get_read_connection()
+    with read_transaction(connection):
+        return _export_npz(path, chunk_size, connection)
+
+
+def _export_npz(path: str, chunk_size: int, connection) -> tuple:
+    byteorder = "<" if sys.byteorder == "little" else ">"
+    widths = _string_widths(connection)
+    encoders = {column: DictionaryEncoder() for column in DICTIONARY_COLUMNS}
+    rows = chunks = 0
+
+    with tempfile.TemporaryDirectory() as spill_dir:
+        spills = {column: open(os.path.join(spill_dir, column), "w+b")
+                  for column in EXPORT_COLUMNS}
+        try:
+            for chunk in iter_rental_chunks(chunk_size, connection):
+                for index, column in enumerate(EXPORT_COLUMNS):
+                    values = [row[index] for row in chunk]
+                    if column in widths:
+                        spills[column].write(_fixed_width(values, widths[column]))
+                    elif column in encoders:
+                        array("i", map(encoders[column].encode, values)).tofile(spills[column])
+                    else:
+                        array(INTEGER_COLUMNS[column],
+                              [-1 if value is None else value for value in values]
+                              ).tofile(spills[column])
+                rows += len(chunk)
+                chunks += 1
+
+            with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+                for column, spill in spills.items():
+                    spill.seek(0)
+                    if column in widths:
+                        descr = f"|S{widths[column]}"
+                    else:
+                        typecode = "i" if column in encoders else INTEGER_COLUMNS[column]
+                        descr = f"{byteorder}i{array(typecode).itemsize}"
+                    _write_npy(archive, column, descr, rows, spill)
+
+                for column, encoder in encoders.items():
+                    values = encoder.values
+                    width = max((len(value.encode("utf-8")) for value in values), default=1)
+                    _write_npy(archive, f"{column}_dictionary", f"|S{width}", len(values),
+                               io.BytesIO(_fixed_width(values, width)))
+        finally:
+            for spill in spills.values():
+                spill.close()
+
+    return rows, chunks
+
+
+# ====================================================
+# Parquet writer
+# ====================================================
+def export_parquet(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE, connection=None) -> tuple:
+    """Export rentals to Parquet, one row group per chunk. Requires pyarrow.
+
+    Every chunk is read in one transaction, see `read_transaction`.
+
+    Returns:
+        tuple: (rows, chunks) written
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_types = {"q": pa.int64(), "i": pa.int32()}
+    schema = pa.schema(
+        [(column, pa.string()) for column in STRING_COLUMNS]
+        + [(column, pa.dictionary(pa.int32(), pa.string())) for column in DICTIONARY_COLUMNS]
+        + [(column, arrow_types[typecode]) for column, typecode in INTEGER_COLUMNS.items()]
+    )
+
+    connection = connection or get_read_connection()
+    rows = chunks = 0
+    with read_transaction(connection), \
+            pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        for chunk in iter_rental_chunks(chunk_size, connection):
+            columns = [
+                pa.array([row[index] for row in chunk], type=field.type.value_type)
+                .dictionary_encode()
+                if column in DICTIONARY_COLUMNS
+                else pa.array([row[index] for row in chunk], type=field.type)
+                for index, (column, field) in enumerate(zip(EXPORT_COLUMNS, schema))
+            ]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+            rows += len(chunk)
+            chunks += 1
+
+    return rows, chunks
+
+
+def export_rentals(path: str, output_format: str = None,
+                   chunk_size: int = DEFAULT_CHUNK_SIZE) -> ExportResult:
+    """Export the rentals table in a columnar format.
+
+    Args:
+        path (str): Output file
+        output_format (str): 'parquet' or 'npz', defaults to Parquet if
+            pyarrow is installed
+        chunk_size (int): Rows read and encoded at a time
+
+    Raises:
+        ValueError: If the format is unknown, or Parquet is requested without pyarrow
+
+    Returns:
+        ExportResult: Rows and chunks written, with throughput
+    """
+    output_format = output_format or ("parquet" if pyarrow_available() else "npz")
+    if output_format not in FORMATS:
+        raise ValueError(f"Invalid export format: {output_format}")
+    if output_format == "parquet" and not pyarrow_available():
+        raise ValueError("Parquet export requires pyarrow.")
+
+    writer = export_parquet if output_format == "parquet" else export_npz
+    started = time.perf_counter()
+    rows, chunks = writer(path, chunk_size)
+    return ExportResult(path, output_format, rows, chunks, time.perf_counter() - started)
@@ -0,0 +1,217 @@
+"""
+In-memory membership filters for user and asset ids.
+
+Events for unknown users or assets can be rejected without querying the
+`rentals` or `assets` tables. `IdFilter` keeps a Bloom filter of the ids in
+`users` or `assets`. A Bloom filter never reports an added id as missing,
+so a known id is never rejected. An unknown id is accepted about `fp_rate`
+of the time, and then the lookup goes to the database as before.
+
+Filters are loaded on first use through `get_connection` and refreshed
+incrementally by rowid. A miss is answered from memory, without a database
+round trip, if the filter was refreshed less than `refresh_seconds` ago
+(`TOPANGA_MEMBERSHIP_REFRESH_SECONDS`, 1 second by default). Otherwise the
+rows added since the last refresh are loaded and the id checked again. An
+id added by another process can therefore be rejected for up to
+`refresh_seconds`. Code in this process that adds users or assets calls
+`invalidate_id_filters`, so the next miss refreshes at once. Ids are never
+updated in place. Deleted ids stay in the filter, and their events are
+looked up in the database.
+
+Memory is `-n * ln(fp_rate) / ln(2)^2` bits for `n` ids, see
+`bloom_memory_bytes`: 11.4 MiB for 10M ids at the default 1%.
+"""
+import math
+import os
+import time
+from typing import Tuple
+
+from topanga_queries import get_connection
+
+DEFAULT_FP_RATE = 0.01
+DEFAULT_REFRESH_SECONDS = 1.0
+DEFAULT_CAPACITY = 1024
+FILTERED_TABLES = ("users", "assets")
+
+
+def get_refresh_seconds() -> float:
+    """Longest time a miss is answered from memory, `TOPANGA_MEMBERSHIP_REFRESH_SECONDS`."""
+    return float(os.getenv("TOPANGA_MEMBERSHIP_REFRESH_SECONDS", DEFAULT_REFRESH_SECONDS))
+
+
+def bloom_num_bits(capacity: int, fp_rate: float = DEFAULT_FP_RATE) -> int:
+    """Bits a Bloom filter needs for `capacity` ids at a false positive rate."""
+    return max(8, math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+
+
+def bloom_memory_bytes(capacity: int, fp_rate: float = DEFAULT_FP_RATE) -> int:
+    """Bytes of the bit array of a Bloom filter for `capacity` ids."""
+    return (bloom_num_bits(capacity, fp_rate) + 7) // 8
+
+
+class BloomFilter:
+    """Set of strings with no false negatives and a bounded false positive rate."""
+
+    def __init__(self, capacity: int, fp_rate: float = DEFAULT_FP_RATE):
+        """
+        Args:
+            capacity (int): Ids the filter is sized for
+            fp_rate (float): False positive rate at `capacity` ids, in (0, 1)
+
+        Raises:
+            ValueError: If the capacity or false positive rate is out of range
+        """
+        if capacity < 1:
+            raise ValueError(f"Invalid capacity: {capacity}")
+        if not 0 < fp_rate < 1:
+            raise ValueError(f"Invalid false positive rate: {fp_rate}")
+
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.num_bits = bloom_num_bits(capacity, fp_rate)
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    @property
+    def memory_bytes(self) -> int:
+        """Size of the bit array."""
+        return len(self._bits)
+
+    @staticmethod
+    def _hashes(item: str) -> Tuple[int, int]:
+        # Double hashing: the k positions are h1 + i * h2. `hash` is salted
+        # per process, which is fine for a filter that lives in one process,
+        # and is cached on the string.
+        return hash(item), hash((item, 0)) | 1
+
+    def add(self, item: str) -> None:
+        """Adds an id."""
+        h1, h2 = self._hashes(item)
+        for i in range(self.num_hashes):
+            position = (h1 + i * h2) % self.num_bits
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        bits, num_bits = self._bits, self.num_bits
+        h1, h2 = self._hashes(item)
+        for i in range(self.num_hashes):
+            position = (h1 + i * h2) % num_bits
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class IdFilter:
+    """Bloom filter of the ids in the `users` or `assets` table."""
+
+    def __init__(self, table: str, fp_rate: float = DEFAULT_FP_RATE,
+                 refresh_seconds: float = None):
+        """
+        Args:
+            table (str): 'users' or 'assets'
+            fp_rate (float): False positive rate of the Bloom filter
+            refresh_seconds (float): Longest time a miss is answered without
+                refreshing, defaults to `get_refresh_seconds()`
+
+        Raises:
+            ValueError: If the table is not filtered
+        """
+        if table not in FILTERED_TABLES:
+            raise ValueError(f"Invalid membership table: {table}")
+
+        self.table = table
+        self.fp_rate = fp_rate
+        self.refresh_seconds = (
+            get_refresh_seconds() if refresh_seconds is None else refresh_seconds)
+        self.bloom = None
+        self._connection = None
+        self._refreshed_at = -math.inf
+        self._last_row = None  # (rowid, id) of the newest row loaded
+
+    def invalidate(self) -> None:
+        """Makes the next miss refresh, e.g. after adding ids."""
+        self._refreshed_at = -math.inf
+
+    def _load(self, rows: list) -> None:
+        for _, id in rows:
+            self.bloom.add(id)
+        if rows:
+            self._last_row = tuple(rows[-1])
+
+    def _rebuild(self) -> None:
+        rows = self._connection.execute(
+            f"SELECT rowid, id FROM {self.table} ORDER BY rowid;").fetchall()
+        self.bloom = BloomFilter(max(DEFAULT_CAPACITY, 2 * len(rows)), self.fp_rate)
+        self._last_row = None
+        self._load(rows)
+
+    def refresh(self) -> None:
+        """Loads the ids added since the last refresh.
+
+        Rebuilds the filter on a new connection, when it is over capacity,
+        or when the newest loaded row was deleted, since SQLite can then
+        give its rowid to a new row.
+        """
+        connection = get_connection()
+        if connection is not self._connection:
+            self._connection = connection
+            self.bloom = None
+
+        self._refreshed_at = time.monotonic()
+        if self.bloom is None or self._last_row is None:
+            self._rebuild()
+            return
+
+        rows = self._connection.execute(
+            f"SELECT rowid, id FROM {self.table} WHERE rowid >= ? ORDER BY rowid;",
+            (self._last_row[0],)).fetchall()
+        if not rows or tuple(rows[0]) != self._last_row or (
+                self.bloom.count + len(rows) - 1 > self.bloom.capacity):
+            self._rebuild()
+        else:
+            self._load(rows[1:])
+
+    def __contains__(self, id: str) -> bool:
+        if self.bloom is None or get_connection() is not self._connection:
+            self.refresh()
+        if id in self.bloom:
+            return True
+
+        if time.monotonic() - self._refreshed_at < self.refresh_seconds:
+            return False
+        self.refresh()
+        return id in self.bloom
+
+
+_filters = {}
+
+
+def get_id_filter(table: str) -> IdFilter:
+    """Returns the shared filter for a table, created on first use."""
+    if table not in _filters:
+        _filters[table] = IdFilter(table)
+    return _filters[table]
+
+
+def invalidate_id_filters() -> None:
+    """Makes the next miss of every filter refresh, call after adding users or assets."""
+    for id_filter in _filters.values():
+        id_filter.invalidate()
+
+
+def may_exist(table: str, id: str) -> bool:
+    """False only if no row in `table` has this id.
+
+    Args:
+        table (str): 'users' or 'assets'
+        id (str): User or asset `id`
+
+    Raises:
+        ValueError: If the table is not filtered
+
+    Returns:
+        bool: True if the id exists, or rarely, if it does not
+    """
+    return id in get_id_filter(table)
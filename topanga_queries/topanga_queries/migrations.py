@@ -0,0 +1,604 @@
+"""Versioned, online schema migrations for the challenge database.
+
+Migrations are applied in order by `run_migrations`, which records each one
+in `schema_migrations` with its timing and stores the version reached in the
+database header with `PRAGMA user_version`. Migrations only add to the
+schema and backfill in bounded chunks, committing after each chunk, so a
+live WAL database stays writable while they run. Each one is also safe to
+re-run, so a migration interrupted part way is simply applied again.
+"""
+import os
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable, List
+
+from topanga_queries import get_connection
+from topanga_queries.stats import hour_ms_sql, is_returned_sql, rebuild_location_stats
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# Connection whose schema version has already been checked
+_checked_connection = None
+
+
+def epoch_ms_sql(column: str) -> str:
+    """SQL expression converting an ISO8601 TEXT column to epoch milliseconds.
+
+    SQLite's date functions normalise any UTC offset, so rows written with
+    mixed offsets still compare correctly once converted. `julianday` holds
+    the time SQLite parsed, rounded to the millisecond, so the result matches
+    `rentals.to_epoch_ms`. Combining `strftime('%s')` with `strftime('%f')`
+    does not: the first is rounded and the second truncated.
+    """
+    return f"CAST(ROUND((julianday({column}) - 2440587.5) * 86400000) AS INTEGER)"
+
+
+def _columns(cur, table_name: str) -> set:
+    cur.execute(f"PRAGMA table_info({table_name});")
+    return {row[1] for row in cur.fetchall()}
+
+
+def canonical_asset_types_sql(column: str) -> str:
+    """SQL expression normalising a JSON array of asset types.
+
+    Duplicates are removed and types sorted, so arrays listing the same
+    types in a different order map to the same `asset_type_groups` row. A
+    plain `json_group_array` adds values in whatever order the planner
+    reads them, but as a window function it adds them in the window's
+    ORDER BY, so the key does not depend on the query plan.
+    """
+    return (
+        "COALESCE((SELECT json_group_array(value) OVER ("
+        "ORDER BY value ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING) "
+        f"FROM (SELECT DISTINCT value FROM json_each({column})) LIMIT 1), json_array())"
+    )
+
+
+def _rowid_chunks(cur, table_name: str, chunk_size: int):
+    """Yield (start, stop) rowid ranges covering `table_name`."""
+    cur.execute(f"SELECT MIN(rowid), MAX(rowid) FROM {table_name};")
+    low, high = cur.fetchone()
+    if low is None:
+        return
+
+    for start in range(low, high + 1, chunk_size):
+        yield start, start + chunk_size
+
+
+def backfill_in_chunks(cur, table_name: str, assignments: str, where: str,
+                       chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """Run `UPDATE table SET assignments WHERE where` one rowid range at a time.
+
+    Each chunk is committed on its own so the write lock is only held for
+    `chunk_size` rows at a time.
+
+    Args:
+        cur: Database cursor
+        table_name (str): Table to update
+        assignments (str): SQL SET clause
+        where (str): SQL condition selecting rows that still need a backfill
+        chunk_size (int): Number of rowids per chunk
+
+    Returns:
+        int: Number of rows updated
+    """
+    updated = 0
+    for start, stop in list(_rowid_chunks(cur, table_name, chunk_size)):
+        cur.execute(
+            f"""
+            UPDATE {table_name} SET {assignments}
+            WHERE rowid >= ? AND rowid < ? AND ({where});
+            """,
+            (start, stop),
+        )
+        updated += cur.rowcount
+        cur.connection.commit()
+    return updated
+
+
+EPOCH_MS_TRIGGERS = ("rentals_epoch_ms_insert", "rentals_epoch_ms_update")
+
+
+def _set_epoch_ms_sql(row: str) -> str:
+    """SET clause copying the timestamps of `row` ("NEW." or "") to the `*_ms` columns."""
+    return f"""
+                    created_at_ms = {epoch_ms_sql(f"{row}created_at")},
+                    expires_at_ms = {epoch_ms_sql(f"{row}expires_at")},
+                    returned_at_ms = {epoch_ms_sql(f"{row}returned_at")}
+    """
+
+
+def _create_epoch_ms_triggers(cur) -> None:
+    set_epoch_ms = _set_epoch_ms_sql("NEW.")
+    cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS rentals_epoch_ms_insert
+                AFTER INSERT ON rentals
+                BEGIN
+                    UPDATE rentals SET {set_epoch_ms} WHERE rowid = NEW.rowid;
+                END;
+                """)
+    cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS rentals_epoch_ms_update
+                AFTER UPDATE OF created_at, expires_at, returned_at ON rentals
+                BEGIN
+                    UPDATE rentals SET {set_epoch_ms} WHERE rowid = NEW.rowid;
+                END;
+                """)
+
+
+def migrate_epoch_timestamps(cur, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+    """Add epoch millisecond copies of the rental timestamp columns.
+
+    The ISO TEXT columns stay the source of truth, so responses are
+    unchanged. Triggers keep the `*_ms` columns in step with every insert and
+    timestamp update, including writes made while the backfill is running,
+    and the indexes let the return path filter and order in SQL.
+    """
+    existing = _columns(cur, "rentals")
+    for column in ("created_at_ms", "expires_at_ms", "returned_at_ms"):
+        if column not in existing:
+            cur.execute(f"ALTER TABLE rentals ADD COLUMN {column} INTEGER;")
+
+    _create_epoch_ms_triggers(cur)
+    cur.connection.commit()
+
+    backfill_in_chunks(
+        cur,
+        "rentals",
+        _set_epoch_ms_sql(""),
+        "created_at_ms IS NULL"
+        " OR expires_at_ms IS NULL"
+        " OR (returned_at IS NOT NULL AND returned_at_ms IS NULL)",
+        chunk_size,
+    )
+
+    cur.execute("""
+                CREATE INDEX IF NOT EXISTS rentals_user_id_status_created_at_ms
+                ON rentals(user_id, status, created_at_ms);
+                """)
+    cur.execute("""
+                CREATE INDEX IF NOT EXISTS rentals_status_expires_at_ms
+                ON rentals(status, expires_at_ms);
+                """)
+    # Superseded by the epoch indexes above
+    cur.execute("DROP INDEX IF EXISTS rentals_user_id_status;")
+    cur.execute("DROP INDEX IF EXISTS rentals_status_expires_at;")
+    cur.connection.commit()
+
+
+def migrate_eligibility_groups(cur, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+    """Normalise `rentals.eligible_asset_types` into asset type groups.
+
+    Every distinct set of eligible asset types becomes one `asset_type_groups`
+    row with a small integer id, and `asset_type_group_members` maps each
+    asset type to the groups accepting it. Rentals reference their group
+    through `eligible_group_id`, so "IN_PROGRESS rentals for this user that
+    accept asset type X" is answered from the
+    `rentals_user_id_status_created_at_ms_group` index alone.
+
+    The JSON column is kept for existing writers; triggers assign the group
+    of every inserted or updated rental from it.
+    """
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS asset_type_groups(
+                    id INTEGER PRIMARY KEY,
+                    asset_types JSON NOT NULL UNIQUE
+                );
+                """)
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS asset_type_group_members(
+                    asset_type TEXT NOT NULL,
+                    group_id INTEGER NOT NULL REFERENCES asset_type_groups(id),
+                    PRIMARY KEY (asset_type, group_id)
+                ) WITHOUT ROWID;
+                """)
+    if "eligible_group_id" not in _columns(cur, "rentals"):
+        cur.execute("""
+                    ALTER TABLE rentals ADD COLUMN eligible_group_id INTEGER
+                    REFERENCES asset_type_groups(id);
+                    """)
+
+    assign_group = f"""
+                    INSERT OR IGNORE INTO asset_type_groups(asset_types)
+                    VALUES ({canonical_asset_types_sql("NEW.eligible_asset_types")});
+                    INSERT OR IGNORE INTO asset_type_group_members(asset_type, group_id)
+                    SELECT member.value, asset_type_groups.id
+                    FROM asset_type_groups, json_each(asset_type_groups.asset_types) AS member
+                    WHERE asset_type_groups.asset_types =
+                        {canonical_asset_types_sql("NEW.eligible_asset_types")};
+                    UPDATE rentals SET eligible_group_id = (
+                        SELECT id FROM asset_type_groups WHERE asset_types =
+                            {canonical_asset_types_sql("NEW.eligible_asset_types")}
+                    ) WHERE rowid = NEW.rowid;
+    """
+    cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS rentals_eligible_group_insert
+                AFTER INSERT ON rentals
+                BEGIN {assign_group} END;
+                """)
+    cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS rentals_eligible_group_update
+                AFTER UPDATE OF eligible_asset_types ON rentals
+                BEGIN {assign_group} END;
+                """)
+    cur.connection.commit()
+
+    canonical = canonical_asset_types_sql("eligible_asset_types")
+    for start, stop in list(_rowid_chunks(cur, "rentals", chunk_size)):
+        cur.execute(
+            f"""
+            INSERT OR IGNORE INTO asset_type_groups(asset_types)
+            SELECT DISTINCT {canonical} FROM rentals
+            WHERE rowid >= ? AND rowid < ? AND eligible_group_id IS NULL;
+            """,
+            (start, stop),
+        )
+        cur.connection.commit()
+    cur.execute("""
+                INSERT OR IGNORE INTO asset_type_group_members(asset_type, group_id)
+                SELECT member.value, asset_type_groups.id
+                FROM asset_type_groups, json_each(asset_type_groups.asset_types) AS member;
+                """)
+    cur.connection.commit()
+
+    backfill_in_chunks(
+        cur,
+        "rentals",
+        f"eligible_group_id = (SELECT id FROM asset_type_groups WHERE asset_types = {canonical})",
+        "eligible_group_id IS NULL",
+        chunk_size,
+    )
+
+    # Covers the whole "oldest eligible rental" lookup: equality on user and
+    # status, created_at_ms order, and group/expiry filters from the index.
+    cur.execute("""
+                CREATE INDEX IF NOT EXISTS rentals_user_id_status_created_at_ms_group
+                ON rentals(user_id, status, created_at_ms, eligible_group_id, expires_at_ms);
+                """)
+    cur.execute("DROP INDEX IF EXISTS rentals_user_id_status_created_at_ms;")
+    cur.connection.commit()
+
+
+def migrate_outbox(cur, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+    """Add the `outbox` table for return results awaiting publication.
+
+    Rows are written in the same transaction as the rental they describe and
+    deleted once a publisher has handed them to the downstream sink.
+    """
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS outbox(
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    topic TEXT NOT NULL,
+                    payload JSON NOT NULL,
+                    created_at_ms INTEGER NOT NULL
+                );
+                """)
+    cur.connection.commit()
+
+
+def _location_stats_sql(row: str, delta: int) -> str:
+    """Trigger statements adding `delta` for `row` (NEW or OLD) to the location stats."""
+    return f"""
+        INSERT INTO location_return_stats(location_id, hour_ms, asset_type, returns)
+        SELECT {row}.returned_at_location_id, {hour_ms_sql(f"{row}.returned_at")},
+               COALESCE((SELECT asset_type FROM assets WHERE id = {row}.asset_id), 'unknown'),
+               {delta}
+        WHERE {is_returned_sql(row)}
+        ON CONFLICT(location_id, hour_ms, asset_type)
+        DO UPDATE SET returns = returns + excluded.returns;
+
+        INSERT INTO location_in_progress(location_id, in_progress)
+        SELECT {row}.created_at_location_id, {delta}
+        WHERE {row}.status = 'IN_PROGRESS'
+        ON CONFLICT(location_id) DO UPDATE SET in_progress = in_progress + excluded.in_progress;
+    """
+
+
+LOCATION_STATS_TRIGGERS = (
+    "rentals_location_stats_insert",
+    "rentals_location_stats_update",
+    "rentals_location_stats_delete",
+)
+
+
+def _create_location_stats_triggers(cur) -> None:
+    cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS rentals_location_stats_insert
+                AFTER INSERT ON rentals
+                BEGIN {_location_stats_sql("NEW", 1)} END;
+                """)
+    cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS rentals_location_stats_update
+                AFTER UPDATE OF asset_id, created_at_location_id, status,
+                    returned_at_location_id, returned_at ON rentals
+                BEGIN {_location_stats_sql("OLD", -1)} {_location_stats_sql("NEW", 1)} END;
+                """)
+    cur.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS rentals_location_stats_delete
+                AFTER DELETE ON rentals
+                BEGIN {_location_stats_sql("OLD", -1)} END;
+                """)
+
+
+def migrate_location_stats(cur, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+    """Add incrementally maintained per-location statistics, see `stats`.
+
+    The triggers apply the difference between the old and new row of every
+    write to `rentals`, in the writer's own transaction. The initial counts
+    come from `rebuild_location_stats`, which runs in a single transaction
+    because trigger deltas applied during a chunked rebuild would be counted
+    twice.
+    """
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS location_return_stats(
+                    location_id TEXT NOT NULL,
+                    hour_ms INTEGER NOT NULL,
+                    asset_type TEXT NOT NULL,
+                    returns INTEGER NOT NULL,
+                    PRIMARY KEY (location_id, hour_ms, asset_type)
+                ) WITHOUT ROWID;
+                """)
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS location_in_progress(
+                    location_id TEXT NOT NULL PRIMARY KEY,
+                    in_progress INTEGER NOT NULL
+                ) WITHOUT ROWID;
+                """)
+    _create_location_stats_triggers(cur)
+    rebuild_location_stats(cur.connection)
+
+
+def migrate_user_history_index(cur, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+    """Index a user's rentals by creation time, whatever their status.
+
+    `iter_rentals_for_user` without a status streams the user's whole
+    history oldest first, and reads it in that order from this index instead
+    of sorting every row of the user before returning the first one.
+    """
+    cur.execute("""
+                CREATE INDEX IF NOT EXISTS rentals_user_id_created_at_ms
+                ON rentals(user_id, created_at_ms);
+                """)
+    cur.connection.commit()
+
+
+def migrate_location_stats_returned_at(cur, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+    """Recreate the location stats triggers to skip rentals without a valid `returned_at`.
+
+    Such a rental has no `hour_ms`, and the NOT NULL constraint failing
+    inside a trigger aborted the rental write itself. The triggers are
+    swapped in one transaction, so no concurrent write goes uncounted.
+    """
+    cur.execute("BEGIN IMMEDIATE;")
+    for trigger in LOCATION_STATS_TRIGGERS:
+        cur.execute(f"DROP TRIGGER IF EXISTS {trigger};")
+    _create_location_stats_triggers(cur)
+    cur.connection.commit()
+
+
+def migrate_epoch_ms_rounding(cur, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+    """Recompute the `*_ms` columns with the rounding `rentals.to_epoch_ms` uses.
+
+    They were built from `strftime('%s')` and `strftime('%f')`, which round
+    and truncate sub-millisecond times differently, so a value could be off
+    by a millisecond, or a second just before a full second. The triggers
+    are swapped in one transaction, then rows whose values differ are
+    rewritten in chunks.
+    """
+    cur.execute("BEGIN IMMEDIATE;")
+    for trigger in EPOCH_MS_TRIGGERS:
+        cur.execute(f"DROP TRIGGER IF EXISTS {trigger};")
+    _create_epoch_ms_triggers(cur)
+    cur.connection.commit()
+
+    backfill_in_chunks(
+        cur,
+        "rentals",
+        _set_epoch_ms_sql(""),
+        f"created_at_ms IS NOT {epoch_ms_sql('created_at')}"
+        f" OR expires_at_ms IS NOT {epoch_ms_sql('expires_at')}"
+        f" OR returned_at_ms IS NOT {epoch_ms_sql('returned_at')}",
+        chunk_size,
+    )
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    apply: Callable  # apply(cur, chunk_size)
+
+
+@dataclass
+class MigrationResult:
+    version: int
+    name: str
+    duration_seconds: float
+
+
+# Ordered by version; append new migrations, never edit applied ones
+MIGRATIONS = [
+    Migration(1, "epoch_timestamps", migrate_epoch_timestamps),
+    Migration(2, "eligibility_groups", migrate_eligibility_groups),
+    Migration(3, "outbox", migrate_outbox),
+    Migration(4, "location_stats", migrate_location_stats),
+    Migration(5, "user_history_index", migrate_user_history_index),
+    Migration(6, "location_stats_returned_at", migrate_location_stats_returned_at),
+    Migration(7, "epoch_ms_rounding", migrate_epoch_ms_rounding),
+]
+
+# Version of a fully migrated database
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+class SchemaOutdatedError(ValueError):
+    """The database has records but an older schema, and needs `migrate-db`."""
+
+
+def _tables(connection) -> set:
+    return {row[0] for row in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table';")}
+
+
+def get_schema_version(connection=None) -> int:
+    """Read the schema version from the database header."""
+    connection = connection or get_connection()
+    return connection.execute("PRAGMA user_version;").fetchone()[0]
+
+
+def check_schema_version(connection=None) -> int:
+    """Check the connected database has the schema this code expects.
+
+    Reading `user_version` costs no catalog scan, and the result is cached
+    per connection, so long-running processes only check once. A database
+    from before versioning has version 0 but already has a `rentals` table,
+    and is told to migrate rather than to initialize.
+
+    Args:
+        connection: Database to check, defaults to the shared connection
+
+    Raises:
+        SchemaOutdatedError: If the database needs migrating
+        ValueError: If the database is uninitialized
+
+    Returns:
+        int: Schema version of the database
+    """
+    global _checked_connection
+
+    connection = connection or get_connection()
+    if _checked_connection is connection:
+        return SCHEMA_VERSION
+
+    version = get_schema_version(connection)
+    if version == 0 and "rentals" not in _tables(connection):
+        raise ValueError("Database is not initialized.")
+    if version < SCHEMA_VERSION:
+        raise SchemaOutdatedError(
+            f"Database schema version {version} is older than {SCHEMA_VERSION}, "
+            "run migrate-db."
+        )
+
+    _checked_connection = connection
+    return version
+
+
+# (connection, version) of the newest migration seen complete on it
+_completed = (None, 0)
+
+
+def migration_complete(name: str) -> bool:
+    """Check whether a migration, backfill included, has been applied.
+
+    A migration's version is only recorded once its backfill has finished,
+    so until then the columns it adds may still be NULL on some rows.
+    Versions only go up, so a positive answer is cached per connection.
+
+    Args:
+        name (str): Migration name, e.g. 'epoch_timestamps'
+
+    Raises:
+        ValueError: If there is no migration with that name
+
+    Returns:
+        bool: True if the connected database is at or past the migration
+    """
+    global _completed
+
+    versions = {migration.name: migration.version for migration in MIGRATIONS}
+    if name not in versions:
+        raise ValueError(f"Unknown migration: {name}")
+
+    connection = get_connection()
+    if _completed[0] is connection and _completed[1] >= versions[name]:
+        return True
+
+    version = get_schema_version(connection)
+    _completed = (connection, version)
+    return version >= versions[name]
+
+
+def run_migrations(connection=None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> List[MigrationResult]:
+    """Apply pending migrations in version order.
+
+    Args:
+        connection: Database to migrate, defaults to the shared connection
+        chunk_size (int): Rows per backfill transaction
+
+    Returns:
+        List[MigrationResult]: Migrations applied and how long each took
+    """
+    connection = connection or get_connection()
+    cur = connection.cursor()
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations(
+                    version INTEGER NOT NULL PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TEXT NOT NULL,
+                    duration_seconds REAL NOT NULL,
+                    chunk_size INTEGER NOT NULL
+                );
+                """)
+    connection.commit()
+
+    current = get_schema_version(connection)
+    results = []
+    for migration in MIGRATIONS:
+        if migration.version <= current:
+            continue
+
+        started = time.perf_counter()
+        migration.apply(cur, chunk_size)
+        duration = time.perf_counter() - started
+
+        cur.execute(
+            "INSERT OR REPLACE INTO schema_migrations VALUES (?, ?, ?, ?, ?);",
+            (migration.version, migration.name,
+             datetime.now(timezone.utc).isoformat(), duration, chunk_size),
+        )
+        cur.execute(f"PRAGMA user_version = {migration.version};")
+        connection.commit()
+
+        results.append(MigrationResult(migration.version, migration.name, duration))
+        print(f"Applied migration {migration.version} ({migration.name}) in {duration:.3f}s")
+
+    cur.close()
+    return results
+
+
+def dry_run_migrations(connection=None, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                       copy_path: str = None) -> List[MigrationResult]:
+    """Apply pending migrations to a copy of the database, leaving it untouched.
+
+    The copy is taken with the SQLite backup API, so it is consistent even
+    while the database is being written to. Timings from the copy show how
+    long each migration will take on the live database.
+
+    Args:
+        connection: Database to copy, defaults to the shared connection
+        chunk_size (int): Rows per backfill transaction
+        copy_path (str): Where to write the copy, defaults to a temporary file
+
+    Returns:
+        List[MigrationResult]: Migrations applied to the copy and their timings
+    """
+    import sqlite3
+    import tempfile
+
+    connection = connection or get_connection()
+    keep_copy = copy_path is not None
+    if not keep_copy:
+        fd, copy_path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+
+    copy = sqlite3.connect(copy_path)
+    try:
+        connection.backup(copy)
+        return run_migrations(copy, chunk_size)
+    finally:
+        copy.close()
+        if not keep_copy:
+            for path in (copy_path, f"{copy_path}-wal", f"{copy_path}-shm"):
+                if os.path.exists(path):
+                    os.remove(path)
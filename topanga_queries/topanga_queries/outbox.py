@@ -0,0 +1,114 @@
+"""
+Transactional outbox of messages for downstream topics.
+
+Messages are written in the transaction of the change they describe and
+stay in `outbox` until a publisher deletes them after delivery, see
+`rental_return_events.publisher`. Nothing else removes them, so with no
+publisher running the table grows with every write. Set
+`TOPANGA_OUTBOX=off` to skip the outbox where nothing drains it.
+
+Failure responses are only written with `TOPANGA_OUTBOX_FAILURES=on`. A
+rejected event otherwise writes nothing, and costs no commit.
+"""
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Union
+
+from topanga_queries import get_connection
+
+OUTBOX_MODES = ("on", "off")
+
+
+@dataclass
+class OutboxMessage:
+    id: int
+    topic: str
+    payload: dict
+    created_at_ms: int
+
+
+def get_outbox_mode() -> str:
+    """Outbox mode from `TOPANGA_OUTBOX`, 'on' unless set."""
+    mode = os.getenv("TOPANGA_OUTBOX", "on")
+    if mode not in OUTBOX_MODES:
+        raise ValueError(f"Invalid TOPANGA_OUTBOX: {mode}")
+    return mode
+
+
+def get_failure_outbox_mode() -> str:
+    """Outbox mode of failure responses from `TOPANGA_OUTBOX_FAILURES`, 'off' unless set."""
+    mode = os.getenv("TOPANGA_OUTBOX_FAILURES", "off")
+    if mode not in OUTBOX_MODES:
+        raise ValueError(f"Invalid TOPANGA_OUTBOX_FAILURES: {mode}")
+    return mode
+
+
+def enqueue_message(topic: str, payload: Union[dict, str], commit: bool = True) -> int:
+    """Add a message to the outbox.
+
+    Pass `commit=False` to write the message in the caller's open
+    transaction, e.g. together with the rental update it describes.
+
+    Args:
+        topic (str): Downstream topic or queue name
+        payload (Union[dict, str]): JSON serializable message body, or a str
+            holding the body already encoded as JSON
+        commit (bool): Commit the write connection after inserting
+
+    Returns:
+        int: Outbox `id` of the message
+    """
+    cur = get_connection().cursor()
+    cur.execute(
+        "INSERT INTO outbox(topic, payload, created_at_ms) VALUES (?, ?, ?);",
+        (topic, payload if isinstance(payload, str) else json.dumps(payload),
+         int(time.time() * 1000)),
+    )
+    message_id = cur.lastrowid
+    if commit:
+        cur.connection.commit()
+    cur.close()
+    return message_id
+
+
+def fetch_outbox_batch(connection=None, limit: int = 100) -> List[OutboxMessage]:
+    """Get the oldest outbox messages, in insertion order.
+
+    Args:
+        connection: Connection to read from, defaults to `get_connection()`
+        limit (int): Maximum number of messages
+
+    Returns:
+        List[OutboxMessage]: Messages awaiting publication
+    """
+    connection = connection or get_connection()
+    rows = connection.execute(
+        "SELECT id, topic, payload, created_at_ms FROM outbox ORDER BY id LIMIT ?;",
+        (limit,),
+    ).fetchall()
+    return [OutboxMessage(id, topic, json.loads(payload), created_at_ms)
+            for id, topic, payload, created_at_ms in rows]
+
+
+def delete_outbox_messages(ids: List[int], connection=None) -> None:
+    """Delete published messages from the outbox and commit."""
+    connection = connection or get_connection()
+    connection.executemany("DELETE FROM outbox WHERE id = ?;", [(id,) for id in ids])
+    connection.commit()
+
+
+def outbox_backlog(connection=None) -> tuple:
+    """Get the number of pending messages and the age of the oldest one.
+
+    Returns:
+        tuple: (pending, oldest_age_seconds), the age is None when empty
+    """
+    connection = connection or get_connection()
+    pending, oldest_ms = connection.execute(
+        "SELECT COUNT(*), MIN(created_at_ms) FROM outbox;").fetchone()
+    oldest_age: Optional[float] = None
+    if oldest_ms is not None:
+        oldest_age = max(0.0, time.time() - oldest_ms / 1000)
+    return pending, oldest_age
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+import argparse
+
+from topanga_queries.export import DEFAULT_CHUNK_SIZE, FORMATS, export_rentals
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the rentals table to Parquet or compressed NPZ.")
+    parser.add_argument("output", help="output file, e.g. rentals.parquet or rentals.npz")
+    parser.add_argument("--format", choices=FORMATS,
+                        help="default: parquet if pyarrow is installed, npz otherwise")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="rows read and encoded at a time")
+    args = parser.parse_args()
+
+    result = export_rentals(args.output, args.format, args.chunk_size)
+    print(f"Exported {result.rows} rentals to {result.path} ({result.output_format}) "
+          f"in {result.chunks} chunks, {result.elapsed_seconds:.2f}s "
+          f"({result.rows_per_second:.0f} rows/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+import argparse
+
+from topanga_queries.migrations import (
+    DEFAULT_CHUNK_SIZE,
+    dry_run_migrations,
+    get_schema_version,
+    run_migrations,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="migrate a copy of the database instead")
+    parser.add_argument("--copy-path", help="where to keep the --dry-run copy")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="rows per backfill transaction")
+    args = parser.parse_args()
+
+    print(f"Database at schema version {get_schema_version()}")
+    if args.dry_run:
+        results = dry_run_migrations(chunk_size=args.chunk_size, copy_path=args.copy_path)
+    else:
+        results = run_migrations(chunk_size=args.chunk_size)
+
+    if not results:
+        print("No pending migrations")
+
+
+if __name__ == "__main__":
+    main()
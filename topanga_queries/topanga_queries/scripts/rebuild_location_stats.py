@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+import argparse
+
+from topanga_queries.stats import get_in_progress_counts, list_return_stats, rebuild_location_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Recompute the per-location return statistics from the rentals table.")
+    parser.parse_args()
+
+    rebuild_location_stats()
+    print(f"Rebuilt {len(list_return_stats())} return stats rows and "
+          f"{len(get_in_progress_counts())} in-progress counts")
+
+
+if __name__ == "__main__":
+    main()
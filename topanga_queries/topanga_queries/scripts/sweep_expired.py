@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+import argparse
+from datetime import datetime
+
+from topanga_queries.sweeper import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_MAX_ROWS_PER_SECOND,
+    sweep_expired_rentals,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flag overdue IN_PROGRESS rentals.")
+    parser.add_argument("--as-of", type=datetime.fromisoformat,
+                        help="ISO8601 cut-off timestamp (default: now)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--max-rows-per-second", type=float,
+                        default=DEFAULT_MAX_ROWS_PER_SECOND)
+    args = parser.parse_args()
+
+    result = sweep_expired_rentals(args.as_of, args.chunk_size, args.max_rows_per_second)
+    print(f"Flagged {result.flagged} rentals in {result.chunks} chunks "
+          f"({result.elapsed_seconds:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Per-location return statistics for ops dashboards.
+
+`location_return_stats` counts returns per return location, hour and asset
+type, and `location_in_progress` counts IN_PROGRESS rentals per creation
+location. Triggers added by `migrations.migrate_location_stats` keep both up
+to date inside the transaction of every rental insert, update and delete, so
+`complete_rental` and the rental-creation path maintain them without any
+extra calls. `rebuild_location_stats` recomputes them from `rentals`.
+"""
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from topanga_queries import get_connection, get_read_connection
+from topanga_queries.rentals import EPOCH, to_epoch_ms
+
+HOUR_MS = 3600 * 1000
+
+
+def is_returned_sql(row: str) -> str:
+    """SQL condition for a rental that left IN_PROGRESS with a return location and time.
+
+    Rentals whose `returned_at` is missing or not a valid time have no hour
+    to be counted in, and are left out.
+    """
+    return (f"{row}.status != 'IN_PROGRESS' AND {row}.returned_at_location_id IS NOT NULL "
+            f"AND strftime('%s', {row}.returned_at) IS NOT NULL")
+
+
+def hour_ms_sql(column: str) -> str:
+    """SQL expression truncating an ISO8601 TEXT column to its hour, in epoch ms."""
+    return f"(CAST(strftime('%s', {column}) AS INTEGER) / 3600 * {HOUR_MS})"
+
+
+@dataclass
+class LocationReturnStats:
+    location_id: str
+    hour: datetime
+    asset_type: str
+    returns: int
+
+
+def rebuild_location_stats(connection=None) -> None:
+    """Recompute the location statistics from scratch, e.g. after a backfill.
+
+    Runs in a single transaction: concurrent writers wait for it instead of
+    applying trigger deltas to partially rebuilt counts.
+
+    Args:
+        connection: Connection to rebuild through, defaults to `get_connection()`
+    """
+    connection = connection or get_connection()
+    cur = connection.cursor()
+    cur.execute("DELETE FROM location_return_stats;")
+    cur.execute("DELETE FROM location_in_progress;")
+    cur.execute(f"""
+                INSERT INTO location_return_stats(location_id, hour_ms, asset_type, returns)
+                SELECT rentals.returned_at_location_id,
+                       {hour_ms_sql("rentals.returned_at")},
+                       COALESCE(assets.asset_type, 'unknown'),
+                       COUNT(*)
+                FROM rentals LEFT JOIN assets ON assets.id = rentals.asset_id
+                WHERE {is_returned_sql("rentals")}
+                GROUP BY 1, 2, 3;
+                """)
+    cur.execute("""
+                INSERT INTO location_in_progress(location_id, in_progress)
+                SELECT created_at_location_id, COUNT(*) FROM rentals
+                WHERE status = 'IN_PROGRESS'
+                GROUP BY created_at_location_id;
+                """)
+    connection.commit()
+    cur.close()
+
+
+def list_return_stats(
+    location_id: str = None, since: datetime = None, until: datetime = None
+) -> List[LocationReturnStats]:
+    """Get hourly return counts per location and asset type.
+
+    Routed to the read connection, see `get_read_connection`.
+
+    Args:
+        location_id (str): Only this return location, defaults to all
+        since (datetime): Only hours starting at or after this timestamp
+        until (datetime): Only hours starting before this timestamp
+
+    Returns:
+        List[LocationReturnStats]: Ordered by location, hour and asset type,
+            without empty hours
+    """
+    conditions, params = ["returns > 0"], []  # Rows counted down to 0 are kept
+    if location_id is not None:
+        conditions.append("location_id = ?")
+        params.append(location_id)
+    if since is not None:
+        conditions.append("hour_ms >= ?")
+        params.append(to_epoch_ms(since) // HOUR_MS * HOUR_MS)
+    if until is not None:
+        conditions.append("hour_ms < ?")
+        params.append(to_epoch_ms(until))
+    where = f"WHERE {' AND '.join(conditions)}"
+
+    cur = get_read_connection().cursor()
+    cur.execute(
+        f"""
+        SELECT location_id, hour_ms, asset_type, returns FROM location_return_stats
+        {where}
+        ORDER BY location_id, hour_ms, asset_type
+        """,
+        params,
+    )
+    return [
+        LocationReturnStats(location_id, EPOCH + timedelta(milliseconds=hour_ms),
+                            asset_type, returns)
+        for location_id, hour_ms, asset_type, returns in cur.fetchall()
+    ]
+
+
+def get_in_progress_counts() -> Dict[str, int]:
+    """Get the number of IN_PROGRESS rentals per creation location.
+
+    Routed to the read connection, see `get_read_connection`.
+
+    Returns:
+        Dict[str, int]: Location ID to in-progress count, without empty locations
+    """
+    cur = get_read_connection().cursor()
+    cur.execute(
+        "SELECT location_id, in_progress FROM location_in_progress WHERE in_progress > 0;")
+    return dict(cur.fetchall())
@@ -0,0 +1,64 @@
+"""Bulk sweeper that flags overdue rentals.
+
+Rentals that are still IN_PROGRESS after `expires_at` are marked FLAGGED so
+they drop out of the return path's candidate set. Overdue rentals are found
+through the `rentals_status_expires_at_ms` index and flagged in small chunks,
+each in its own transaction, with a rate limit between chunks so kiosk
+writes are never starved of the database write lock.
+"""
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from topanga_queries.rentals import flag_expired_rentals
+
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_MAX_ROWS_PER_SECOND = 5000
+
+
+@dataclass
+class SweepResult:
+    flagged: int
+    chunks: int
+    elapsed_seconds: float
+
+
+def sweep_expired_rentals(
+    as_of: datetime = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    max_rows_per_second: float = DEFAULT_MAX_ROWS_PER_SECOND,
+) -> SweepResult:
+    """Flag every IN_PROGRESS Rental that expired at or before `as_of`.
+
+    Args:
+        as_of (datetime): Cut-off timestamp, defaults to now
+        chunk_size (int): Rentals flagged per transaction
+        max_rows_per_second (float): Upper bound on the flagging rate
+
+    Raises:
+        ValueError: If `chunk_size` or `max_rows_per_second` is not positive
+
+    Returns:
+        SweepResult: Number of Rentals flagged and chunks used
+    """
+    if chunk_size <= 0 or max_rows_per_second <= 0:
+        raise ValueError("chunk_size and max_rows_per_second must be positive.")
+
+    expired_at = as_of or datetime.now(timezone.utc)
+
+    started = time.monotonic()
+    flagged = chunks = 0
+    while True:
+        count = flag_expired_rentals(expired_at, chunk_size)
+        flagged += count
+        chunks += 1
+        if count < chunk_size:
+            break
+
+        # Sleep off any time we are ahead of the allowed rate; the write lock
+        # is released between chunks so kiosk returns can interleave.
+        delay = flagged / max_rows_per_second - (time.monotonic() - started)
+        if delay > 0:
+            time.sleep(delay)
+
+    return SweepResult(flagged, chunks, time.monotonic() - started)
@@ -0,0 +1,251 @@
+"""SQL query tracing and slow-query log.
+
+Set `TOPANGA_SQL_TRACE=1` and every connection `topanga_queries` opens is a
+`TracingConnection`. Its cursors time `execute`/`executemany` and every
+fetch, count the rows returned, and count SQLite virtual machine steps
+through a progress handler as a measure of how many rows a query scanned.
+Totals are kept per query fingerprint, the SQL text with whitespace
+collapsed and literals replaced by `?`.
+
+Statements run inside `trace_event` are also counted per event, such as
+one return, and `get_event_query_stats` reports how many statements events
+took and which ones the worst event ran, so an N+1 pattern stands out even
+when each of its queries is fast.
+
+A query whose execution takes longer than `TOPANGA_SLOW_QUERY_MS`
+(default 100) is logged once to the `topanga_queries.sql` logger together
+with its `EXPLAIN QUERY PLAN`, so a full table scan shows up as `SCAN`.
+
+With tracing off, connections are plain `sqlite3.Connection` objects.
+"""
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, replace
+from typing import Dict, Iterator, List, Optional
+
+DEFAULT_SLOW_QUERY_MS = 100.0
+# Progress handler granularity, in SQLite virtual machine instructions
+PROGRESS_STEPS = 100
+
+logger = logging.getLogger("topanga_queries.sql")
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+
+@dataclass
+class QueryStats:
+    fingerprint: str
+    count: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+    rows: int = 0
+    vm_steps: int = 0
+    slow: int = 0
+
+
+@dataclass
+class EventQueryStats:
+    events: int = 0
+    # Statements per event -> number of events
+    histogram: Dict[int, int] = field(default_factory=dict)
+    max_queries: int = 0
+    # Fingerprint -> executions, in the event with the most statements
+    max_event: Dict[str, int] = field(default_factory=dict)
+
+
+_stats: Dict[str, QueryStats] = {}
+_event_stats = EventQueryStats()
+_stats_lock = threading.Lock()
+# Fingerprints of the statements run in the current `trace_event`
+_event_queries: ContextVar[Optional[List[str]]] = ContextVar("event_queries", default=None)
+
+
+def tracing_enabled() -> bool:
+    """Whether `TOPANGA_SQL_TRACE` is set."""
+    return os.getenv("TOPANGA_SQL_TRACE", "") not in ("", "0")
+
+
+def fingerprint(sql: str) -> str:
+    """Normalise SQL text so executions of the same query group together."""
+    sql = _LITERALS.sub("?", " ".join(sql.split()))
+    return _PLACEHOLDER_LISTS.sub("(?, ...)", sql).rstrip(";").strip()
+
+
+def get_query_stats() -> Dict[str, QueryStats]:
+    """Copy of the per-fingerprint totals recorded so far."""
+    with _stats_lock:
+        return {key: replace(stats) for key, stats in _stats.items()}
+
+
+def get_event_query_stats() -> EventQueryStats:
+    """Copy of the per-event statement counts recorded by `trace_event`."""
+    with _stats_lock:
+        return replace(_event_stats, histogram=dict(_event_stats.histogram),
+                       max_event=dict(_event_stats.max_event))
+
+
+def reset_query_stats() -> None:
+    """Clears the recorded totals and per-event counts."""
+    global _event_stats
+
+    with _stats_lock:
+        _stats.clear()
+        _event_stats = EventQueryStats()
+
+
+@contextmanager
+def trace_event() -> Iterator[Optional[List[str]]]:
+    """Counts the statements run until exit as one event's, when tracing is on.
+
+    The count is kept in a context variable, so events on other threads are
+    counted apart, and is recorded in `get_event_query_stats` on exit.
+
+    Yields:
+        Optional[List[str]]: Fingerprints of the statements run so far, None
+            when tracing is off
+    """
+    if not tracing_enabled():
+        yield None
+        return
+
+    queries = []
+    token = _event_queries.set(queries)
+    try:
+        yield queries
+    finally:
+        _event_queries.reset(token)
+        with _stats_lock:
+            _event_stats.events += 1
+            _event_stats.histogram[len(queries)] = _event_stats.histogram.get(len(queries), 0) + 1
+            if len(queries) > _event_stats.max_queries:
+                _event_stats.max_queries = len(queries)
+                _event_stats.max_event = dict(Counter(queries))
+
+
+class _Execution:
+    """One execution of a statement, accumulated over execute and fetches."""
+
+    __slots__ = ("sql", "parameters", "stats", "seconds", "logged")
+
+    def __init__(self, sql, parameters):
+        self.sql = sql
+        self.parameters = parameters
+        self.seconds = 0.0
+        self.logged = False
+        key = fingerprint(sql)
+        with _stats_lock:
+            self.stats = _stats.setdefault(key, QueryStats(key))
+            self.stats.count += 1
+        queries = _event_queries.get()
+        if queries is not None:
+            queries.append(key)
+
+
+class TracingCursor(sqlite3.Cursor):
+    """Cursor that records the time, rows and VM steps of each statement."""
+
+    _execution = None
+
+    def _timed(self, call, *args):
+        steps = self.connection.vm_steps
+        started = time.perf_counter()
+        try:
+            return call(*args)
+        finally:
+            self._record(time.perf_counter() - started, self.connection.vm_steps - steps)
+
+    def _record(self, seconds: float, steps: int, rows: int = 0) -> None:
+        execution = self._execution
+        if execution is None:
+            return
+
+        execution.seconds += seconds
+        with _stats_lock:
+            stats = execution.stats
+            stats.total_seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, execution.seconds)
+            stats.rows += rows
+            stats.vm_steps += steps * PROGRESS_STEPS
+
+        if not execution.logged and execution.seconds * 1000 > self.connection.slow_query_ms:
+            execution.logged = True
+            with _stats_lock:
+                stats.slow += 1
+            self.connection.log_slow_query(execution.sql, execution.parameters,
+                                           execution.seconds)
+
+    def execute(self, sql, parameters=()):
+        self._execution = _Execution(sql, parameters)
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        self._execution = _Execution(sql, seq_of_parameters[0] if seq_of_parameters else ())
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def fetchone(self):
+        steps, started = self.connection.vm_steps, time.perf_counter()
+        row = super().fetchone()
+        self._record(time.perf_counter() - started,
+                     self.connection.vm_steps - steps, int(row is not None))
+        return row
+
+    def fetchmany(self, size=None):
+        steps, started = self.connection.vm_steps, time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._record(time.perf_counter() - started, self.connection.vm_steps - steps, len(rows))
+        return rows
+
+    def fetchall(self):
+        steps, started = self.connection.vm_steps, time.perf_counter()
+        rows = super().fetchall()
+        self._record(time.perf_counter() - started, self.connection.vm_steps - steps, len(rows))
+        return rows
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+
+class TracingConnection(sqlite3.Connection):
+    """Connection whose cursors are `TracingCursor`s."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.vm_steps = 0
+        self.slow_query_ms = float(os.getenv("TOPANGA_SLOW_QUERY_MS", DEFAULT_SLOW_QUERY_MS))
+        self.set_progress_handler(self._count_steps, PROGRESS_STEPS)
+
+    def _count_steps(self) -> int:
+        self.vm_steps += 1
+        return 0  # Never interrupt the query
+
+    def cursor(self, factory=TracingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def log_slow_query(self, sql: str, parameters, seconds: float) -> None:
+        """Logs a slow query with its query plan."""
+        try:
+            # The base class `execute` uses a plain cursor, so this is not traced
+            plan = sqlite3.Connection.execute(
+                self, f"EXPLAIN QUERY PLAN {sql}", parameters).fetchall()
+            plan = "\n".join(f"  {detail}" for *_, detail in plan)
+        except sqlite3.Error as e:
+            plan = f"  (no plan: {e})"
+        logger.warning("Slow query, %.1f ms: %s\n%s", seconds * 1000, fingerprint(sql), plan)
@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 
-from topanga_queries import db_connection
+from topanga_queries import get_read_connection
 
 
 @dataclass
@@ -12,6 +12,8 @@ class User:
 def get_user(id: str) -> User:
     """Get User from database.
 
+    Routed to the read connection, see `get_read_connection`.
+
     Args:
         id (str): User `id`
 
@@ -21,7 +23,7 @@ def get_user(id: str) -> User:
     Returns:
         User: User dataclass instance
     """
-    cur = db_connection.cursor()
+    cur = get_read_connection().cursor()
     cur.execute("""SELECT * FROM users WHERE id = ?""", (id,))
     record = cur.fetchone()
     if record: